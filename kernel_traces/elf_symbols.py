@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# on disk cache of the symbol tables, a json file per build-id / hash
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "elf_symbols")
+
+SHT_SYMTAB = 2
+SHT_NOTE = 7
+SHT_DYNSYM = 11
+NT_GNU_BUILD_ID = 3
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xff00
+
+
+class ElfError(ValueError):
+    pass
+
+
+class ElfFile:
+    """
+    Minimal ELF reader (standard library only): section headers, build-id and the .symtab / .dynsym symbols
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            ident = f.read(16)
+            if ident[:4] != b"\x7fELF":
+                raise ElfError("{} is not an ELF file".format(filename))
+            self._is64 = ident[4] == 2
+            self._endian = "<" if ident[5] == 1 else ">"
+
+            header = f.read(48 if self._is64 else 36)
+            if self._is64:
+                (_, _, _, _, _, shoff, _, _, _, _, shentsize, shnum, shstrndx) = struct.unpack(
+                    self._endian + "HHIQQQIHHHHHH", header)
+            else:
+                (_, _, _, _, _, shoff, _, _, _, _, shentsize, shnum, shstrndx) = struct.unpack(
+                    self._endian + "HHIIIIIHHHHHH", header)
+
+            section_format = self._endian + ("IIQQQQIIQQ" if self._is64 else "IIIIIIIIII")
+            f.seek(shoff)
+            table = f.read(shentsize * shnum)
+            # (name offset, type, flags, addr, offset, size, link, info, addralign, entsize)
+            self.sections = [struct.unpack_from(section_format, table, n * shentsize) for n in range(shnum)]
+            self._data = dict()
+            self._file = f
+            names = self._section_data(shstrndx) if shnum else b""
+            self.section_names = [_c_string(names, section[0]) for section in self.sections]
+            self.build_id = self._read_build_id()
+            self._file = None
+
+    def _section_data(self, index):
+        if index not in self._data:
+            section = self.sections[index]
+            self._file.seek(section[4])
+            self._data[index] = self._file.read(section[5])
+        return self._data[index]
+
+    def _read_build_id(self):
+        for index, section in enumerate(self.sections):
+            if section[1] != SHT_NOTE:
+                continue
+            data = self._section_data(index)
+            pos = 0
+            while pos + 12 <= len(data):
+                namesz, descsz, note_type = struct.unpack_from(self._endian + "III", data, pos)
+                pos += 12
+                name = data[pos:pos + namesz]
+                pos += (namesz + 3) & ~3
+                desc = data[pos:pos + descsz]
+                pos += (descsz + 3) & ~3
+                if note_type == NT_GNU_BUILD_ID and name.rstrip(b"\0") == b"GNU":
+                    return desc.hex()
+        return None
+
+    def symbols(self):
+        """
+        :return: dict of section name -> {symbol name: value} of the defined symbols of .symtab and .dynsym
+        """
+        result = dict()
+        symbol_format = self._endian + ("IBBHQQ" if self._is64 else "IIIBBH")
+        symbol_size = struct.calcsize(symbol_format)
+        with open(self.filename, "rb") as f:
+            self._file = f
+            for index, section in enumerate(self.sections):
+                if section[1] not in (SHT_SYMTAB, SHT_DYNSYM):
+                    continue
+                data = self._section_data(index)
+                strings = self._section_data(section[6])
+                for pos in range(0, len(data) - symbol_size + 1, symbol_size):
+                    if self._is64:
+                        name, _, _, shndx, value, _ = struct.unpack_from(symbol_format, data, pos)
+                    else:
+                        name, value, _, _, _, shndx = struct.unpack_from(symbol_format, data, pos)
+                    if not name or shndx == SHN_UNDEF or shndx >= SHN_LORESERVE:
+                        continue
+                    section_symbols = result.setdefault(self.section_names[shndx], dict())
+                    section_symbols.setdefault(_c_string(strings, name), value)
+            self._file = None
+            self._data = dict()
+        return result
+
+
+def _c_string(data, offset):
+    return data[offset:data.index(b"\0", offset)].decode(errors="replace")
+
+
+def _file_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return "sha1-" + digest.hexdigest()
+
+
+class SymbolCache:
+    """
+    Symbol tables of ELF files, parsed once per build-id (the file hash when there is none): kept in memory and
+    in CACHE_DIR. The key of a file is itself cached by (path, size, mtime).
+    """
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._keys = dict()
+        self._tables = dict()
+
+    def _key(self, filename):
+        stat = os.stat(filename)
+        file_id = (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+        if file_id not in self._keys:
+            build_id = ElfFile(filename).build_id
+            self._keys[file_id] = build_id if build_id else _file_hash(filename)
+        return self._keys[file_id]
+
+    def symbols(self, filename):
+        """
+        :return: dict of section name -> {symbol name: value}
+        """
+        key = self._key(filename)
+        if key in self._tables:
+            return self._tables[key]
+
+        cache_file = os.path.join(self.cache_dir, key + ".json") if self.cache_dir else None
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file) as f:
+                    self._tables[key] = json.load(f)
+                return self._tables[key]
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring the symbol cache %s: %s", cache_file, e)
+
+        logger.debug("Loading the symbols of %s (%s)", filename, key)
+        self._tables[key] = ElfFile(filename).symbols()
+        if cache_file:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(cache_file), suffix=".tmp",
+                                                dir=self.cache_dir)
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        json.dump(self._tables[key], f)
+                    os.replace(tmp_file, cache_file)
+                except BaseException:
+                    os.unlink(tmp_file)
+                    raise
+            except OSError as e:
+                logger.warning("Failed to save the symbol cache %s: %s", cache_file, e)
+        return self._tables[key]
+
+    def address(self, filename, symbol, section=".text"):
+        """
+        Value of a symbol defined in section, as printed by objdump -tT
+        """
+        try:
+            return self.symbols(filename)[section][symbol]
+        except KeyError:
+            raise KeyError("{} not found in the {} symbols of {}".format(symbol, section, filename)) from None
+
+
+symbol_cache = SymbolCache()
@@ -0,0 +1,69 @@
+class EventMatch:
+    """
+    Declarative event predicate: the event name is one of events (any name if None), the info contains one of
+    info_contains (if given) and none of info_excludes, the procname contains procname (if given)
+    """
+    def __init__(self, events=None, info_contains=(), info_excludes=(), procname=None):
+        if isinstance(events, str):
+            events = (events,)
+        self.events = tuple(events) if events is not None else None
+        self.info_contains = tuple(info_contains)
+        self.info_excludes = tuple(info_excludes)
+        self.procname = procname
+
+    def __repr__(self):
+        return "EventMatch({}, info_contains={}, info_excludes={}, procname={})".format(
+            self.events, self.info_contains, self.info_excludes, self.procname)
+
+    def match_info(self, info):
+        return ((not self.info_contains or any(s in info for s in self.info_contains)) and
+                not any(s in info for s in self.info_excludes))
+
+    def __call__(self, event):
+        return ((self.events is None or event.event in self.events) and
+                (self.procname is None or self.procname in event.procname) and
+                self.match_info(event.info))
+
+
+class PairSpec:
+    """
+    "remember start event, close on end event" interval:
+    a start event replaces the remembered start, an end event closes the remembered start (if any) and a reset event
+    forgets it. An event matching start is a start, otherwise an event matching end is an end.
+    Only events of source (and cpu) are considered, key ("cpu" or "pid") tracks a remembered start per cpu / pid.
+    """
+    KEYS = (None, "cpu", "pid")
+
+    def __init__(self, name, start, end, source=None, cpu=None, key=None, reset=None):
+        assert key in self.KEYS, "unknown key {}".format(key)
+        self.name = name
+        self.start = start
+        self.end = end
+        self.reset = reset
+        self.source = source
+        self.cpu = cpu
+        self.key = key
+
+    def __repr__(self):
+        return "PairSpec({})".format(self.name)
+
+    @property
+    def events(self):
+        """
+        Names of the events the spec looks at, None for every event
+        """
+        matches = [self.start, self.end] + ([self.reset] if self.reset is not None else [])
+        if any(match.events is None for match in matches):
+            return None
+        return frozenset(name for match in matches for name in match.events)
+
+    def accepts(self, event):
+        return ((self.source is None or event.source == self.source) and
+                (self.cpu is None or int(event.cpuNum) == self.cpu))
+
+    def event_key(self, event):
+        if self.key == "cpu":
+            return event.cpuNum
+        if self.key == "pid":
+            return event.pid
+        return None
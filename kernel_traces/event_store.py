@@ -0,0 +1,338 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from kernel_traces.trace_parser import Event
+
+EVENT_DTYPE = np.dtype([
+    ("timestamp", np.int64),
+    ("cpu", np.int16),
+    ("pid", np.int32),
+    ("source", "S1"),
+    ("event", np.int32),  # id in EventStore.event_names
+    ("reason", np.int32),  # id in EventStore.reason_names
+    ("procname", np.int32),  # id in EventStore.procnames
+    ("flags", np.int32),  # id in EventStore.flag_names
+])
+
+
+class InternTable:
+    """
+    Map strings to small integer ids, id 0 is always the empty string
+    """
+    def __init__(self, names=("",)):
+        self.names = list()
+        self._ids = dict()
+        for name in names:
+            self.intern(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, item):
+        return self.names[item]
+
+    def __contains__(self, item):
+        return item in self._ids
+
+    def intern(self, name):
+        try:
+            return self._ids[name]
+        except KeyError:
+            self._ids[name] = len(self.names)
+            self.names.append(name)
+            return self._ids[name]
+
+    def get_id(self, name, default=-1):
+        return self._ids.get(name, default)
+
+    def get_ids(self, names):
+        return [self._ids[name] for name in names if name in self._ids]
+
+    def ids_matching(self, predicate):
+        return [n for n, name in enumerate(self.names) if predicate(name)]
+
+
+class EventStore:
+    """
+    Columnar representation of trace events: one structured numpy array (see EVENT_DTYPE) and a side table with
+    the raw info strings (utf-8 blob and offsets).
+    Slicing returns a view of the store, use event(i) / iter_events() to get Event objects back.
+    """
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, data=None, info_blob=b"", info_offsets=None,
+                 event_names=None, reason_names=None, procnames=None, flag_names=None):
+        if data is None:
+            data = np.empty(0, dtype=EVENT_DTYPE)
+        if info_offsets is None:
+            info_offsets = np.zeros(len(data) + 1, dtype=np.int64)
+
+        self.data = data
+        self.info_blob = info_blob
+        self.info_offsets = info_offsets
+
+        self.event_names = event_names if event_names is not None else InternTable()
+        self.reason_names = reason_names if reason_names is not None else InternTable()
+        self.procnames = procnames if procnames is not None else InternTable()
+        self.flag_names = flag_names if flag_names is not None else InternTable()
+
+    @classmethod
+    def from_events(cls, events):
+        """
+        Build a store from an iterable of Event, the iterable is consumed in chunks so a stream of events
+        (Traces.iter_events()) never has to be in memory as Event objects
+        """
+        store = cls()
+        chunks = list()
+        info_chunks = list()
+        info_lengths = list()
+
+        chunk = np.empty(cls.CHUNK_SIZE, dtype=EVENT_DTYPE)
+        chunk_info = list()
+        for event in events:
+            chunk[len(chunk_info)] = store._event_row(event)
+            info = event.info.encode()
+            chunk_info.append(info)
+            info_lengths.append(len(info))
+            if len(chunk_info) == cls.CHUNK_SIZE:
+                chunks.append(chunk)
+                info_chunks.append(b"".join(chunk_info))
+                chunk = np.empty(cls.CHUNK_SIZE, dtype=EVENT_DTYPE)
+                chunk_info = list()
+        chunks.append(chunk[:len(chunk_info)])
+        info_chunks.append(b"".join(chunk_info))
+
+        store.data = np.concatenate(chunks)
+        store.info_blob = b"".join(info_chunks)
+        store.info_offsets = np.zeros(len(store.data) + 1, dtype=np.int64)
+        np.cumsum(np.asarray(info_lengths, dtype=np.int64), out=store.info_offsets[1:])
+        return store
+
+    def _event_row(self, event):
+        try:
+            pid = event.pid
+        except ValueError:
+            pid = -1
+        return (event.timestamp,
+                int(event.cpuNum),
+                pid,
+                event.source.encode(),
+                self.event_names.intern(event.event),
+                self.reason_names.intern(event.reason),
+                self.procnames.intern(event.procname),
+                self.flag_names.intern(event.flags),
+                )
+
+    @classmethod
+    def concatenate(cls, stores):
+        """
+        Concatenate stores (in order), ids of the intern tables are remapped to a common table
+        """
+        result = cls()
+        data = list()
+        offsets = [np.zeros(1, dtype=np.int64)]
+        blob_size = 0
+        for store in stores:
+            current = store.data.copy()
+            for column, table, result_table in (("event", store.event_names, result.event_names),
+                                                ("reason", store.reason_names, result.reason_names),
+                                                ("procname", store.procnames, result.procnames),
+                                                ("flags", store.flag_names, result.flag_names)):
+                mapping = np.asarray([result_table.intern(name) for name in table.names], dtype=np.int32)
+                current[column] = mapping[current[column]]
+            data.append(current)
+
+            store_offsets = store.info_offsets - store.info_offsets[0]
+            offsets.append(store_offsets[1:] + blob_size)
+            blob_size += int(store_offsets[-1])
+
+        result.data = np.concatenate(data) if data else result.data
+        result.info_offsets = np.concatenate(offsets)
+        result.info_blob = b"".join(store.info_blob[store.info_offsets[0]:store.info_offsets[-1]] for store in stores)
+        return result
+
+    @classmethod
+    def merge(cls, stores):
+        """
+        Concatenate the stores and sort by timestamp, on equal timestamps the order of stores is kept
+        """
+        store = cls.concatenate(stores)
+        return store.take(np.argsort(store.data["timestamp"], kind="stable"))
+
+    def take(self, indices):
+        """
+        New store with the events at indices (copy)
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.info_offsets[indices + 1] - self.info_offsets[indices]
+        info_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=info_offsets[1:])
+        info_blob = b"".join(self.info_blob[self.info_offsets[i]:self.info_offsets[i + 1]] for i in indices)
+        return self._new(self.data[indices], info_blob, info_offsets)
+
+    def save(self, filename, meta=None):
+        """
+        Save the store (and json serializable meta data) to an uncompressed npz file, the file is replaced atomically
+        """
+        fd, tmp_filename = tempfile.mkstemp(prefix=os.path.basename(filename), suffix=".tmp",
+                                            dir=os.path.dirname(filename) or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f,
+                         data=self.data,
+                         info_blob=np.frombuffer(self.info_blob[self.info_offsets[0]:self.info_offsets[-1]],
+                                                 dtype=np.uint8),
+                         info_offsets=self.info_offsets - self.info_offsets[0],
+                         event_names=np.asarray(self.event_names.names, dtype=str),
+                         reason_names=np.asarray(self.reason_names.names, dtype=str),
+                         procnames=np.asarray(self.procnames.names, dtype=str),
+                         flag_names=np.asarray(self.flag_names.names, dtype=str),
+                         meta=np.asarray(json.dumps(meta)),
+                         )
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+
+    @classmethod
+    def load(cls, filename):
+        """
+        :return: (store, meta)
+        """
+        with np.load(filename) as f:
+            store = cls(f["data"],
+                        f["info_blob"].tobytes(),
+                        f["info_offsets"],
+                        event_names=InternTable(f["event_names"].tolist()),
+                        reason_names=InternTable(f["reason_names"].tolist()),
+                        procnames=InternTable(f["procnames"].tolist()),
+                        flag_names=InternTable(f["flag_names"].tolist()),
+                        )
+            meta = json.loads(f["meta"].item())
+        return store, meta
+
+    def _new(self, data, info_blob, info_offsets):
+        return self.__class__(data, info_blob, info_offsets,
+                              event_names=self.event_names,
+                              reason_names=self.reason_names,
+                              procnames=self.procnames,
+                              flag_names=self.flag_names)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            assert step == 1, "only contiguous slices are supported"
+            stop = max(start, stop)
+            return self._new(self.data[start:stop], self.info_blob, self.info_offsets[start:stop + 1])
+        return self.event(item)
+
+    @property
+    def timestamps(self):
+        return self.data["timestamp"]
+
+    def info(self, i):
+        return self.info_blob[self.info_offsets[i]:self.info_offsets[i + 1]].decode()
+
+    def event(self, i):
+        row = self.data[i]
+        event = Event(self.procnames[row["procname"]],
+                      "{:03d}".format(row["cpu"]),
+                      self.flag_names[row["flags"]],
+                      int(row["timestamp"]),
+                      self.event_names[row["event"]],
+                      self.info(i),
+                      source=row["source"].decode(),
+                      reason_id=Event.REASONS.intern(self.reason_names[row["reason"]]))
+        return event
+
+    def iter_events(self, indices=None):
+        if indices is None:
+            indices = np.arange(len(self))
+        indices = np.asarray(indices, dtype=np.int64)
+        # the reasons are already decoded, only map them to the ids of the shared Event.REASONS table
+        reason_ids = [Event.REASONS.intern(name) for name in self.reason_names.names]
+        # columns are converted to python objects a chunk at a time, much faster than row by row access
+        for chunk_start in range(0, len(indices), self.CHUNK_SIZE):
+            chunk = indices[chunk_start:chunk_start + self.CHUNK_SIZE]
+            rows = self.data[chunk]
+            info_starts = self.info_offsets[chunk].tolist()
+            info_ends = self.info_offsets[chunk + 1].tolist()
+            for procname, cpu, flags, timestamp, event, source, reason, info_start, info_end in zip(
+                    rows["procname"].tolist(), rows["cpu"].tolist(), rows["flags"].tolist(),
+                    rows["timestamp"].tolist(), rows["event"].tolist(), rows["source"].tolist(),
+                    rows["reason"].tolist(), info_starts, info_ends):
+                yield Event(self.procnames[procname],
+                            "{:03d}".format(cpu),
+                            self.flag_names[flags],
+                            timestamp,
+                            self.event_names[event],
+                            self.info_blob[info_start:info_end].decode(),
+                            source=source.decode(),
+                            reason_id=reason_ids[reason])
+
+    def time_slice(self, start=None, end=None):
+        """
+        View of the events with start < timestamp < end (the store is sorted by timestamp), O(log n)
+        """
+        timestamps = self.data["timestamp"]
+        first = 0 if start is None else int(np.searchsorted(timestamps, start, side="right"))
+        last = len(self) if end is None else int(np.searchsorted(timestamps, end, side="left"))
+        return self[first:last]
+
+    def group_by(self, *columns):
+        """
+        Split the events by the values of columns (e.g. "source", "cpu"), the order of events is kept in each group
+        :return: dict of key tuple -> view, all the views share one reordered copy of the store
+        """
+        order = np.lexsort([self.data[column] for column in reversed(columns)])
+        grouped = self.take(order)
+        keys = np.stack([grouped.data[column].astype(np.int64) if column != "source"
+                         else grouped.data[column].view(np.uint8).astype(np.int64)
+                         for column in columns], axis=-1)
+        bounds = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+        starts = [0] + bounds.tolist()
+        ends = bounds.tolist() + [len(grouped)]
+
+        groups = dict()
+        for start, end in zip(starts, ends):
+            if start == end:
+                continue
+            row = grouped.data[start]
+            key = tuple(row[column].decode() if column == "source" else int(row[column]) for column in columns)
+            groups[key] = grouped[start:end]
+        return groups
+
+    def shift_timestamps(self, delta, mask=None):
+        if mask is None:
+            self.data["timestamp"] += delta
+        else:
+            self.data["timestamp"][mask] += delta
+
+    # vectorized predicates
+    def mask_event(self, *names):
+        return np.isin(self.data["event"], self.event_names.get_ids(names))
+
+    def mask_reason(self, predicate):
+        return np.isin(self.data["reason"], self.reason_names.ids_matching(predicate))
+
+    def mask_source(self, source):
+        return self.data["source"] == source.encode()
+
+    def mask_cpu(self, cpu):
+        return self.data["cpu"] == int(cpu)
+
+    def mask_info(self, predicate, mask=None):
+        """
+        Evaluate predicate on the info strings, only on the events selected by mask (not vectorized)
+        """
+        result = np.zeros(len(self), dtype=bool)
+        indices = range(len(self)) if mask is None else np.flatnonzero(mask)
+        for i in indices:
+            result[i] = predicate(self.info(i))
+        return result
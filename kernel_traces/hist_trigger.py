@@ -0,0 +1,181 @@
+import logging
+import re
+
+from kernel_traces.online_stats import LogLinearHistogram
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+HIST_ENTRY_RE = re.compile(r"^\{(?P<keys>.*)\}(?P<values>.*)$")
+HIST_VALUE_RE = re.compile(r"(\w+):\s*(-?\d+)")
+HIST_LOG2_RE = re.compile(r"^~\s*2\^(\d+)$")
+HIST_TOTAL_RE = re.compile(r"^\s*(Hits|Entries|Dropped):\s*(\d+)", re.MULTILINE)
+
+
+class Hist:
+    """
+    One table of an events/<system>/<name>/hist file
+    """
+    def __init__(self, trigger=""):
+        self.trigger = trigger
+        self.entries = list()  # (keys dict, values dict)
+        self.totals = dict()
+
+    @property
+    def dropped(self):
+        return self.totals.get("Dropped", 0)
+
+
+def _parse_key(value):
+    """
+    Numeric keys are converted, a .log2 key ("~ 2^n") is converted to 2^n
+    """
+    value = value.strip()
+    match = HIST_LOG2_RE.match(value)
+    if match:
+        return 1 << int(match.group(1))
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def parse_hist(text):
+    """
+    Parse a hist file, a table per trigger of the event:
+        { exit_reason:         30, lat: ~ 2^10 } hitcount:        123  lat:      4567
+    :return: list of Hist
+    """
+    hists = list()
+    for part in text.split("# event histogram")[1:]:
+        trigger = re.search(r"^# trigger info:\s*(.*)$", part, re.MULTILINE)
+        hist = Hist(trigger.group(1) if trigger else "")
+        for line in part.splitlines():
+            match = HIST_ENTRY_RE.match(line.strip())
+            if not match:
+                continue
+            keys = dict()
+            for key in match.group("keys").split(","):
+                name, _, value = key.partition(":")
+                keys[name.strip()] = _parse_key(value)
+            values = {name: int(value) for name, value in HIST_VALUE_RE.findall(match.group("values"))}
+            hist.entries.append((keys, values))
+        hist.totals = {name: int(value) for name, value in HIST_TOTAL_RE.findall(part)}
+        if hist.dropped:
+            logger.warning("Histogram %s dropped %d entries (table full), increase its size", hist.trigger,
+                           hist.dropped)
+        hists.append(hist)
+    return hists
+
+
+def exit_reason_names(format_text, defaults=None):
+    """
+    Names of the kvm_exit exit_reason values, as shown in the text trace (and translated with Event.REASONS_NAME),
+    taken from the __print_symbolic() table of the print fmt
+    :param format_text: events/kvm/kvm_exit/format
+    :param defaults: values of the other fields the print fmt depends on (isa)
+    :return: function exit_reason -> name
+    """
+    from kernel_traces.raw_trace import EventFormat
+    from kernel_traces.trace_parser import Event
+
+    event_format = EventFormat.parse(format_text)
+    record = {field.name: 0 for field in event_format.fields}
+    record.update(defaults or {})
+    names = dict()
+
+    def name(exit_reason):
+        try:
+            return names[exit_reason]
+        except KeyError:
+            pass
+        record["exit_reason"] = exit_reason
+        _, info = event_format.format(record)
+        reason = info.split()[1] if info.startswith("reason ") else str(exit_reason)
+        names[exit_reason] = Event.REASONS_NAME.get(reason, reason)
+        return names[exit_reason]
+    return name
+
+
+class ExitLatencyHist:
+    """
+    kvm_exit -> kvm_entry latency (trace clock units) per exit reason, aggregated in the kernel:
+    a synthetic event is fired on every kvm_entry with the latency since the kvm_exit of the same vcpu thread, and
+    two hist triggers on it keep the count / total latency and the log2 latency distribution of every exit reason.
+    Nothing goes through the ring buffer.
+    """
+    EVENT = "kvm_exit_latency"
+    SYNTHETIC_EVENT = "{} u32 exit_reason; u64 lat".format(EVENT)
+    # the hosts traced are Intel, KVM_ISA_VMX
+    KVM_EXIT_DEFAULTS = {"isa": 1}
+    TABLE_SIZE = 8192
+
+    TRIGGERS = (
+        ("kvm/kvm_exit", "hist:keys=common_pid:exit_ts=common_timestamp:exit_reason_var=exit_reason"),
+        ("kvm/kvm_entry", "hist:keys=common_pid:exit_lat=common_timestamp-$exit_ts:"
+                          "onmatch(kvm.kvm_exit).{}($exit_reason_var,$exit_lat)".format(EVENT)),
+    )
+    # read back, can be paused / cleared
+    TOTALS_TRIGGER = "hist:keys=exit_reason:vals=hitcount,lat:sort=exit_reason"
+    DISTRIBUTION_TRIGGER = "hist:keys=exit_reason,lat.log2:sort=exit_reason,lat.log2:size={}".format(TABLE_SIZE)
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    @property
+    def event_path(self):
+        return "synthetic/{}".format(self.EVENT)
+
+    def install(self):
+        self.trace.synthetic_event_add(self.SYNTHETIC_EVENT)
+        for event_path, trigger in self.TRIGGERS:
+            self.trace.hist_trigger_add(event_path, trigger)
+        for trigger in (self.TOTALS_TRIGGER, self.DISTRIBUTION_TRIGGER):
+            self.trace.hist_trigger_add(self.event_path, trigger)
+
+    def remove(self):
+        """
+        Remove the triggers and the synthetic event (those left by an earlier run too), in reverse order: the
+        triggers using the synthetic event first
+        """
+        for trigger in (self.DISTRIBUTION_TRIGGER, self.TOTALS_TRIGGER):
+            self.trace.hist_trigger_remove(self.event_path, trigger)
+        for event_path, trigger in reversed(self.TRIGGERS):
+            self.trace.hist_trigger_remove(event_path, trigger)
+        self.trace.synthetic_event_remove(self.EVENT)
+
+    def control(self, command):
+        """
+        :param command: "pause", "continue" or "clear"
+        """
+        for trigger in (self.TOTALS_TRIGGER, self.DISTRIBUTION_TRIGGER):
+            self.trace.hist_trigger_command(self.event_path, trigger, command)
+
+    def read(self):
+        """
+        :return: dict exit reason -> (count, total latency, LogLinearHistogram of the log2 buckets)
+        """
+        names = exit_reason_names(self.trace.read_value(("events", "kvm", "kvm_exit", "format"), log_output=False),
+                                  self.KVM_EXIT_DEFAULTS)
+        results = dict()
+        for hist in self.trace.read_hist(self.event_path):
+            for keys, values in hist.entries:
+                reason = names(keys["exit_reason"])
+                count, total, histogram = results.get(reason, (0, 0, LogLinearHistogram()))
+                if "lat" in keys:
+                    # DISTRIBUTION_TRIGGER
+                    histogram.add(keys["lat"], values.get("hitcount", 0))
+                else:
+                    count, total = values.get("hitcount", 0), values.get("lat", 0)
+                results[reason] = (count, total, histogram)
+        return results
+
+    def write_csv(self, filename):
+        results = self.read()
+        with open(filename, "w") as f:
+            f.write("reason,count,avg,p50,p90,p99,max\n")
+            for reason, (count, total, histogram) in sorted(results.items(), key=lambda item: -item[1][0]):
+                quantiles = [histogram.quantile(q) for q in (0.5, 0.9, 0.99, 1)] if count else [0] * 4
+                f.write(",".join(str(value) for value in
+                                 [reason, count, total / count if count else 0] + quantiles) + "\n")
+        return results
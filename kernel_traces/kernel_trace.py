@@ -1,14 +1,17 @@
+import contextlib
 import shlex
 
 import logging
 import shutil
+import tarfile
+import time
 
 from utils.machine import Machine
 import os.path
 import threading
 import subprocess
 
-from utils.shell_utils import run_command, run_command_output
+from utils.shell_utils import run_command
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -17,6 +20,18 @@ logger.setLevel(logging.DEBUG)
 class Trace:
     TRACE_DIR = r"/sys/kernel/debug/tracing/"
     TMP_FILE = '/tmp/trace_host_tmp'
+    BATCH_MARK = "@@trace-batch"  # separates the results of the writes in the output of a batch
+    # calibrate_buffer_size(): the per cpu buffers hold the whole run times the margin, bounded by the minimum and
+    # by a fraction of the available memory of the traced machine (for all the cpus)
+    BUFFER_MARGIN = 1.5
+    BUFFER_MIN_KB = 1024
+    BUFFER_MEMORY_FRACTION = 0.5
+    # per cpu buffer to measure the event rate with (calibration_start()), before the real sizes are known
+    BUFFER_CALIBRATION_KB = 4096
+    # shell commands copying the files needed to decode raw buffers to $tmp (run in TRACE_DIR)
+    RAW_CMDLINES_COMMAND = "cat saved_cmdlines > $tmp/saved_cmdlines; "
+    RAW_METADATA_COMMAND = ("cat events/header_page > $tmp/header_page; " + RAW_CMDLINES_COMMAND +
+                            "cat events/*/*/format > $tmp/formats 2>/dev/null; ")
 
     def __init__(self, target: Machine, target_file):
         self.target = target
@@ -25,6 +40,12 @@ class Trace:
         self._thread = threading.Thread(target=thread_read_trace, args=(self,))
         self._read_proc = None
         self._trace_on = False
+        self._capture = None
+        self._plan = None  # writes collected by batch()
+        self._exit_hist = None
+        self._calibration_start = None
+        self._available_kb = None  # MemAvailable when the calibration started
+        self.probes = dict()  # event name -> probe kind (kprobe, kretprobe, uprobe, uretprobe)
 
         # self._old_cpumask = self.read_value("tracing_cpumask")
 
@@ -33,8 +54,7 @@ class Trace:
             key = os.path.join(*key)
         return key
 
-    def write_value(self, key, value, append=False, cpu=None):
-        print(repr(value))
+    def _write_command(self, key, value, append=False, cpu=None):
         command = "echo {value} {redirect} {key_path}".format(
             value=value,
             key_path=os.path.join(self.TRACE_DIR, self._key2path(key)),
@@ -42,9 +62,204 @@ class Trace:
         )
         if cpu is not None:
             command = "sudo taskset -c {} bash -c \"{}\"".format(cpu, command)
-        self.target.remote_command(command)
+        return command
+
+    def write_value(self, key, value, append=False, cpu=None, check=True):
+        """
+        :param check: in a batch, fail the batch if the write fails (out of a batch, the write always raises)
+        """
+        print(repr(value))
+        if self._plan is not None:
+            self._plan.append((self._key2path(key), value, append, cpu, check))
+            return
+        if self.target.direct_files:
+            self.target.write_file(os.path.join(self.TRACE_DIR, self._key2path(key)), self._echo_text(value),
+                                   append=append, cpu=cpu)
+            return
+        self.target.remote_command(self._write_command(key, value, append, cpu))
+
+    @staticmethod
+    def _echo_text(value):
+        """
+        What "echo {value}" writes, for the direct writes
+        """
+        return " ".join(shlex.split(str(value))) + "\n"
+
+    @contextlib.contextmanager
+    def batch(self, verify=True):
+        """
+        Collect the writes (setup(), enable_event(), kprobe_add()...) and apply them at the end of the block with a
+        single remote shell, instead of one ssh per write:
+
+            with trace.batch():
+                trace.setup()
+                trace.enable_event("kvm/kvm_exit")
+
+        :param verify: read the written files back and raise when they don't hold the written values
+        """
+        if self._plan is not None:
+            # nested, applied by the outer batch
+            yield
+            return
+
+        self._plan = list()
+        try:
+            yield
+            plan = self._plan
+        finally:
+            self._plan = None
+        self.apply_plan(plan, verify=verify)
+
+    def apply_plan(self, plan, verify=True):
+        """
+        Run the writes of plan [(key, value, append, cpu, check)] on the target at once: direct writes when the
+        target files are local, otherwise a single "sh -s"
+        """
+        if not plan:
+            return
+
+        if self.target.direct_files:
+            failed, read_back = self._apply_plan_direct(plan, verify)
+        else:
+            failed, read_back = self._apply_plan_script(plan, verify)
+
+        errors = list()
+        for n in failed:
+            key, value, append, cpu, check = plan[n]
+            if check:
+                errors.append("failed to write {!r} to {}".format(value, key))
+            else:
+                logger.debug("Ignored failed write of %r to %s", value, key)
+        for n, content in read_back.items():
+            key, value, append, cpu, check = plan[n]
+            if n in failed:
+                continue
+            if not self._verify_value(key, value, append, content):
+                errors.append("{} is {!r} after writing {!r}".format(key, content[:200], value))
+        if errors:
+            raise RuntimeError("Trace configuration failed: {}".format("; ".join(errors)))
+
+    def _apply_plan_direct(self, plan, verify):
+        """
+        Apply the plan with direct file writes (see Machine.direct_files)
+        :return: (indices of the failed writes, dict of index -> content read back)
+        """
+        failed = list()
+        for n, (key, value, append, cpu, check) in enumerate(plan):
+            try:
+                self.target.write_file(os.path.join(self.TRACE_DIR, key), self._echo_text(value), append=append,
+                                       cpu=cpu)
+            except subprocess.CalledProcessError:
+                failed.append(n)
+        read_back = dict()
+        if verify:
+            for n in self._writes_to_verify(plan):
+                try:
+                    read_back[n] = self.target.read_file(os.path.join(self.TRACE_DIR, plan[n][0]))
+                except OSError:
+                    read_back[n] = ""
+        return failed, read_back
+
+    def _apply_plan_script(self, plan, verify):
+        """
+        Apply the plan with a single "sh -s" on the target
+        :return: (indices of the failed writes, dict of index -> content read back)
+        """
+        lines = list()
+        for n, (key, value, append, cpu, check) in enumerate(plan):
+            lines.append("{} 2>/dev/null || echo {} fail {}".format(self._write_command(key, value, append, cpu),
+                                                                     self.BATCH_MARK, n))
+        if verify:
+            for n in self._writes_to_verify(plan):
+                lines.append("echo {} read {}; cat {} 2>/dev/null".format(
+                    self.BATCH_MARK, n, os.path.join(self.TRACE_DIR, plan[n][0])))
+        script = "\n".join(lines) + "\n"
+        logger.debug("Apply %d trace writes:\n%s", len(plan), script)
+        output = self.target.remote_command("sh -s", input=script, log_output=False)
+
+        failed = list()
+        read_back = dict()
+        current = None
+        for line in output.splitlines():
+            if line.startswith(self.BATCH_MARK):
+                _, what, n = line.split()
+                if what == "fail":
+                    failed.append(int(n))
+                else:
+                    current = read_back[int(n)] = list()
+            elif current is not None:
+                current.append(line)
+        return failed, {n: "\n".join(content) for n, content in read_back.items()}
+
+    def _writes_to_verify(self, plan):
+        """
+        Indices of the writes whose result should still be visible at the end of the plan: the last write of
+        every file, all the probes appended after the last clear of a probe file, and no enable file with a
+        later write to an enable file above or below it (they change each other)
+        """
+        result = list()
+        for n, (key, value, append, cpu, check) in enumerate(plan):
+            if self._expected_value(key, value, append) is None:
+                continue
+            later = [(later_key, later_append) for later_key, _, later_append, _, _ in plan[n + 1:]]
+            name = os.path.basename(key)
+            if name in ("kprobe_events", "uprobe_events") and append:
+                if (key, False) in later:
+                    continue
+            elif any(later_key == key for later_key, _ in later):
+                continue
+            if name == "enable":
+                directory = os.path.dirname(key)
+                if any(os.path.basename(later_key) == "enable" and
+                       (os.path.dirname(later_key).startswith(directory + "/") or
+                        directory.startswith(os.path.dirname(later_key) + "/"))
+                       for later_key, _ in later):
+                    continue
+            result.append(n)
+        return result
+
+    @staticmethod
+    def _expected_value(key, value, append):
+        """
+        What a file should hold after a write, None when it is not verified
+        """
+        name = os.path.basename(key)
+        value = str(value)
+        if name in ("kprobe_events", "uprobe_events"):
+            if not append:
+                return "" if not value else None
+            # "p:name func" is listed as "p:group/name func"
+            probe = value.split()[0] if value.split() else ""
+            return probe.split(":", 1)[-1].split("/")[-1] or None
+        if name == "filter":
+            unquoted = shlex.split(value) if value else []
+            return unquoted[0] if unquoted and unquoted[0] else "none"
+        if name in ("enable", "tracing_on", "current_tracer", "trace_clock", "buffer_size_kb"):
+            return value
+        return None
+
+    def _verify_value(self, key, value, append, content):
+        name = os.path.basename(key)
+        expected = self._expected_value(key, value, append)
+        content = content.strip()
+        if name in ("kprobe_events", "uprobe_events"):
+            if not append:
+                return content == expected
+            return any(line.split()[0].split(":", 1)[-1].split("/")[-1] == expected
+                       for line in content.splitlines() if line.split())
+        if name == "trace_clock":
+            return "[{}]".format(expected) in content.split()
+        if name == "buffer_size_kb":
+            # rounded up to whole pages
+            try:
+                return int(content.split()[0]) >= int(expected)
+            except (ValueError, IndexError):
+                return False
+        return content == expected
 
     def read_value(self, key, **kargs):
+        if self.target.direct_files:
+            return self.target.read_file(os.path.join(self.TRACE_DIR, self._key2path(key)))
         command = "cat {key_path}".format(
             key_path=os.path.join(self.TRACE_DIR, self._key2path(key))
         )
@@ -58,8 +273,131 @@ class Trace:
         self.kprobe_empty()
         self.uprobe_empty()
 
-    def set_buffer_size(self, size):
-        self.write_value("buffer_size_kb", size)
+    def set_buffer_size(self, size, cpu=None):
+        """
+        :param cpu: size of a single cpu buffer, default all
+        """
+        if cpu is None:
+            self.write_value("buffer_size_kb", size)
+        else:
+            self.write_value(("per_cpu", "cpu{}".format(cpu), "buffer_size_kb"), size)
+
+    def online_cpus(self):
+        output = self.target.remote_command("ls {}".format(os.path.join(self.TRACE_DIR, "per_cpu")),
+                                            log_output=False)
+        return sorted(int(name[3:]) for name in output.split() if name.startswith("cpu") and name[3:].isdigit())
+
+    def read_cpu_stats(self, cpus=None):
+        """
+        Read per_cpu/cpuN/stats
+        :return: dict of cpu -> stats dict, see kernel_traces.trace_capture.parse_cpu_stats
+        """
+        from kernel_traces.trace_capture import parse_cpu_stats
+
+        if cpus is None:
+            cpus = self.online_cpus()
+        command = "; ".join("echo == {cpu}; cat {stats}".format(
+            cpu=cpu, stats=os.path.join(self.TRACE_DIR, "per_cpu", "cpu{}".format(cpu), "stats")) for cpu in cpus)
+        output = self.target.remote_command(command, log_output=False)
+
+        stats = dict()
+        for part in output.split("== ")[1:]:
+            cpu, _, text = part.partition("\n")
+            stats[int(cpu)] = parse_cpu_stats(text)
+        return stats
+
+    def check_overruns(self, cpus=None, stats=None):
+        """
+        Warn about the events lost by the ring buffers (overrun / dropped events)
+        :return: (number of lost events, per cpu stats)
+        """
+        from kernel_traces.trace_capture import LOST_COUNTERS, lost_events
+
+        if stats is None:
+            stats = self.read_cpu_stats(cpus)
+        lost = 0
+        for cpu, cpu_stats in sorted(stats.items()):
+            cpu_lost = lost_events(cpu_stats)
+            if cpu_lost:
+                logger.warning("%s: lost %d events on cpu %d (%s), the trace is incomplete, use a larger buffer "
+                               "(calibrate_buffer_size)", self.target_file, cpu_lost, cpu,
+                               ", ".join("{} {}".format(name, cpu_stats.get(name, 0)) for name in LOST_COUNTERS))
+            lost += cpu_lost
+        return lost, stats
+
+    def available_memory_kb(self):
+        """
+        :return: MemAvailable of the target (KB), None if unknown
+        """
+        for line in self.target.remote_command("cat /proc/meminfo", log_output=False).splitlines():
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1])
+        return None
+
+    def calibration_start(self):
+        """
+        Trace the enabled events for a while (the workload should run until calibration_stop()) to measure their rate,
+        the buffers should still be small (BUFFER_CALIBRATION_KB): the available memory is read now
+        """
+        self._available_kb = self.available_memory_kb()
+        self.empty_trace()
+        self._calibration_start = time.time()
+        self.trace_on()
+
+    def calibration_stop(self, runtime, cpus=None):
+        """
+        Size the per cpu buffers for runtime seconds of the event rate measured since calibration_start(),
+        the trace is emptied
+        :param cpus: the traced cpus (default all), the buffers of the other online cpus are shrunk to BUFFER_MIN_KB
+        :return: dict of cpu -> buffer size (KB)
+        """
+        self.trace_off()
+        elapsed = time.time() - self._calibration_start
+        self._calibration_start = None
+        stats = self.read_cpu_stats(cpus)
+        others = [] if cpus is None else [cpu for cpu in self.online_cpus() if cpu not in stats]
+
+        available_kb = self._available_kb
+        self._available_kb = None
+        if available_kb and stats:
+            available_kb -= self.BUFFER_MIN_KB * len(others)
+            max_kb = max(self.BUFFER_MIN_KB, available_kb * self.BUFFER_MEMORY_FRACTION / len(stats))
+        else:
+            max_kb = None
+
+        sizes = dict()
+        for cpu, cpu_stats in sorted(stats.items()):
+            # the buffer may have wrapped: the overrun events are counted with the average size of the others
+            entries = cpu_stats.get("entries", 0)
+            events = entries + cpu_stats.get("overrun", 0) + cpu_stats.get("read events", 0)
+            event_size = cpu_stats.get("bytes", 0) / entries if entries else 0
+            size = max(self.BUFFER_MIN_KB, int(events * event_size / elapsed * runtime * self.BUFFER_MARGIN / 1024))
+            if max_kb is not None and size > max_kb:
+                logger.warning("%s: cpu %d needs a %d KB buffer for %ss, limited to %d KB by the available memory, "
+                               "events will be lost", self.target_file, cpu, size, runtime, max_kb)
+                size = int(max_kb)
+            logger.info("%s: cpu %d: %.0f events/s, buffer %d KB", self.target_file, cpu, events / elapsed, size)
+            sizes[cpu] = size
+
+        with self.batch():
+            for cpu in others:
+                self.set_buffer_size(self.BUFFER_MIN_KB, cpu=cpu)
+            for cpu, size in sizes.items():
+                self.set_buffer_size(size, cpu=cpu)
+            self.empty_trace()
+        return sizes
+
+    def calibrate_buffer_size(self, runtime, duration=1, workload=None, cpus=None):
+        """
+        Measure the rate of the enabled events while workload() runs (or for duration seconds), and size the per cpu
+        buffers to hold runtime seconds of it, see calibration_stop()
+        """
+        self.calibration_start()
+        if workload is not None:
+            workload()
+        else:
+            time.sleep(duration)
+        return self.calibration_stop(runtime, cpus=cpus)
 
     def trace_on(self):
         self.write_value("tracing_on", 1)
@@ -85,6 +423,74 @@ class Trace:
         else:
             return data
 
+    def read_trace_raw(self, filename=None, cpus=None):
+        """
+        Read the binary ring buffers (per_cpu/cpuN/trace_pipe_raw) together with the event format descriptors,
+        the events are decoded locally by kernel_traces.raw_trace.RawTraceFile (Traces picks it up by itself).
+        The kernel doesn't format the events and the transfer is several times smaller than the text trace.
+        The buffers are consumed.
+        :param cpus: cpus to read, default all
+        """
+        from kernel_traces.raw_trace import RAW_SUFFIX
+
+        if filename is None:
+            filename = self.target_file
+        raw_dir = filename + RAW_SUFFIX
+
+        cpu_names = "cpu*" if cpus is None else " ".join("cpu{}".format(cpu) for cpu in cpus)
+        command = ("cd {trace_dir} && tmp=$(mktemp -d) && mkdir $tmp/per_cpu && "
+                   "for cpu in $(cd per_cpu && echo {cpu_names}); do "
+                   "dd if=per_cpu/$cpu/trace_pipe_raw of=$tmp/per_cpu/$cpu bs=4096 iflag=nonblock status=none "
+                   "2>/dev/null; "
+                   "done; " +
+                   self.RAW_METADATA_COMMAND +
+                   "tar -C $tmp -c . ; rm -rf $tmp").format(trace_dir=self.TRACE_DIR, cpu_names=cpu_names)
+
+        shutil.rmtree(raw_dir, ignore_errors=True)
+        self._extract_remote_tar(command, raw_dir)
+
+    def read_trace_metadata(self, filename=None, cmdlines_only=False):
+        """
+        Read the files needed to decode the raw buffers of a capture (see kernel_traces.trace_capture)
+        :param cmdlines_only: only update saved_cmdlines (at the end of the capture)
+        """
+        from kernel_traces.raw_trace import RAW_SUFFIX
+
+        if filename is None:
+            filename = self.target_file
+        command = ("cd {trace_dir} && tmp=$(mktemp -d) && " +
+                   (self.RAW_CMDLINES_COMMAND if cmdlines_only else self.RAW_METADATA_COMMAND) +
+                   "tar -C $tmp -c . ; rm -rf $tmp").format(trace_dir=self.TRACE_DIR)
+        self._extract_remote_tar(command, filename + RAW_SUFFIX)
+
+    def _extract_remote_tar(self, command, directory):
+        command = self.target.remote_command_prepare(command)
+        logger.debug("Run command: %s", command)
+
+        with subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE) as proc:
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+                tar.extractall(directory, filter="data")
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, command)
+
+    def capture_start(self, cpus=None, raw=False, compress=False):
+        """
+        Start draining the per cpu buffers to local files while tracing, see kernel_traces.trace_capture
+        """
+        from kernel_traces.trace_capture import TraceCapture
+
+        assert self._capture is None
+        self._capture = TraceCapture(self, cpus=cpus, raw=raw, compress=compress)
+        self._capture.start()
+        return self._capture
+
+    def capture_stop(self):
+        """
+        :return: per cpu stats of the ring buffers (overrun, dropped events...)
+        """
+        capture, self._capture = self._capture, None
+        return capture.stop()
+
     def trace_to_local_file(self):
         command = "cat {} > {}".format(
             os.path.join(self.TRACE_DIR, "trace_pipe"),
@@ -118,11 +524,11 @@ class Trace:
     def disable_all_events(self):
         self.write_value(("events", "enable"), 0)
 
-    def _change_event_status(self, event_path, status):
+    def _change_event_status(self, event_path, status, check=True):
         """
         :param event_path: without leading events/
         """
-        self.write_value(("events", self._key2path(event_path), "enable"), status)
+        self.write_value(("events", self._key2path(event_path), "enable"), status, check=check)
 
     def enable_event(self, event_path):
         self._change_event_status(event_path, 1)
@@ -140,51 +546,66 @@ class Trace:
     def get_trace(self):
         return self.read_value("trace")
 
+    def _probe_added(self, kind, definition):
+        probe_type, _, rest = definition.partition(":")
+        if not rest.split():
+            return
+        name = rest.split()[0].rpartition("/")[2]
+        if probe_type == "-":
+            self.probes.pop(name, None)
+        else:
+            self.probes[name] = kind if probe_type == "p" else kind.replace("probe", "retprobe")
+
+    def _probes_emptied(self, kind):
+        self.probes = {name: probe_kind for name, probe_kind in self.probes.items() if probe_kind[0] != kind[0]}
+
     def kprobe_empty(self):
         self.kprobe_disbale()
         self.write_value("kprobe_events", "")
+        self._probes_emptied("kprobe")
 
     def kprobe_add(self, s):
         self.write_value("kprobe_events", s, append=True)
+        self._probe_added("kprobe", s)
 
     def kprobe_enable(self):
         try:
-            self.enable_event("kprobes")
+            self._change_event_status("kprobes", 1, check=False)
         except subprocess.CalledProcessError:
             pass
 
     def kprobe_disbale(self):
         try:
-            self.disable_event("kprobes")
+            self._change_event_status("kprobes", 0, check=False)
         except subprocess.CalledProcessError:
             pass
 
     def uprobe_empty(self):
         self.uprobe_disbale()
         self.write_value("uprobe_events", "")
+        self._probes_emptied("uprobe")
 
     def uprobe_add(self, s):
         self.write_value("uprobe_events", s, append=True)
+        self._probe_added("uprobe", s)
 
     def uprobe_enable(self):
         try:
-            self.enable_event("uprobes")
+            self._change_event_status("uprobes", 1, check=False)
         except subprocess.CalledProcessError:
             pass
 
     def uprobe_disbale(self):
         try:
-            self.disable_event("uprobes")
+            self._change_event_status("uprobes", 0, check=False)
         except subprocess.CalledProcessError:
             pass
 
     def uprobe_add_event(self, event_type, event_name, event_exe, event_func, misc=''):
-        command = "objdump -tT {exe} |grep .text|grep -w {func}|cut -f 1 -d \' \'".format(
-            exe=event_exe,
-            func=event_func
-        )
-        output=run_command_output(command, shell=True)
-        event_addr = int(output, 16)
+        from kernel_traces.elf_symbols import symbol_cache
+
+        # the symbol tables of event_exe are parsed once (per build-id), not for every probe
+        event_addr = symbol_cache.address(event_exe, event_func)
         event = "{event_type}:{event_name} {event_exe}:0x{event_addr:x} {misc}".format(
             event_type=event_type,
             event_name=event_name,
@@ -194,6 +615,62 @@ class Trace:
         )
         self.uprobe_add(event)
 
+    def synthetic_event_add(self, definition):
+        """
+        :param definition: "name type field; type field..."
+        """
+        self.write_value("synthetic_events", shlex.quote(definition), append=True)
+
+    def synthetic_event_remove(self, name):
+        self._remove_value("synthetic_events", "!" + name)
+
+    def hist_trigger_add(self, event_path, trigger):
+        """
+        :param trigger: "hist:keys=...", see Documentation/trace/histogram.rst
+        """
+        self.write_value(("events", self._key2path(event_path), "trigger"), shlex.quote(trigger), append=True)
+
+    def hist_trigger_remove(self, event_path, trigger):
+        self._remove_value(("events", self._key2path(event_path), "trigger"), "!" + trigger)
+
+    def hist_trigger_command(self, event_path, trigger, command):
+        """
+        :param command: "pause", "continue" or "clear" the histogram of trigger
+        """
+        self.write_value(("events", self._key2path(event_path), "trigger"),
+                         shlex.quote("{}:{}".format(trigger, command)), append=True)
+
+    def _remove_value(self, key, value):
+        # removing something that is not there fails, it is fine
+        try:
+            self.write_value(key, shlex.quote(value), append=True, check=False)
+        except subprocess.CalledProcessError:
+            pass
+
+    def read_hist(self, event_path):
+        """
+        :return: list of kernel_traces.hist_trigger.Hist, a table per hist trigger of the event
+        """
+        from kernel_traces.hist_trigger import parse_hist
+        return parse_hist(self.read_value(("events", self._key2path(event_path), "hist"), log_output=False))
+
+    def exit_latency_hist_start(self):
+        """
+        Aggregate the exit latency per exit reason in the kernel instead of tracing kvm_exit / kvm_entry
+        :return: kernel_traces.hist_trigger.ExitLatencyHist, read() / write_csv() it at the end
+        """
+        from kernel_traces.hist_trigger import ExitLatencyHist
+        self._exit_hist = ExitLatencyHist(self)
+        with self.batch(verify=False):
+            self._exit_hist.remove()
+            self._exit_hist.install()
+        return self._exit_hist
+
+    def exit_latency_hist_stop(self):
+        if self._exit_hist is not None:
+            self._exit_hist.remove()
+            self._exit_hist = None
+
     def trace_marker(self, msg, cpu=None):
         if self._trace_on:
             self.write_value("trace_marker", msg, cpu=cpu)
@@ -211,10 +688,7 @@ def thread_read_trace(trace):
     with subprocess.Popen(shlex.split(command),
                           stdout=subprocess.PIPE) as proc:
         with open(trace.target_file, "wb") as f:
-            while trace.running:
-                data = proc.stdout.read(1024*5)
-                f.write(data)
-            data = proc.stdout.read()
-            f.write(data)
+            # blocks on the pipe until the trace is read, no need to poll trace.running
+            shutil.copyfileobj(proc.stdout, f, 1 << 20)
             proc.stdout.close()
         proc.kill()
@@ -3,7 +3,7 @@ import csv
 import math
 import math
 import os
-from collections import defaultdict
+from collections import Counter, defaultdict
 from functools import lru_cache
 from operator import itemgetter
 from statistics import mean, median
@@ -131,9 +131,9 @@ def exit_time(events):
 def create_histogram(results, output_file):
     if results:
         with open(output_file, "w") as f:
-            data = [round(math.log(time, 2)) for time, _, _ in results]
+            data = Counter(round(math.log(time, 2)) for time, _, _ in results)
             for i in range(max(data)):
-                f.write("{} {}\n".format(i, data.count(i)))
+                f.write("{} {}\n".format(i, data[i]))
 
 
 def draw_histogram(results, output_file, title):
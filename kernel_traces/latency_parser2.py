@@ -1,8 +1,10 @@
 import logging
+import copy
 import csv
 import operator
 import os
-from statistics import mean, median
+from collections import Counter
+from statistics import mean, median, pstdev
 
 import matplotlib
 
@@ -10,18 +12,29 @@ from utils import read_cpu_speed
 
 matplotlib.use('Agg')
 
-from kernel_traces.trace_parser import Event
+from kernel_traces.event_pairs import EventMatch, PairSpec
+from kernel_traces.online_stats import LogLinearHistogram, OnlineStats
+from kernel_traces.trace_parser import Event, TraceFilter
 
 
 class Stats:
-    def __init__(self, name):
+    def __init__(self, name, online=False):
+        """
+        :param online: keep running statistics (constant memory, estimated median) instead of every measured interval
+        """
         self.name = name
+        self.online = online
         self._events = list()
         self._delta_time = list()
         self._last_batch_time = list()
         self._last_batch_events = list()
+        self._online = OnlineStats() if self.online else None
+        # tail latencies in O(n), in both modes
+        self._histogram = LogLinearHistogram()
 
     def __len__(self):
+        if self._online is not None:
+            return self._online.count
         return len(self._delta_time)
 
     def __lt__(self, other):
@@ -35,21 +48,27 @@ class Stats:
         #     *self.get_stats(True),
         # )
         try:
-            longest_idx = max(enumerate(self._delta_time), key=operator.itemgetter(1))[0]
-            events = self._events[longest_idx][0].timestamp, self._events[longest_idx][1].timestamp,
-        except (IndexError, ValueError):
+            if self._online is not None:
+                longest = self._online.max_events
+            else:
+                longest_idx = max(enumerate(self._delta_time), key=operator.itemgetter(1))[0]
+                longest = self._events[longest_idx]
+            events = longest[0].timestamp, longest[1].timestamp,
+        except (IndexError, ValueError, TypeError):
             events = (0, 0)
-        return "{:<31}: {:<6} cycles {:>11.2f} {:>11.2f} {:>11.2f} {:>11.2f} usec: {:>7.2f} {:>7.2f} {:>7.2f} {:>7.2f} longest: {}\\|{}".format(
+        return "{:<31}: {:<6} cycles {:>11.2f} {:>11.2f} {:>11.2f} {:>11.2f} usec: {:>7.2f} {:>7.2f} {:>7.2f} {:>7.2f} tail: {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} longest: {}\\|{}".format(
             self.name,
             len(self),
             *self.get_stats(False),
             *self.get_stats(True),
+            *self.get_tail_stats(),
             *events
         )
 
     def get_header(self):
-        return "{:<31}: {:<6} cycles {:>11} {:>11} {:>11} {:>11} usec: {:>7} {:>7} {:>7} {:>7}".format(
-            "Event Name", "Count", "min", "max", "avg", "mean", "min", "max", "avg", "mean"
+        return "{:<31}: {:<6} cycles {:>11} {:>11} {:>11} {:>11} usec: {:>7} {:>7} {:>7} {:>7} tail: {:>9} {:>9} {:>9} {:>9}".format(
+            "Event Name", "Count", "min", "max", "avg", "mean", "min", "max", "avg", "mean",
+            "p90", "p99", "p99.9", "max"
         )
 
     def count_event(self, event_start, event_end):
@@ -74,8 +93,14 @@ class Stats:
         self._last_batch_time.append(delta_time)
 
     def finish_batch(self):
-        self._events += self._last_batch_events
-        self._delta_time += self._last_batch_time
+        for delta_time in self._last_batch_time:
+            self._histogram.add(delta_time)
+        if self._online is not None:
+            for events, delta_time in zip(self._last_batch_events, self._last_batch_time):
+                self._online.add(delta_time, events)
+        else:
+            self._events += self._last_batch_events
+            self._delta_time += self._last_batch_time
         self._last_batch_events = list()
         self._last_batch_time = list()
         self.reset_batch()
@@ -86,6 +111,8 @@ class Stats:
 
     @property
     def min(self):
+        if self._online is not None:
+            return self._online.min if self._online.count else 0
         try:
             return min(self._delta_time)
         except ValueError:
@@ -93,6 +120,8 @@ class Stats:
 
     @property
     def max(self):
+        if self._online is not None:
+            return self._online.max if self._online.count else 0
         try:
             return max(self._delta_time)
         except ValueError:
@@ -100,6 +129,8 @@ class Stats:
 
     @property
     def avg(self):
+        if self._online is not None:
+            return self._online.mean
         try:
             return mean(self._delta_time)
         except ValueError:
@@ -107,11 +138,44 @@ class Stats:
 
     @property
     def median(self):
+        if self._online is not None:
+            return self._online.quantile(0.5)
         try:
             return median(self._delta_time)
         except ValueError:
             return 0
 
+    @property
+    def std(self):
+        if self._online is not None:
+            return self._online.variance ** 0.5
+        try:
+            return pstdev(self._delta_time)
+        except ValueError:
+            return 0
+
+    def percentile(self, percent):
+        """
+        Estimated from the log-linear histogram (relative error below 1%)
+        """
+        return self._histogram.quantile(percent / 100)
+
+    @property
+    def p90(self):
+        return self.percentile(90)
+
+    @property
+    def p99(self):
+        return self.percentile(99)
+
+    @property
+    def p999(self):
+        return self.percentile(99.9)
+
+    @property
+    def histogram(self):
+        return self._histogram
+
     @property
     def time_min(self):
         return self.min / read_cpu_speed()
@@ -128,6 +192,18 @@ class Stats:
     def time_median(self):
         return self.median / read_cpu_speed()
 
+    @property
+    def time_p90(self):
+        return self.p90 / read_cpu_speed()
+
+    @property
+    def time_p99(self):
+        return self.p99 / read_cpu_speed()
+
+    @property
+    def time_p999(self):
+        return self.p999 / read_cpu_speed()
+
     def get_stats(self, use_time=True):
         min_val = self.min
         max_val = self.max
@@ -140,42 +216,118 @@ class Stats:
             return tuple(v / cpu_speed for v in
                          (float(min_val), float(max_val), float(avg_val), float(median_val)))
 
+    def get_tail_stats(self, use_time=True):
+        values = (float(self.p90), float(self.p99), float(self.p999), float(self.max))
+        if not use_time:
+            return values
+        cpu_speed = read_cpu_speed()
+        return tuple(v / cpu_speed for v in values)
+
 
 class StatsCounter(Stats):
     def count_counter(self, counter):
-        self._delta_time.append(counter)
+        self._histogram.add(counter)
+        if self._online is not None:
+            self._online.add(counter)
+        else:
+            self._delta_time.append(counter)
 
     def get_stats(self, use_time=True):
         return super().get_stats(False)
 
+    def get_tail_stats(self, use_time=True):
+        return super().get_tail_stats(False)
+
 
 class ParseEvents:
+    # names of the events the parser handles, None for every event
+    EVENTS = None
+    # source of the events the parser handles (Event.EVENT_SOURCE_*), None for both
+    SOURCE = None
+
     def handle_event(self, event):
         raise NotImplementedError()
 
+    def handles(self, source, event_name):
+        """
+        Used by MainStats to dispatch only the relevant events to the parser
+        """
+        return ((self.SOURCE is None or self.SOURCE == source) and
+                (self.EVENTS is None or event_name in self.EVENTS))
+
 
-class SendRecvStats(Stats, ParseEvents):
-    def __init__(self):
-        super().__init__("guest_sendrecv_netperf")
-        self._last_send = None
+class PairStats(Stats, ParseEvents):
+    """
+    Stats of the intervals of a PairSpec, see kernel_traces.event_pairs
+    """
+    def __init__(self, spec, online=False):
+        super().__init__(spec.name, online)
+        self.spec = spec
+        self._event_names = spec.events
+        self._last_event = dict()  # key -> remembered start
+
+    def handles(self, source, event_name):
+        return ((self.spec.source is None or self.spec.source == source) and
+                (self._event_names is None or event_name in self._event_names))
 
     def handle_event(self, event):
-        if event.event == "sys_sendto" and "netperf" in event.procname:
-            self._last_send = event
-        elif event.event == "sys_recvfrom" and "netperf" in event.procname \
-                and self._last_send:
-            self.count_event(self._last_send, event)
+        spec = self.spec
+        if not spec.accepts(event):
+            return
 
-            self._last_send = None
+        if spec.start(event):
+            self._last_event[spec.event_key(event)] = event
+        elif spec.end(event):
+            last_event = self._last_event.pop(spec.event_key(event), None)
+            if last_event:
+                self.count_event(last_event, event)
+        elif spec.reset is not None and spec.reset(event):
+            self._last_event.pop(spec.event_key(event), None)
+
+
+# one line per measured interval, MainStats.PAIR_SPECS adds general ones
+SEND_RECV = PairSpec("guest_sendrecv_netperf",
+                     EventMatch("sys_sendto", procname="netperf"), EventMatch("sys_recvfrom", procname="netperf"))
+HOST_NETSERVER = PairSpec("host_netserver",
+                          EventMatch("sched_switch", info_contains=("next_comm=netserver",)),
+                          EventMatch("sched_switch", info_contains=("prev_comm=netserver",)),
+                          source=Event.EVENT_SOURCE_HOST)
+GUEST_NETPERF = PairSpec("guest_netperf",
+                         EventMatch("sched_switch", info_contains=("next_comm=netperf",)),
+                         EventMatch("sched_switch", info_contains=("prev_comm=netperf",)),
+                         source=Event.EVENT_SOURCE_GUEST)
+# from a context switch to the next host event
+HOST_SCHED_OVERHEAD = PairSpec("host_sched_overhead",
+                               EventMatch("sched_switch"), EventMatch(),
+                               source=Event.EVENT_SOURCE_HOST)
+GUEST_XMIT = PairSpec("guest_xmit",
+                      EventMatch("net_dev_start_xmit"), EventMatch("net_dev_xmit"),
+                      source=Event.EVENT_SOURCE_GUEST)
+# read of fd 11 (the tap device), other reads forget the start
+HOST_READ_PACKETS = PairSpec("host_read_packets",
+                             EventMatch("sys_read", info_contains=("fd: 11",), info_excludes=("->",)),
+                             EventMatch("sys_read", info_contains=("->",)),
+                             source=Event.EVENT_SOURCE_HOST,
+                             reset=EventMatch("sys_read"))
+GUEST_INTERRUPT_HANDLER = PairSpec("guest_interrupt_handler",
+                                   EventMatch("irq_handler_entry", info_contains=("virtio", "eth")),
+                                   EventMatch("irq_handler_exit"),
+                                   source=Event.EVENT_SOURCE_GUEST)
+# KVM_IRQFD / KVM_IRQ_LINE ioctl, any other ioctl closes it
+HOST_IOCTL_INTERRUPT = PairSpec("host_ioctl_interrupt",
+                                EventMatch("sys_ioctl", info_contains=("cmd: 4020aea5", "cmd: ffffffffc008ae67"),
+                                           info_excludes=("->",)),
+                                EventMatch("sys_ioctl"),
+                                source=Event.EVENT_SOURCE_HOST)
 
 
 class BatchStats(Stats, ParseEvents):
-    def __init__(self):
-        super().__init__("total_batch_time")
+    def __init__(self, online=False):
+        super().__init__("total_batch_time", online)
         self._last_event = None
         self._ignore_halt = False
         self._current_event_num = 0
-        self.batch_event_stats = StatsCounter("events_per_batch")
+        self.batch_event_stats = StatsCounter("events_per_batch", online)
 
     def handle_event(self, event):
         self._current_event_num += 1
@@ -204,86 +356,15 @@ class BatchStats(Stats, ParseEvents):
         self.batch_event_stats.reset_batch()
 
 
-class SchedNetserver(Stats, ParseEvents):
-    def __init__(self):
-        super().__init__("host_netserver")
-        self._last_event = None
-
-    def handle_event(self, event):
-        if event.source != event.EVENT_SOURCE_HOST:
-            return
-
-        if event.event == "sched_switch":
-            if "next_comm=netserver" in event.info:
-                self._last_event = event
-            elif "prev_comm=netserver" in event.info:
-                if self._last_event:
-                    self.count_event(self._last_event, event)
-
-                self._last_event = None
-
-
-class SchedNetperf(Stats, ParseEvents):
-    def __init__(self):
-        super().__init__("guest_netperf")
-        self._last_event = None
-
-    def handle_event(self, event):
-        if event.source != event.EVENT_SOURCE_GUEST:
-            return
-
-        if event.event == "sched_switch":
-            if "next_comm=netperf" in event.info:
-                self._last_event = event
-            elif "prev_comm=netperf" in event.info:
-                if self._last_event:
-                    self.count_event(self._last_event, event)
-
-                self._last_event = None
-
-
-class SchedStats(Stats, ParseEvents):
-    def __init__(self):
-        super().__init__("host_sched_overhead")
-        self._last_event = None
-
-    def handle_event(self, event):
-        if event.source != event.EVENT_SOURCE_HOST:
-            return
-
-        if event.event == "sched_switch":
-            self._last_event = event
-        else:
-            if self._last_event:
-                self.count_event(self._last_event, event)
-
-            self._last_event = None
-
-
-class NetDevXmitStats(Stats, ParseEvents):
-    def __init__(self):
-        super().__init__("guest_xmit")
-        self._last_event = None
-
-    def handle_event(self, event):
-        if event.source != event.EVENT_SOURCE_GUEST:
-            return
-
-        if event.event == "net_dev_start_xmit":
-            self._last_event = event
-        elif event.event == "net_dev_xmit":
-            if self._last_event:
-                self.count_event(self._last_event, event)
-
-            self._last_event = None
-
-
 class SyswritevStats(Stats, ParseEvents):
-    def __init__(self):
-        super().__init__("host_writev")
+    EVENTS = ("sys_writev",)
+    SOURCE = Event.EVENT_SOURCE_HOST
+
+    def __init__(self, online=False):
+        super().__init__("host_writev", online)
         self._last_event = None
-        self.writev_size = StatsCounter("writev_size")
-        self.writev_vlen = StatsCounter("writev_vlen")
+        self.writev_size = StatsCounter("writev_size", online)
+        self.writev_vlen = StatsCounter("writev_vlen", online)
 
     def handle_event(self, event):
         if event.source != event.EVENT_SOURCE_HOST:
@@ -306,32 +387,11 @@ class SyswritevStats(Stats, ParseEvents):
                 self.writev_size.count_counter(length)
 
 
-class SysreadStats(Stats, ParseEvents):
-    def __init__(self):
-        super().__init__("host_read_packets")
-        self._last_event = None
-
-    def handle_event(self, event):
-        if event.source != event.EVENT_SOURCE_HOST:
-            return
-
-        if event.event == "sys_read":
-            if "->" not in event.info and "fd: 11" in event.info:
-                self._last_event = event
-            else:
-                if "->" in event.info:
-                    if self._last_event:
-                        self.count_event(self._last_event, event)
-
-                    self._last_event = None
-                else:
-                    # not fd 11
-                    self._last_event = None
-
-
 class SysreadDeltaStats(Stats, ParseEvents):
-    def __init__(self):
-        super().__init__("host_delta_read")
+    SOURCE = Event.EVENT_SOURCE_HOST  # every host event resets the saved events
+
+    def __init__(self, online=False):
+        super().__init__("host_delta_read", online)
         self._last_read_start = None
         self._last_read_end = None
 
@@ -361,8 +421,10 @@ class SysreadDeltaStats(Stats, ParseEvents):
 
 
 class SyswritevDeltaStats(Stats, ParseEvents):
-    def __init__(self):
-        super().__init__("host_delta_writev")
+    SOURCE = Event.EVENT_SOURCE_HOST  # every host event resets the saved events
+
+    def __init__(self, online=False):
+        super().__init__("host_delta_writev", online)
         self._last_read_start = None
         self._last_read_end = None
 
@@ -391,38 +453,20 @@ class SyswritevDeltaStats(Stats, ParseEvents):
             self._last_read_start = None
 
 
-class InterruptStats(Stats, ParseEvents):
-    def __init__(self):
-        super().__init__("guest_interrupt_handler")
-        self._last_event = None
-
-    def handle_event(self, event):
-        if event.source != event.EVENT_SOURCE_GUEST:
-            return
-
-        if event.event == "irq_handler_entry" and (
-                "virtio" in event.info
-                or "eth" in event.info
-        ):
-            self._last_event = event
-        elif event.event == "irq_handler_exit":
-            if self._last_event:
-                self.count_event(self._last_event, event)
-
-            self._last_event = None
-
-
 class ExitStats(ParseEvents):
-    def __init__(self):
+    EVENTS = (Event.EVENT_KVM_EXIT, Event.EVENT_KVM_ENTRY)
+
+    def __init__(self, online=False):
+        self.online = online
         self._results = dict()
         self._last_exit = None
 
     def __getitem__(self, item):
-        return self._results.get(item, Stats(item))
+        return self._results.get(item, Stats(item, self.online))
 
     def count_event(self, name, start, end):
         if name not in self._results:
-            self._results[name] = Stats(name)
+            self._results[name] = Stats(name, self.online)
         self._results[name].count_event(start, end)
 
     def finish_batch(self):
@@ -452,8 +496,10 @@ class ExitStats(ParseEvents):
 class HWExitStats(ParseEvents):
     HW_EXIT = "HW_exit"
     HW_ENRTY = "HW_entry"
+    EVENTS = ("net_exit_before", Event.EVENT_KVM_EXIT, Event.EVENT_KVM_ENTRY, "net_exit_after")
 
-    def __init__(self):
+    def __init__(self, online=False):
+        self.online = online
         self._results = dict()
 
         self._last_pre_exit = None
@@ -463,11 +509,11 @@ class HWExitStats(ParseEvents):
         self._last_post_entry = None
 
     def __getitem__(self, item):
-        return self._results.get(item, Stats(item))
+        return self._results.get(item, Stats(item, self.online))
 
     def count_event(self, name, start, end):
         if name not in self._results:
-            self._results[name] = Stats(name)
+            self._results[name] = Stats(name, self.online)
         self._results[name].count_event(start, end)
 
     def finish_batch(self):
@@ -512,30 +558,12 @@ class HWExitStats(ParseEvents):
         return self._results
 
 
-class InterruptIoctlStats(Stats, ParseEvents):
-    def __init__(self):
-        super().__init__("host_ioctl_interrupt")
-        self._last_event = None
-
-    def handle_event(self, event):
-        if event.source != event.EVENT_SOURCE_HOST:
-            return
-
-        if event.event == "sys_ioctl":
-            if "->" not in event.info and (
-                    "cmd: 4020aea5" in event.info
-                    or "cmd: ffffffffc008ae67" in event.info):
-                self._last_event = event
-            else:
-                if self._last_event:
-                    self.count_event(self._last_event, event)
-
-                self._last_event = None
-
-
 class RecvStats(Stats, ParseEvents):
-    def __init__(self):
-        super().__init__("guest_recv_func")
+    EVENTS = ("net_dev_recv_start", "napi_receive_start", "napi_receive_end", "net_dev_recv_end")
+    SOURCE = Event.EVENT_SOURCE_GUEST
+
+    def __init__(self, online=False):
+        super().__init__("guest_recv_func", online)
         self._last_event = list()
 
     def handle_event(self, event):
@@ -560,15 +588,18 @@ class RecvStats(Stats, ParseEvents):
 
 
 class WritevDeep(ParseEvents):
-    def __init__(self):
+    EVENTS = ("sys_writev", "import_iovec", "import_iovec_end", "tun_get_user", "tun_get_user_end",
+              "netif_receive_skb", "netif_receive_skb_end")
+
+    def __init__(self, online=False):
 
-        self.writev_size = StatsCounter("writev_size")
-        self.writev_vlen = StatsCounter("writev_vlen")
+        self.writev_size = StatsCounter("writev_size", online)
+        self.writev_vlen = StatsCounter("writev_vlen", online)
 
-        self.writev_import_iovec = Stats("writev_import_iovec")
-        self.writev_tun_get_user = Stats("writev_tun_get_user")
-        self.writev_receive_skb = Stats("writev_receive_skb")
-        self.writev_stat = Stats("writev")
+        self.writev_import_iovec = Stats("writev_import_iovec", online)
+        self.writev_tun_get_user = Stats("writev_tun_get_user", online)
+        self.writev_receive_skb = Stats("writev_receive_skb", online)
+        self.writev_stat = Stats("writev", online)
 
         self._last_writev = None
         self._last_import_iovec = None
@@ -636,15 +667,21 @@ class WritevDeep(ParseEvents):
 
 
 class TraceFunctionStats(Stats, ParseEvents):
-    def __init__(self, func1, func2=None, source=Event.EVENT_SOURCE_GUEST, name=None):
+    def __init__(self, func1, func2=None, source=Event.EVENT_SOURCE_GUEST, name=None, online=False):
         self._name1 = func1
         self._name2 = func2
         self._source = source
         self._last_event = None
         if name is None:
             name = "{}_{}-{}".format(source, func1, func2)
-        super().__init__(name)
+        super().__init__(name, online)
         self._last_event = list()
+        self._event_names = {func1, func1 + "_end"}
+        if func2:
+            self._event_names.update((func2, func2 + "_end"))
+
+    def handles(self, source, event_name):
+        return (not self._source or source == self._source) and event_name in self._event_names
 
     def handle_event(self, event):
         if self._source and event.source != self._source:
@@ -665,48 +702,71 @@ class TraceFunctionStats(Stats, ParseEvents):
 
 class MainStats:
     ATTR = "time_avg"
-
-    def __init__(self, traces, output_dir, size=None):
+    # additional intervals to measure, e.g. a kprobe pair:
+    # PairSpec("guest_napi_poll", EventMatch("napi_poll"), EventMatch("napi_poll_end"), Event.EVENT_SOURCE_GUEST)
+    PAIR_SPECS = ()
+    # filter_events() pushed down to the trace parsing, see Traces(filters=...)
+    TRACE_FILTERS = (TraceFilter(cpus=(2,), source=Event.EVENT_SOURCE_HOST),)
+
+    def __init__(self, traces, output_dir, size=None, event_costs=None, online=False):
+        """
+        :param event_costs: dict of (source, event name) -> estimated tracing cost (cycles), the measured times are
+        corrected by the cost of the events they include, see kernel_traces.overhead
+        :param online: constant memory statistics (estimated median), see Stats
+        """
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.DEBUG)
 
         self._traces = traces
         self._dir = output_dir
         self._size = size
-
-        self._events = tuple(self._traces.get_test_events())
+        self._event_costs = event_costs
+
+        self._store = None  # the filtered test events, when the traces are only in a store
+        self._invalid = None  # is_event_invalid() of the events of self._store
+        if self._traces.store_only:
+            # filter_events() and is_event_invalid() over the columns, only the kept events are created
+            store = self._traces.get_window(*self._traces.test_window())
+            self._store = store.take(self.filter_events_mask(store).nonzero()[0])
+            self._invalid = self.is_event_invalid_mask(self._store)
+            self._events = None if self._traces.stream else tuple(self._store.iter_events())
+        elif self._traces.stream:
+            # events are read (and translated) from the trace files while parsing
+            self._events = None
+        else:
+            self._events = tuple(self._traces.get_test_events())
 
         self.translate_events()
 
         # parsers
-        self._parse_send_recv = SendRecvStats()
-        self._parse_batch = BatchStats()
-
-        self._parse_exits = ExitStats()
-        self._parse_hw_exits = HWExitStats()
-        self._parse_sched = SchedStats()
-        self._parse_xmit = NetDevXmitStats()
-        self._parse_writev = SyswritevStats()
-        self._parse_read = SysreadStats()
-        self._parse_ioctl_interrupt = InterruptIoctlStats()
-        self._parse_interrupt = InterruptStats()
-        self._parse_recv = RecvStats()
-        self._parse_netserver = SchedNetserver()
-        self._parse_netperf = SchedNetperf()
-
-        self._parse_delta_read = SysreadDeltaStats()
-        self._parse_delta_writev = SyswritevDeltaStats()
-
-        self._writev_deep = WritevDeep()
-        self._parse_guest_recv_checksum = TraceFunctionStats("dev_gro_receive", name="guest_recv_checksum")
-        self._parse_guest_tcp_stack = TraceFunctionStats("netif_receive_skb_internal", "dev_hard_start_xmit", Event.EVENT_SOURCE_GUEST, name="Guest TCP stack")
-
-        self._parse_guest_tcp = TraceFunctionStats("netif_receive_skb_internal", "ip_rcv_finish", name="guest_tcp_func")
-        self._parse_guest_tcp1 = TraceFunctionStats("ip_rcv_finish", "tcp_v4_rcv", name="guest_tcp_func1")
-        self._parse_guest_tcp1_2 = TraceFunctionStats("tcp_v4_rcv", "tcp_write_xmit", name="guest_tcp_func1_2")
-        self._parse_guest_tcp2 = TraceFunctionStats("tcp_write_xmit", "dev_queue_xmit", name="guest_tcp_func2")
-        self._parse_guest_tcp3 = TraceFunctionStats("dev_queue_xmit", "dev_hard_start_xmit", name="guest_tcp_func3")
-        self._parse_guest_tcp_ack = TraceFunctionStats("tcp_ack", name="guest_tcp_ack")
+        self._parse_send_recv = PairStats(SEND_RECV, online)
+        self._parse_batch = BatchStats(online)
+
+        self._parse_exits = ExitStats(online)
+        self._parse_hw_exits = HWExitStats(online)
+        self._parse_sched = PairStats(HOST_SCHED_OVERHEAD, online)
+        self._parse_xmit = PairStats(GUEST_XMIT, online)
+        self._parse_writev = SyswritevStats(online)
+        self._parse_read = PairStats(HOST_READ_PACKETS, online)
+        self._parse_ioctl_interrupt = PairStats(HOST_IOCTL_INTERRUPT, online)
+        self._parse_interrupt = PairStats(GUEST_INTERRUPT_HANDLER, online)
+        self._parse_recv = RecvStats(online)
+        self._parse_netserver = PairStats(HOST_NETSERVER, online)
+        self._parse_netperf = PairStats(GUEST_NETPERF, online)
+
+        self._parse_delta_read = SysreadDeltaStats(online)
+        self._parse_delta_writev = SyswritevDeltaStats(online)
+
+        self._writev_deep = WritevDeep(online)
+        self._parse_guest_recv_checksum = TraceFunctionStats("dev_gro_receive", name="guest_recv_checksum", online=online)
+        self._parse_guest_tcp_stack = TraceFunctionStats("netif_receive_skb_internal", "dev_hard_start_xmit", Event.EVENT_SOURCE_GUEST, name="Guest TCP stack", online=online)
+
+        self._parse_guest_tcp = TraceFunctionStats("netif_receive_skb_internal", "ip_rcv_finish", name="guest_tcp_func", online=online)
+        self._parse_guest_tcp1 = TraceFunctionStats("ip_rcv_finish", "tcp_v4_rcv", name="guest_tcp_func1", online=online)
+        self._parse_guest_tcp1_2 = TraceFunctionStats("tcp_v4_rcv", "tcp_write_xmit", name="guest_tcp_func1_2", online=online)
+        self._parse_guest_tcp2 = TraceFunctionStats("tcp_write_xmit", "dev_queue_xmit", name="guest_tcp_func2", online=online)
+        self._parse_guest_tcp3 = TraceFunctionStats("dev_queue_xmit", "dev_hard_start_xmit", name="guest_tcp_func3", online=online)
+        self._parse_guest_tcp_ack = TraceFunctionStats("tcp_ack", name="guest_tcp_ack", online=online)
 
         self._general_parsers = [
             self._parse_sched,
@@ -731,15 +791,16 @@ class MainStats:
             self._parse_guest_tcp2,
             self._parse_guest_tcp3,
             self._parse_guest_tcp_ack,
-            TraceFunctionStats("tcp_v4_rcv", "tcp_v4_do_rcv", Event.EVENT_SOURCE_GUEST),
-            TraceFunctionStats("tcp_v4_do_rcv", "tcp_rcv_established", Event.EVENT_SOURCE_GUEST),
-            TraceFunctionStats("tcp_rcv_established", "__tcp_push_pending_frames", Event.EVENT_SOURCE_GUEST),
-            TraceFunctionStats("__tcp_push_pending_frames", "tcp_write_xmit", Event.EVENT_SOURCE_GUEST),
+            TraceFunctionStats("tcp_v4_rcv", "tcp_v4_do_rcv", Event.EVENT_SOURCE_GUEST, online=online),
+            TraceFunctionStats("tcp_v4_do_rcv", "tcp_rcv_established", Event.EVENT_SOURCE_GUEST, online=online),
+            TraceFunctionStats("tcp_rcv_established", "__tcp_push_pending_frames", Event.EVENT_SOURCE_GUEST, online=online),
+            TraceFunctionStats("__tcp_push_pending_frames", "tcp_write_xmit", Event.EVENT_SOURCE_GUEST, online=online),
             # TraceFunctionStats("tcp_write_xmit", Event.EVENT_SOURCE_GUEST),
 
-        ]
+        ] + [PairStats(spec, online) for spec in self.PAIR_SPECS]
 
         self.attr = self.ATTR
+        self._dispatch = dict()  # (source, event name) -> parsers, see get_handlers()
 
     TYP_E1000 = "E1000"
     TYP_VIRTIO = "VIRTIO"
@@ -758,6 +819,9 @@ class MainStats:
         # self.output_writev_deep_csv()
 
     def translate_events(self):
+        if self._events is None:
+            return
+
         last_exit = None
         for e in self._events:
             if e.event == Event.EVENT_KVM_EXIT:
@@ -767,6 +831,69 @@ class MainStats:
             elif e.event == Event.EVENT_KVM_MSR and last_exit:
                 last_exit.note = e
 
+    @staticmethod
+    def iter_translated_events(events):
+        """
+        Same as translate_events, for a stream of events.
+        Events are held back from a kvm_exit until the next kvm_exit, so the exit note is final when it is handled
+        """
+        pending = list()
+        for e in events:
+            if e.event == Event.EVENT_KVM_EXIT:
+                yield from pending
+                pending = [e]
+                continue
+
+            if pending:
+                if e.event in (Event.EVENT_KVM_MMIO, Event.EVENT_KVM_MSR):
+                    pending[0].note = e
+                pending.append(e)
+            else:
+                yield e
+        yield from pending
+
+    def iter_events(self):
+        if self._events is not None:
+            return iter(self._events)
+        if self._store is not None:
+            return self.iter_translated_events(self._store.iter_events())
+        return self.iter_translated_events(self._traces.iter_test_events())
+
+    def iter_checked_events(self):
+        """
+        :return: iterator of (event, is_event_invalid(event)) over the events passing filter_events()
+        """
+        if self._invalid is not None:
+            # already filtered and checked over the store
+            return zip(self.iter_events(), self._invalid.tolist())
+        return ((e, self.is_event_invalid(e)) for e in self.iter_events() if self.filter_events(e))
+
+    def count_events(self):
+        """
+        :return: Counter of (source, event name) of the events the statistics look at
+        """
+        return Counter((e.source, e.event) for e, _ in self.iter_checked_events())
+
+    def iter_corrected_events(self, checked_events):
+        """
+        Copies of the events on a timeline without the tracing cost: every event is moved back by the cost of the
+        events before it. The filtered events share a single timeline (the guest runs on the traced host cpu), so an
+        interval loses the cost of its start event and of the events inside it.
+        An event costs at most the time to the next event, the events keep their order.
+        :param checked_events: iterator of (event, invalid), see iter_checked_events()
+        """
+        total_cost = 0
+        last_timestamp = None
+        for e, invalid in checked_events:
+            corrected = copy.copy(e)
+            corrected.timestamp = e.timestamp - round(total_cost)
+            if last_timestamp is not None and corrected.timestamp < last_timestamp:
+                total_cost -= last_timestamp - corrected.timestamp
+                corrected.timestamp = last_timestamp
+            last_timestamp = corrected.timestamp
+            total_cost += self._event_costs.get((e.source, e.event), 0)
+            yield corrected, invalid
+
     def filter_events(self, event):
         return event.source == event.EVENT_SOURCE_GUEST or \
                (event.source == event.EVENT_SOURCE_HOST and
@@ -782,36 +909,70 @@ class MainStats:
             (event.source == event.EVENT_SOURCE_HOST and event.event == "irq_handler_exit")
         )
 
+    def filter_events_mask(self, store):
+        """
+        Vectorized filter_events over an EventStore
+        """
+        return store.mask_source(Event.EVENT_SOURCE_GUEST) | \
+               (store.mask_source(Event.EVENT_SOURCE_HOST) & store.mask_cpu(2))
+
+    def is_event_invalid_mask(self, store):
+        """
+        Vectorized is_event_invalid over an EventStore, the info of the kvm_exit events is checked as it is
+        """
+        is_exit = store.mask_event("kvm_exit")
+        is_host = store.mask_source(Event.EVENT_SOURCE_HOST)
+        return (
+            store.mask_event("sys_fdatasync") |
+            store.mask_info(lambda info: "EXTERNAL_INTERRUPT" in info or "PREEMPTION_TIMER" in info, mask=is_exit) |
+            store.mask_event("local_timer_entry", "local_timer_exit") |
+            (is_host & store.mask_event("irq_handler_entry", "irq_handler_exit"))
+        )
+
+    def get_handlers(self, source, event_name):
+        """
+        Parsers handling the events of source and event_name (see ParseEvents.handles), the batch parser is
+        handled separately. The dispatch table is filled on demand, parse_events() resets it.
+        """
+        key = (source, event_name)
+        try:
+            return self._dispatch[key]
+        except KeyError:
+            parsers = [self._parse_exits, self._parse_hw_exits, self._parse_send_recv] + self._general_parsers
+            handlers = tuple(p for p in parsers if p.handles(source, event_name))
+            self._dispatch[key] = handlers
+            return handlers
+
     def parse_events(self):
         is_batch_invalid = False
         skiped_batches = 0
-        for e in self._events:
-            if self.filter_events(e):
-                is_batch_invalid = is_batch_invalid or self.is_event_invalid(e)
-                self._parse_exits.handle_event(e)
-                self._parse_hw_exits.handle_event(e)
-                self._parse_send_recv.handle_event(e)
-                is_new_batch = self._parse_batch.handle_event(e)
-                for p in self._general_parsers:
-                    p.handle_event(e)
-
-                if is_new_batch:
-                    if not is_batch_invalid:
-                        for parser in self._general_parsers:
-                            parser.finish_batch()
-                        self._parse_exits.finish_batch()
-                        self._parse_hw_exits.finish_batch()
-                        self._parse_send_recv.finish_batch()
-                        self._parse_batch.finish_batch()
-                    else:
-                        for parser in self._general_parsers:
-                            parser.reset_batch()
-                        self._parse_exits.reset_batch()
-                        self._parse_hw_exits.reset_batch()
-                        self._parse_send_recv.reset_batch()
-                        self._parse_batch.reset_batch()
-                        skiped_batches += 1
-                    is_batch_invalid = False
+        self._dispatch = dict()
+        events = self.iter_checked_events()
+        if self._event_costs is not None:
+            events = self.iter_corrected_events(events)
+        for e, invalid in events:
+            is_batch_invalid = is_batch_invalid or invalid
+            is_new_batch = self._parse_batch.handle_event(e)
+            for p in self.get_handlers(e.source, e.event):
+                p.handle_event(e)
+
+            if is_new_batch:
+                if not is_batch_invalid:
+                    for parser in self._general_parsers:
+                        parser.finish_batch()
+                    self._parse_exits.finish_batch()
+                    self._parse_hw_exits.finish_batch()
+                    self._parse_send_recv.finish_batch()
+                    self._parse_batch.finish_batch()
+                else:
+                    for parser in self._general_parsers:
+                        parser.reset_batch()
+                    self._parse_exits.reset_batch()
+                    self._parse_hw_exits.reset_batch()
+                    self._parse_send_recv.reset_batch()
+                    self._parse_batch.reset_batch()
+                    skiped_batches += 1
+                is_batch_invalid = False
         self.logger.warning("Skip %d batches", skiped_batches)
         print("Skip %d batches" % (skiped_batches, ))
 
@@ -843,7 +1004,7 @@ class MainStats:
                 f.write("\n")
         print("finish")
 
-    def _output_row(self, csv_writer, name, count, value, count_normalize=True, multiply=True):
+    def _output_row(self, csv_writer, name, count, value, count_normalize=True, multiply=True, tail=()):
         if isinstance(count, Stats):
             count = len(count)
 
@@ -855,7 +1016,7 @@ class MainStats:
         else:
             final = value
 
-        csv_writer.writerow([name, count, value, final])
+        csv_writer.writerow([name, count, value, final, *tail])
 
     def _output_single_row(self, csv_writer, stat, name=None, count=None, count_normalize=True, multiply=True, attr=None):
         if name is None:
@@ -866,7 +1027,8 @@ class MainStats:
         if attr is None:
             attr = self.attr
 
-        self._output_row(csv_writer, name, count, getattr(stat, attr), count_normalize=count_normalize, multiply=multiply)
+        self._output_row(csv_writer, name, count, getattr(stat, attr), count_normalize=count_normalize, multiply=multiply,
+                         tail=stat.get_tail_stats(attr.startswith("time_")))
 
     def _output_compute_row(self, csv_writer,
                             func, args, name=None, count=1, count_normalize=True):
@@ -893,7 +1055,7 @@ class MainStats:
             writer = csv.writer(f)
             writer.writerow(["using %s" % (self.attr,), "msg size:", self._size, self._size])
 
-            writer.writerow(["name", "count per batch", "one", "total"])
+            writer.writerow(["name", "count per batch", "one", "total", "p90", "p99", "p99.9", "max"])
             self._output_single_row(writer, self._parse_hw_exits[self._parse_hw_exits.HW_EXIT], name="exit overhead", count_normalize=False, multiply=False)
             self._output_single_row(writer, self._parse_hw_exits[self._parse_hw_exits.HW_ENRTY], name="entry overhead", count_normalize=False, multiply=False)
             writer.writerow([])
@@ -1062,7 +1224,7 @@ class MainStats:
             writer = csv.writer(f)
             writer.writerow(["using %s" % (self.attr,), "msg size:", self._size, self._size])
 
-            writer.writerow(["name", "count per batch", "one", "total"])
+            writer.writerow(["name", "count per batch", "one", "total", "p90", "p99", "p99.9", "max"])
             self._output_single_row(writer, self._parse_hw_exits[self._parse_hw_exits.HW_EXIT], name="exit overhead", count_normalize=False, multiply=False)
             self._output_single_row(writer, self._parse_hw_exits[self._parse_hw_exits.HW_ENRTY], name="entry overhead", count_normalize=False, multiply=False)
             writer.writerow([])
@@ -0,0 +1,178 @@
+import math
+
+
+class P2Quantile:
+    """
+    Streaming quantile estimation with the P-square algorithm (Jain & Chlamtac), 5 markers, constant memory
+    """
+    def __init__(self, p):
+        self.p = p
+        self._initial = list()
+        self._heights = None
+        self._positions = None
+        self._desired = None
+        self._increments = (0, p / 2, p, (1 + p) / 2, 1)
+
+    def add(self, x):
+        if self._heights is None:
+            self._initial.append(x)
+            if len(self._initial) == 5:
+                self._heights = sorted(self._initial)
+                self._positions = [1, 2, 3, 4, 5]
+                self._desired = [1, 1 + 2 * self.p, 1 + 4 * self.p, 3 + 2 * self.p, 5]
+                self._initial = None
+            return
+
+        q = self._heights
+        n = self._positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        for i in (1, 2, 3):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        q = self._heights
+        n = self._positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def value(self):
+        if self._heights is not None:
+            return self._heights[2]
+        if not self._initial:
+            return 0
+        # exact (interpolated) on the first few values, the same as statistics.median for p=0.5
+        values = sorted(self._initial)
+        pos = self.p * (len(values) - 1)
+        low = math.floor(pos)
+        high = math.ceil(pos)
+        return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+class OnlineStats:
+    """
+    Running count/mean/variance (Welford), min/max with the events of the max, and quantile estimations
+    """
+    QUANTILES = (0.5, 0.99)
+
+    def __init__(self, quantiles=QUANTILES):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = None
+        self.max = None
+        self.max_events = None
+        self._quantiles = {q: P2Quantile(q) for q in quantiles}
+
+    def add(self, value, events=None):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+            self.max_events = events
+
+        for quantile in self._quantiles.values():
+            quantile.add(value)
+
+    @property
+    def variance(self):
+        if self.count < 1:
+            return 0
+        return self._m2 / self.count
+
+    def quantile(self, q):
+        return self._quantiles[q].value()
+
+
+class LogLinearHistogram:
+    """
+    HDR style histogram: exact buckets below 2**SUB_BUCKET_BITS, above that every power of two is split into
+    2**SUB_BUCKET_BITS linear sub buckets, so the relative error of a quantile is at most 2**-SUB_BUCKET_BITS.
+    Values are truncated to integers (cycles), negative values are kept in mirrored buckets.
+    """
+    SUB_BUCKET_BITS = 7
+
+    def __init__(self, sub_bucket_bits=SUB_BUCKET_BITS):
+        self._bits = sub_bucket_bits
+        self._sub_buckets = 1 << sub_bucket_bits
+        self._counts = dict()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _index(self, value):
+        value = int(value)
+        if value < 0:
+            return -self._index(-value) - 1
+        if value < self._sub_buckets:
+            return value
+        shift = value.bit_length() - self._bits - 1
+        return ((shift + 1) << self._bits) + (value >> shift) - self._sub_buckets
+
+    def _bounds(self, index):
+        """
+        :return: (lowest, highest) value of the bucket
+        """
+        if index < 0:
+            low, high = self._bounds(-index - 1)
+            return -high, -low
+        if index < self._sub_buckets:
+            return index, index
+        shift = (index >> self._bits) - 1
+        low = (self._sub_buckets + (index & (self._sub_buckets - 1))) << shift
+        return low, low + (1 << shift) - 1
+
+    def add(self, value, count=1):
+        index = self._index(value)
+        self._counts[index] = self._counts.get(index, 0) + count
+        self.count += count
+
+    def quantile(self, q):
+        """
+        Value at quantile q (0..1), the middle of the bucket holding the ceil(q * count)th value
+        """
+        if not self.count:
+            return 0
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= rank:
+                low, high = self._bounds(index)
+                return (low + high) / 2
+        low, high = self._bounds(max(self._counts))
+        return (low + high) / 2
+
+    def buckets(self):
+        """
+        :return: sorted list of (lowest value, highest value, count)
+        """
+        return [self._bounds(index) + (self._counts[index],) for index in sorted(self._counts)]
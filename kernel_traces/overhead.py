@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+from statistics import mean
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+OVERHEAD_FILE = "overhead.json"
+
+
+def event_key(source, event_name):
+    return "{}/{}".format(source, event_name)
+
+
+# rough cost of an event relative to a tracepoint, by the kind of probe that emits it (see Trace.probes): a kprobe
+# traps (int3), a return probe also goes through a trampoline, a uprobe traps from user space and single steps
+PROBE_WEIGHTS = {
+    "tracepoint": 1,
+    "kprobe": 3,
+    "kretprobe": 5,
+    "uprobe": 15,
+    "uretprobe": 20,
+}
+
+
+def estimate_overhead(traced, untraced, counts, window_cycles, event_costs=None, probes=None):
+    """
+    Estimate the cost of a traced event from the slowdown of the traced run: the traced run did its work in
+    (1 - traced / untraced) less of its time. The known event_costs are kept, the rest of the slowdown is spread over
+    the other events weighted by their probe kind (PROBE_WEIGHTS)
+    :param traced: netperf result of the traced run (throughput or transaction rate, higher is better)
+    :param untraced: netperf results of the same test without tracing
+    :param counts: dict of (source, event name) -> number of events in the window
+    :param window_cycles: duration of the window the events were counted in
+    :param event_costs: dict of event key -> cost (cycles) already known (e.g. refined by hand)
+    :param probes: dict of event key -> probe kind, the events that are not in it are tracepoints
+    :return: dict, see save_overhead()
+    """
+    event_costs = dict(event_costs or {})
+    probes = probes or {}
+    baseline = mean(untraced) if untraced else 0
+    slowdown = 1 - traced / baseline if baseline else 0
+    if slowdown < 0:
+        logger.warning("The traced run (%s) was faster than the runs without tracing (%s), no overhead", traced,
+                       untraced)
+    counts = {event_key(*key): count for key, count in sorted(counts.items())}
+    events = sum(counts.values())
+    event_cost = max(slowdown, 0) * window_cycles / events if events else 0
+
+    missing = [key for key in counts if key not in event_costs]
+    if missing:
+        known_cycles = sum(counts[key] * event_costs[key] for key in counts if key in event_costs)
+        weights = {key: PROBE_WEIGHTS.get(probes.get(key, "tracepoint"), 1) for key in missing}
+        weighted_events = sum(counts[key] * weights[key] for key in missing)
+        unit_cost = max(max(slowdown, 0) * window_cycles - known_cycles, 0) / weighted_events if weighted_events else 0
+        for key in missing:
+            event_costs[key] = unit_cost * weights[key]
+    return {
+        "traced": traced,
+        "untraced": list(untraced),
+        "slowdown": slowdown,
+        "window_cycles": window_cycles,
+        "events": events,
+        "event_rate": events / window_cycles if window_cycles else 0,
+        "event_cost": event_cost,  # average
+        # can be refined by hand: the entries that are kept are not estimated again
+        "event_costs": dict(sorted(event_costs.items())),
+        "probes": dict(sorted(probes.items())),
+        "counts": counts,
+    }
+
+
+def save_overhead(directory, overhead):
+    with open(os.path.join(directory, OVERHEAD_FILE), "w") as f:
+        json.dump(overhead, f, indent=1)
+
+
+def load_overhead(directory):
+    """
+    :return: the saved overhead dict, None when there is none
+    """
+    try:
+        with open(os.path.join(directory, OVERHEAD_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def event_costs(overhead):
+    """
+    :return: dict of (source, event name) -> estimated cost (cycles) of tracing the event
+    """
+    costs = dict()
+    for key, cost in overhead.get("event_costs", {}).items():
+        source, _, event_name = key.partition("/")
+        costs[(source, event_name)] = cost
+    return costs
@@ -0,0 +1,655 @@
+"""
+Decode the binary ftrace ring buffer (per_cpu/cpuN/trace_pipe_raw) into trace_parser.Event objects.
+
+The raw capture directory (see kernel_trace.Trace.read_trace_raw) holds:
+    per_cpu/cpuN    - the raw ring buffer pages of cpu N
+    header_page     - events/header_page, layout of a ring buffer page
+    formats         - all the events/*/*/format descriptors, concatenated
+    saved_cmdlines  - pid -> comm
+"""
+import ast
+import logging
+import multiprocessing
+import os.path
+import re
+import struct
+
+from kernel_traces.trace_parser import Event, TraceFile, TraceMerger, file_fingerprint
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+RAW_SUFFIX = ".raw"
+
+# ring buffer event header: type_len:5, time_delta:27
+TYPE_LEN_PADDING = 29
+TYPE_LEN_TIME_EXTEND = 30
+TYPE_LEN_TIME_STAMP = 31
+TS_SHIFT = 27
+MISSED_EVENTS = 1 << 31
+MISSED_STORED = 1 << 30
+
+# common_flags
+TRACE_FLAG_IRQS_OFF = 0x01
+TRACE_FLAG_IRQS_NOSUPPORT = 0x02
+TRACE_FLAG_NEED_RESCHED = 0x04
+TRACE_FLAG_HARDIRQ = 0x08
+TRACE_FLAG_SOFTIRQ = 0x10
+TRACE_FLAG_PREEMPT_RESCHED = 0x20
+TRACE_FLAG_NMI = 0x40
+
+FIELD_RE = re.compile(r"field:(?P<decl>[^;]*);\s*offset:(?P<offset>\d+);\s*size:(?P<size>\d+);"
+                      r"(?:\s*signed:(?P<signed>\d+);)?")
+STRING_RE = re.compile(r'"(?:\\.|[^"\\])*"')
+PRINTF_RE = re.compile(r"%(?P<flags>[-+ #0]*)(?P<width>\d+)?(?:\.(?P<precision>\d+))?(?P<length>hh|h|ll|l|z|L)?"
+                       r"(?P<conv>p[a-zA-Z]*|[diouxXcs%])")
+CAST_RE = re.compile(r"\(\s*(?:(?:unsigned|signed|const|struct|long|int|short|char|void|bool|size_t|"
+                     r"u8|u16|u32|u64|s8|s16|s32|s64|__u8|__u16|__u32|__u64|__s8|__s16|__s32|__s64)\s*)+\**\s*\)")
+INT_SUFFIX_RE = re.compile(r"\b(0[xX][0-9a-fA-F]+|\d+)[uUlL]+\b")
+DYNAMIC_FIELD_RE = re.compile(r"\b__get_(?:rel_)?(?:str|dynamic_array)\(\s*(\w+)\s*\)")
+TOKEN_RE = re.compile(r'"(?:\\.|[^"\\])*"|[(){}\[\],?:]|[^"(){}\[\],?:]+')
+OPEN_TOKENS = "({["
+CLOSE_TOKENS = ")}]"
+HELPERS = {
+    "__print_symbolic": "_symbolic",
+    "__print_flags": "_flags",
+    "__print_hex": "_hex",
+    "__print_hex_str": "_hex",
+}
+
+
+class Field:
+    def __init__(self, decl, offset, size, signed):
+        self.decl = decl.strip()
+        self.offset = offset
+        self.size = size
+        self.signed = signed
+
+        match = re.match(r"(?P<type>.*?)\s*(?P<name>\w+)\s*(?:\[(?P<length>[^\]]*)\])?$", self.decl)
+        self.name = match.group("name")
+        self.type = match.group("type")
+        self.is_array = match.group("length") is not None
+        self.is_dynamic = self.type.startswith("__data_loc") or self.type.startswith("__rel_loc")
+        self.is_string = "char" in self.type and (self.is_array or self.is_dynamic)
+        self.is_scalar = not (self.is_array or self.is_dynamic) and self.size in (1, 2, 4, 8)
+
+    def value(self, data):
+        if self.is_scalar:
+            return int.from_bytes(data[self.offset:self.offset + self.size], "little", signed=self.signed)
+        if self.is_dynamic:
+            loc = int.from_bytes(data[self.offset:self.offset + 4], "little")
+            start, length = loc & 0xffff, loc >> 16
+            if self.type.startswith("__rel_loc"):
+                start += self.offset + self.size
+            raw = data[start:start + length]
+        elif self.size == 0:
+            # flexible array at the end of the record
+            raw = data[self.offset:]
+        else:
+            raw = data[self.offset:self.offset + self.size]
+
+        if self.is_string:
+            return raw.split(b"\0", 1)[0].decode(errors="replace")
+        return raw
+
+    def __repr__(self):
+        return "Field({!r}, {}, {}, {})".format(self.decl, self.offset, self.size, self.signed)
+
+
+class PrintFormat:
+    """
+    "print fmt" of an event format file, compiled to python.
+    The arguments are C expressions, they are translated to python and checked to use only the record fields
+    and the helper functions (__print_symbolic, __print_flags, ...), anything else is NotImplementedError.
+    """
+    def __init__(self, text):
+        args = _split_args(text)
+        self.fmt = ast.literal_eval(args[0].strip())
+        self.specs = list(PRINTF_RE.finditer(self.fmt))
+        self.args = [_compile_c_expression(arg) for arg in args[1:]]
+
+    def format(self, record):
+        namespace = dict(_NAMESPACE, REC=record)
+        values = iter([eval(arg, namespace) for arg in self.args])
+
+        out = list()
+        pos = 0
+        for spec in self.specs:
+            out.append(self.fmt[pos:spec.start()])
+            pos = spec.end()
+            out.append(_format_value(spec, None if spec.group("conv") == "%" else next(values)))
+        out.append(self.fmt[pos:])
+        return "".join(out)
+
+
+def _split_args(text):
+    """
+    Split on top level commas (outside strings, parentheses and braces)
+    """
+    return ["".join(part) for part in _split_tokens(_tokenize(text), ",")]
+
+
+def _tokenize(text):
+    return TOKEN_RE.findall(text)
+
+
+def _split_tokens(tokens, separator):
+    parts = [[]]
+    depth = 0
+    for token in tokens:
+        if token in OPEN_TOKENS:
+            depth += 1
+        elif token in CLOSE_TOKENS:
+            depth -= 1
+        elif token == separator and depth == 0:
+            parts.append([])
+            continue
+        parts[-1].append(token)
+    return parts
+
+
+def _find_top(tokens, token):
+    depth = 0
+    for n in range(len(tokens)):
+        if tokens[n] in OPEN_TOKENS:
+            depth += 1
+        elif tokens[n] in CLOSE_TOKENS:
+            depth -= 1
+        elif tokens[n] == token and depth == 0:
+            return n
+    return None
+
+
+def _translate_c(expression):
+    """
+    Translate a C expression to python source (ternaries, logical operators, REC->field, helpers, casts)
+    """
+    parts = list()
+    pos = 0
+    for string in STRING_RE.finditer(expression):
+        parts.append(_strip_casts(expression[pos:string.start()]))
+        parts.append(string.group())
+        pos = string.end()
+    parts.append(_strip_casts(expression[pos:]))
+    return _translate_tokens(_tokenize("".join(parts)))
+
+
+def _strip_casts(code):
+    code = CAST_RE.sub("", code)
+    return DYNAMIC_FIELD_RE.sub(r"REC->\1", code)
+
+
+def _translate_tokens(tokens):
+    parts = _split_tokens(tokens, ",")
+    if len(parts) > 1:
+        return ", ".join(_translate_tokens(part) for part in parts)
+
+    question = _find_top(tokens, "?")
+    if question is not None:
+        # the else branch may hold more (right associative) ternaries, find the matching ":"
+        colon = None
+        depth = 0
+        nested = 0
+        for n in range(question + 1, len(tokens)):
+            if tokens[n] in OPEN_TOKENS:
+                depth += 1
+            elif tokens[n] in CLOSE_TOKENS:
+                depth -= 1
+            elif depth == 0 and tokens[n] == "?":
+                nested += 1
+            elif depth == 0 and tokens[n] == ":":
+                if not nested:
+                    colon = n
+                    break
+                nested -= 1
+        if colon is None:
+            raise NotImplementedError("".join(tokens))
+        return "(({}) if ({}) else ({}))".format(_translate_tokens(tokens[question + 1:colon]),
+                                                 _translate_tokens(tokens[:question]),
+                                                 _translate_tokens(tokens[colon + 1:]))
+
+    out = list()
+    n = 0
+    while n < len(tokens):
+        token = tokens[n]
+        if token in OPEN_TOKENS:
+            close = n + 1
+            depth = 1
+            while depth:
+                if close == len(tokens):
+                    raise NotImplementedError("".join(tokens))
+                depth += (tokens[close] in OPEN_TOKENS) - (tokens[close] in CLOSE_TOKENS)
+                close += 1
+            inner = _translate_tokens(tokens[n + 1:close - 1])
+            if token == "[":
+                out.append("[{}]".format(inner))
+            elif token == "{":
+                out.append("({},)".format(inner) if inner.strip() else "()")
+            else:
+                out.append("({})".format(inner))
+            n = close
+            continue
+        out.append(token if token.startswith('"') else _translate_code(token))
+        n += 1
+    return "".join(out)
+
+
+def _translate_code(code):
+    code = INT_SUFFIX_RE.sub(r"\1", code)
+    code = re.sub(r"REC->(\w+)", r'REC["\1"]', code)
+    for helper, name in HELPERS.items():
+        code = re.sub(r"\b{}\b".format(helper), name, code)
+    code = code.replace("&&", " and ").replace("||", " or ")
+    code = re.sub(r"!(?!=)", " not ", code)
+    return code
+
+
+_ALLOWED_NODES = (ast.Expression, ast.Constant, ast.Name, ast.Load, ast.Subscript, ast.Call, ast.Tuple,
+                  ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+                  ast.operator, ast.unaryop, ast.boolop, ast.cmpop)
+
+
+class _IntegerDivision(ast.NodeTransformer):
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Div):
+            node.op = ast.FloorDiv()
+        return node
+
+
+def _compile_c_expression(expression):
+    source = _translate_c(expression.strip())
+    try:
+        tree = ast.parse(source.strip(), mode="eval")
+    except SyntaxError:
+        raise NotImplementedError(expression)
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise NotImplementedError(expression)
+        if isinstance(node, ast.Name) and node.id not in _NAMESPACE and node.id != "REC":
+            raise NotImplementedError(expression)
+    tree = ast.fix_missing_locations(_IntegerDivision().visit(tree))
+    return compile(tree, "<print fmt>", "eval")
+
+
+def _symbolic(value, *table):
+    for key, name in table:
+        if key == value:
+            return name
+    return "0x{:x}".format(value)
+
+
+def _flags(value, delimiter, *table):
+    names = list()
+    for mask, name in table:
+        if mask and value & mask == mask:
+            names.append(name)
+            value &= ~mask
+        elif not mask and not value:
+            return name
+    if value:
+        names.append("0x{:x}".format(value))
+    return delimiter.join(names)
+
+
+def _hex(value, length=None):
+    return " ".join("{:02x}".format(b) for b in value[:length])
+
+
+_NAMESPACE = {"__builtins__": {}, "_symbolic": _symbolic, "_flags": _flags, "_hex": _hex}
+
+_UNSIGNED_BITS = {None: 32, "hh": 8, "h": 16, "l": 64, "ll": 64, "z": 64, "L": 64}
+
+
+def _format_value(spec, value):
+    conv = spec.group("conv")
+    if conv == "%":
+        return "%"
+    if conv.startswith("p"):
+        # no symbols, print pointers (and %ps/%pS) as hex
+        return "0x{:x}".format(value % (1 << 64)) if isinstance(value, int) else str(value)
+
+    python_spec = "%{}{}{}".format(spec.group("flags"),
+                                   spec.group("width") or "",
+                                   "." + spec.group("precision") if spec.group("precision") else "")
+    if conv == "s":
+        return (python_spec + "s") % (value,)
+    if conv == "c":
+        return (python_spec + "c") % (chr(value) if isinstance(value, int) else value,)
+    if conv in "ouxX" and value < 0:
+        value %= 1 << _UNSIGNED_BITS[spec.group("length")]
+    return (python_spec + conv.replace("u", "d").replace("i", "d")) % (value,)
+
+
+class EventFormat:
+    """
+    Parsed events/<system>/<name>/format
+    """
+    def __init__(self, name, id, fields, print_fmt=""):
+        self.name = name
+        self.id = id
+        self.fields = fields
+        self.print_fmt = print_fmt
+
+        # the scalar fields are unpacked with a single struct, the rest (strings, arrays, unions) one by one
+        scalar = list()
+        struct_format = "<"
+        end = 0
+        for field in sorted(fields, key=lambda f: f.offset):
+            if field.is_scalar and field.offset >= end:
+                code = {1: "b", 2: "h", 4: "i", 8: "q"}[field.size]
+                struct_format += "{}x{}".format(field.offset - end, code if field.signed else code.upper())
+                end = field.offset + field.size
+                scalar.append(field)
+        self._scalar_names = [f.name for f in scalar]
+        self._scalar_struct = struct.Struct(struct_format)
+        self._other_fields = [f for f in fields if f not in scalar]
+
+        self._formatter = None
+        self._format_failed = False
+
+    @classmethod
+    def parse(cls, text):
+        name = re.search(r"^name:\s*(\S+)", text, re.MULTILINE).group(1)
+        id = int(re.search(r"^ID:\s*(\d+)", text, re.MULTILINE).group(1))
+        fields = [Field(m.group("decl"), int(m.group("offset")), int(m.group("size")), m.group("signed") == "1")
+                  for m in FIELD_RE.finditer(text)]
+        print_fmt = re.search(r"^print fmt:\s*(.*)$", text, re.MULTILINE)
+        return cls(name, id, fields, print_fmt.group(1) if print_fmt else "")
+
+    def record(self, data):
+        """
+        :return: dict field name -> value
+        """
+        record = dict(zip(self._scalar_names, self._scalar_struct.unpack_from(data)))
+        for field in self._other_fields:
+            record[field.name] = field.value(data)
+        return record
+
+    def format(self, record):
+        """
+        :return: (event name, info) as in the text trace
+        """
+        if self.name == "print":
+            # trace_marker writes, shown as the caller (tracing_mark_write) in the text trace
+            return TraceFile.MARK_EVENT, record.get("buf", "")
+        if self.name.startswith("sys_enter_"):
+            args = ", ".join("{}: {:x}".format(f.name, record[f.name] % (1 << 64)) for f in self.fields
+                             if not f.name.startswith("common_") and f.name != "__syscall_nr")
+            return "sys_" + self.name[len("sys_enter_"):], args + ")"
+        if self.name.startswith("sys_exit_"):
+            return "sys_" + self.name[len("sys_exit_"):], "-> 0x{:x}".format(record["ret"] % (1 << 64))
+
+        if self._formatter is None and not self._format_failed:
+            try:
+                self._formatter = PrintFormat(self.print_fmt)
+            except (NotImplementedError, SyntaxError, ValueError) as e:
+                logger.debug("Unsupported print fmt of %s (%s), using field=value", self.name, e)
+                self._format_failed = True
+        if self._formatter is not None:
+            try:
+                return self.name, self._formatter.format(record)
+            except Exception as e:
+                logger.debug("Failed to format %s: %s", self.name, e)
+        return self.name, " ".join("{}={}".format(f.name, record[f.name]) for f in self.fields
+                                   if not f.name.startswith("common_"))
+
+
+def parse_formats(text):
+    """
+    :param text: concatenated format files
+    :return: dict id -> EventFormat
+    """
+    formats = dict()
+    for block in re.split(r"^(?=name:)", text, flags=re.MULTILINE):
+        if not block.strip():
+            continue
+        event_format = EventFormat.parse(block)
+        formats[event_format.id] = event_format
+    return formats
+
+
+def parse_saved_cmdlines(text):
+    cmdlines = {0: "<idle>"}
+    for line in text.splitlines():
+        pid, _, comm = line.partition(" ")
+        if pid.isdigit():
+            cmdlines[int(pid)] = comm
+    return cmdlines
+
+
+def trace_flags(flags, preempt_count):
+    """
+    The latency format flags column (irqs-off, need-resched, hardirq/softirq, preempt-depth)
+    """
+    irqs_off = "d" if flags & TRACE_FLAG_IRQS_OFF else "X" if flags & TRACE_FLAG_IRQS_NOSUPPORT else "."
+    need_resched = {TRACE_FLAG_NEED_RESCHED | TRACE_FLAG_PREEMPT_RESCHED: "N",
+                    TRACE_FLAG_NEED_RESCHED: "n",
+                    TRACE_FLAG_PREEMPT_RESCHED: "p"}.get(flags & (TRACE_FLAG_NEED_RESCHED |
+                                                                  TRACE_FLAG_PREEMPT_RESCHED), ".")
+    nmi = flags & TRACE_FLAG_NMI
+    hardirq = flags & TRACE_FLAG_HARDIRQ
+    softirq = flags & TRACE_FLAG_SOFTIRQ
+    hardsoft = ("Z" if nmi and hardirq else "z" if nmi else "H" if hardirq and softirq else
+                "h" if hardirq else "s" if softirq else ".")
+    preempt = "{:x}".format(preempt_count & 0xf) if preempt_count & 0xf else "."
+    return irqs_off + need_resched + hardsoft + preempt
+
+
+class PageHeader:
+    """
+    events/header_page: layout of a ring buffer page
+    """
+    def __init__(self, text=None):
+        # defaults of x86_64
+        self.timestamp_offset, self.commit_offset, self.commit_size = 0, 8, 8
+        self.data_offset, self.data_size = 16, 4080
+        if text is None:
+            return
+        for m in FIELD_RE.finditer(text):
+            name = m.group("decl").split()[-1]
+            offset, size = int(m.group("offset")), int(m.group("size"))
+            if name == "timestamp":
+                self.timestamp_offset = offset
+            elif name == "commit":
+                self.commit_offset, self.commit_size = offset, size
+            elif name == "data":
+                self.data_offset, self.data_size = offset, size
+
+    @property
+    def page_size(self):
+        return self.data_offset + self.data_size
+
+
+class RawCpuBuffer:
+    """
+    Events of the raw ring buffer pages of a single cpu
+    """
+    def __init__(self, filename, cpu, page_header, formats):
+        self.filename = filename
+        self.cpu = cpu
+        self.page_header = page_header
+        self.formats = formats
+        self.missed_pages = 0
+
+    def iter_records(self, name_filter=None):
+        """
+        :param name_filter: function on the format name, only matching events are decoded
+        :return: iterator of (timestamp, EventFormat, data)
+        """
+        header = self.page_header
+        page_size = header.page_size
+        formats = self.formats
+        selected = None
+        if name_filter is not None:
+            selected = {id for id, event_format in formats.items() if name_filter(event_format.name)}
+
+        with open(self.filename, "rb") as f:
+            while True:
+                page = f.read(page_size)
+                if len(page) < header.data_offset:
+                    return
+                timestamp = int.from_bytes(page[header.timestamp_offset:header.timestamp_offset + 8], "little")
+                commit = int.from_bytes(page[header.commit_offset:header.commit_offset + header.commit_size],
+                                        "little")
+                if commit & (MISSED_EVENTS | MISSED_STORED):
+                    self.missed_pages += 1
+                end = header.data_offset + (commit & (MISSED_STORED - 1))
+                pos = header.data_offset
+                while pos + 4 <= end:
+                    word = int.from_bytes(page[pos:pos + 4], "little")
+                    type_len = word & 0x1f
+                    delta = word >> 5
+                    pos += 4
+                    if type_len == TYPE_LEN_PADDING:
+                        if delta == 0:
+                            break  # rest of the page is empty
+                        pos += int.from_bytes(page[pos:pos + 4], "little")
+                        timestamp += delta
+                        continue
+                    if type_len == TYPE_LEN_TIME_EXTEND:
+                        timestamp += (int.from_bytes(page[pos:pos + 4], "little") << TS_SHIFT) + delta
+                        pos += 4
+                        continue
+                    if type_len == TYPE_LEN_TIME_STAMP:
+                        absolute = (int.from_bytes(page[pos:pos + 4], "little") << TS_SHIFT) + delta
+                        timestamp = absolute | (timestamp & ~((1 << 59) - 1))
+                        pos += 4
+                        continue
+
+                    if type_len == 0:
+                        length = int.from_bytes(page[pos:pos + 4], "little") - 4
+                        pos += 4
+                    else:
+                        length = type_len * 4
+                    timestamp += delta
+                    data = page[pos:pos + length]
+                    pos += (length + 3) & ~3
+
+                    event_type = int.from_bytes(data[:2], "little")
+                    if selected is not None and event_type not in selected:
+                        continue
+                    event_format = formats.get(event_type)
+                    if event_format is None:
+                        logger.debug("Unknown event type %d on cpu %d", event_type, self.cpu)
+                        continue
+                    yield timestamp, event_format, data
+
+
+class RawTraceFile(TraceFile):
+    """
+    TraceFile over a raw capture directory, the events are decoded from the ring buffer pages, there is no text
+    parsing
+    """
+    def __init__(self, filename, source="", filters=(), reasons=None):
+        super().__init__(filename, source=source, filters=filters, reasons=reasons)
+        self.raw_dir = filename + RAW_SUFFIX
+        with open(os.path.join(self.raw_dir, "formats")) as f:
+            self.formats = parse_formats(f.read())
+        self.page_header = PageHeader(self._read_optional("header_page"))
+        self.cmdlines = parse_saved_cmdlines(self._read_optional("saved_cmdlines") or "")
+
+        cpu_dir = os.path.join(self.raw_dir, "per_cpu")
+        cpus = sorted(int(name[3:]) for name in os.listdir(cpu_dir) if name.startswith("cpu"))
+        self.cpu_buffers = [RawCpuBuffer(os.path.join(cpu_dir, "cpu{}".format(cpu)), cpu, self.page_header,
+                                         self.formats)
+                            for cpu in cpus]
+
+    @staticmethod
+    def exists(filename):
+        return os.path.isdir(filename + RAW_SUFFIX)
+
+    def _read_optional(self, name):
+        try:
+            with open(os.path.join(self.raw_dir, name)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def fingerprint(self):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(self.raw_dir) for name in names)
+        return {os.path.relpath(name, self.raw_dir): file_fingerprint(name) for name in files}
+
+    @property
+    def missed_pages(self):
+        return sum(buffer.missed_pages for buffer in self.cpu_buffers)
+
+    def _procname(self, pid):
+        return "{}-{}".format(self.cmdlines.get(pid, "<...>"), pid)
+
+    def _iter_cpu_events(self, buffer, name_filter=None):
+        cpu = "{:03d}".format(buffer.cpu)
+        filters = self.filters
+        if filters and not all(f.accepts_cpu(buffer.cpu) for f in filters):
+            # only the markers / TSC offset events can be accepted
+            selected = name_filter
+            name_filter = (lambda name: name in ("print", "kvm_write_tsc_offset") and
+                           (selected is None or selected(name)))
+        for timestamp, event_format, data in buffer.iter_records(name_filter):
+            record = event_format.record(data)
+            name, info = event_format.format(record)
+            event = Event(self._procname(record["common_pid"]),
+                          cpu,
+                          trace_flags(record["common_flags"], record["common_preempt_count"]),
+                          timestamp,
+                          name,
+                          " ".join(info.split()),
+                          source=self.source,
+                          reasons=self.reasons)
+            if filters and not all(f.accepts_event(event) for f in filters):
+                continue
+            yield event
+
+    def iter_events(self, start=0, end=None):
+        """
+        Decode the events of all the cpus, ordered by timestamp
+        :param start, end: byte range of a text trace, a raw capture is always decoded whole
+        """
+        if start or end is not None:
+            raise ValueError("{}: a raw capture cannot be parsed by byte range".format(self.raw_dir))
+        return self._iter_decoded_events()
+
+    def _iter_decoded_events(self, name_filter=None):
+        """
+        :param name_filter: function on the event format name, only matching events are decoded
+        """
+        merger = TraceMerger()
+        for buffer in self.cpu_buffers:
+            merger.add_source(self._iter_cpu_events(buffer, name_filter), name="{} cpu{}".format(self.raw_dir,
+                                                                                               buffer.cpu))
+        yield from merger
+        if self.missed_pages:
+            logger.warning("%s: events were lost on %d pages", self.raw_dir, self.missed_pages)
+
+    def iter_matching_events(self, pattern):
+        """
+        Decode only the events with a name containing pattern (trace markers are the "print" event)
+        """
+        return (event for event in self._iter_decoded_events(lambda name: pattern in name or name == "print")
+                if pattern in event.event)
+
+    def parse_store(self, processes=None):
+        """
+        With processes, the cpu buffers are decoded in parallel and merged
+        """
+        from kernel_traces.event_store import EventStore
+
+        if not processes or len(self.cpu_buffers) < 2:
+            return super().parse_store()
+
+        cpus = [(self.filename, self.source, self.filters, n) for n in range(len(self.cpu_buffers))]
+        with multiprocessing.Pool(min(processes, len(cpus))) as pool:
+            stores = pool.map(_decode_cpu_buffer, cpus, chunksize=1)
+        return EventStore.merge(stores)
+
+
+def _decode_cpu_buffer(args):
+    from kernel_traces.event_store import EventStore
+
+    filename, source, filters, n = args
+    trace = RawTraceFile(filename, source=source, filters=filters)
+    buffer = trace.cpu_buffers[n]
+    store = EventStore.from_events(trace._iter_cpu_events(buffer))
+    if buffer.missed_pages:
+        logger.warning("%s: events were lost on %d pages", buffer.filename, buffer.missed_pages)
+    return store
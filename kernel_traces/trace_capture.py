@@ -0,0 +1,164 @@
+import json
+import logging
+import os.path
+import shlex
+import shutil
+import subprocess
+import threading
+import zlib
+
+from kernel_traces.trace_parser import per_cpu_filename
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# counters of per_cpu/cpuN/stats meaning events were lost
+LOST_COUNTERS = ("overrun", "commit overrun", "dropped events")
+
+
+def parse_cpu_stats(text):
+    """
+    Parse per_cpu/cpuN/stats ("name: value" lines), numbers are converted
+    """
+    stats = dict()
+    for line in text.splitlines():
+        name, sep, value = line.partition(":")
+        if not sep:
+            continue
+        value = value.strip()
+        for convert in (int, float):
+            try:
+                value = convert(value)
+                break
+            except ValueError:
+                pass
+        stats[name.strip()] = value
+    return stats
+
+
+def lost_events(stats):
+    return sum(stats.get(name, 0) for name in LOST_COUNTERS)
+
+
+class TraceCapture:
+    """
+    Drain the ring buffer of every cpu concurrently while tracing: one remote reader per cpu on
+    per_cpu/cpuN/trace_pipe (text, written to the per cpu trace files Traces picks up) or trace_pipe_raw (binary,
+    written to a raw capture directory, see kernel_traces.raw_trace). Each reader is copied to its file by a
+    thread with large reads, memory stays bounded whatever the trace size.
+    On stop, the readers drain what is left in the buffers and the per cpu overrun / lost event counts are
+    collected (and saved next to the trace file).
+    """
+    READ_SIZE = 1 << 20
+    POLL_INTERVAL = 0.1  # seconds between the non blocking reads of a buffer
+    STATS_SUFFIX = ".capture.json"
+
+    def __init__(self, trace, cpus=None, raw=False, compress=False):
+        """
+        :param trace: kernel_traces.kernel_trace.Trace of the machine to capture
+        :param cpus: cpus to capture, default all
+        :param compress: gzip the data on the traced machine, decompressed on the fly locally
+        """
+        self.trace = trace
+        self.cpus = cpus
+        self.raw = raw
+        self.compress = compress
+        self.stats = dict()
+        self._readers = list()  # (cpu, proc, thread)
+
+    @property
+    def filename(self):
+        return self.trace.target_file
+
+    def _cpu_dir(self, cpu):
+        return os.path.join(self.trace.TRACE_DIR, "per_cpu", "cpu{}".format(cpu))
+
+    def _cpu_filename(self, cpu):
+        if self.raw:
+            from kernel_traces.raw_trace import RAW_SUFFIX
+            return os.path.join(self.filename + RAW_SUFFIX, "per_cpu", "cpu{}".format(cpu))
+        return per_cpu_filename(self.filename, cpu)
+
+    def _reader_command(self, cpu):
+        # the pipe is read without blocking every POLL_INTERVAL until the local side closes stdin, then once more
+        # for the rest of the buffer: no reader is killed with events it read but did not write
+        pipe, block_size = ("trace_pipe_raw", 4096) if self.raw else ("trace_pipe", self.READ_SIZE)
+        drain = "dd if={pipe} bs={block_size} iflag=nonblock status=none".format(pipe=pipe, block_size=block_size)
+        command = ("cd {cpu_dir} && {{ exec 3<&0; {{ read _ <&3; }} & waiter=$!; "
+                   "while kill -0 $waiter; do {drain}; sleep {interval}; done; {drain}; }} 2>/dev/null").format(
+            cpu_dir=self._cpu_dir(cpu), drain=drain, interval=self.POLL_INTERVAL)
+        if self.compress:
+            command += " | gzip -1 -c"
+        return self.trace.target.remote_command_prepare(command)
+
+    def start(self):
+        if self.cpus is None:
+            self.cpus = self.trace.online_cpus()
+        if self.raw:
+            from kernel_traces.raw_trace import RAW_SUFFIX
+            shutil.rmtree(self.filename + RAW_SUFFIX, ignore_errors=True)
+            self.trace.read_trace_metadata(self.filename)
+
+        for cpu in self.cpus:
+            filename = self._cpu_filename(cpu)
+            os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+            command = self._reader_command(cpu)
+            logger.debug("Run command: %s", command)
+            proc = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    bufsize=self.READ_SIZE)
+            thread = threading.Thread(target=self._copy, args=(proc, filename), daemon=True)
+            thread.start()
+            self._readers.append((cpu, proc, thread))
+
+    def _copy(self, proc, filename):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if self.compress else None
+        with open(filename, "wb") as f:
+            while True:
+                data = proc.stdout.read1(self.READ_SIZE)
+                if not data:
+                    break
+                if decompressor is not None:
+                    data = decompressor.decompress(data)
+                f.write(data)
+            if decompressor is not None:
+                f.write(decompressor.flush())
+
+    def stop(self, timeout=60):
+        """
+        Stop the readers (tracing should be off), wait for the rest of the buffers
+        :return: per cpu stats, see read_stats()
+        """
+        for cpu, proc, thread in self._readers:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+        for cpu, proc, thread in self._readers:
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.warning("Trace reader of cpu %d did not finish, killing it", cpu)
+                proc.kill()
+                thread.join()
+            proc.wait()
+        self._readers = list()
+
+        if self.raw:
+            self.trace.read_trace_metadata(self.filename, cmdlines_only=True)
+        return self.read_stats()
+
+    def read_stats(self):
+        """
+        Read per_cpu/cpuN/stats of the captured cpus, warn about lost events
+        :return: dict of cpu -> stats dict
+        """
+        _, self.stats = self.trace.check_overruns(self.cpus)
+        try:
+            with open(self.filename + self.STATS_SUFFIX, "w") as f:
+                json.dump({str(cpu): stats for cpu, stats in self.stats.items()}, f, indent=1)
+        except OSError as e:
+            logger.warning("Failed to save capture stats: %s", e)
+        return self.stats
+
+    @property
+    def lost(self):
+        return sum(lost_events(stats) for stats in self.stats.values())
@@ -4,6 +4,13 @@ import struct
 import collections
 import csv
 import argparse
+import heapq
+import hashlib
+import itertools
+import multiprocessing
+import re
+
+import numpy as np
 
 from utils import read_cpu_speed
 
@@ -15,6 +22,53 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+class ReasonTable:
+    """
+    Intern table of the decoded exit / mmio / msr reasons of a trace: the raw (op, addr) tuple of an event is decoded
+    and translated (Event.REASONS_NAME) once, events keep a small id, id 0 is the empty reason
+    """
+    def __init__(self):
+        self.names = [""]
+        self._name_ids = {"": 0}
+        self._key_ids = dict()  # (event name, op, addr) -> id
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name):
+        try:
+            return self._name_ids[name]
+        except KeyError:
+            self._name_ids[name] = len(self.names)
+            self.names.append(name)
+            return self._name_ids[name]
+
+    def get_id(self, name, default=-1):
+        return self._name_ids.get(name, default)
+
+    def decode(self, event):
+        """
+        :return: reason id of the event
+        """
+        name = event.event
+        if name == Event.EVENT_KVM_EXIT:
+            key = (name, event.info.split(maxsplit=2)[1])
+        elif name == Event.EVENT_KVM_MMIO:
+            info = event.info.split()
+            key = (name, info[1], info[5][-4:])
+        elif name == Event.EVENT_KVM_MSR:
+            key = (name,) + tuple(event.info.split(maxsplit=2)[:2])
+        else:
+            return 0
+
+        try:
+            return self._key_ids[key]
+        except KeyError:
+            reason = " ".join(key[1:])
+            self._key_ids[key] = self.intern(event.REASONS_NAME.get(reason, reason))
+            return self._key_ids[key]
+
+
 class Event:
     EVENT_KVM_EXIT = "kvm_exit"
     EVENT_KVM_ENTRY = "kvm_entry"
@@ -38,7 +92,11 @@ class Event:
         "write 00c4": "E1000 ITR",
     }
 
-    def __init__(self, procname, cpuNum, flags, timestamp, event, info, source=""):
+    # shared by the events created without the table of their trace
+    REASONS = ReasonTable()
+    reasons = REASONS
+
+    def __init__(self, procname, cpuNum, flags, timestamp, event, info, source="", reasons=None, reason_id=None):
         self.procname = procname
         self.cpuNum = cpuNum
         self.flags = flags
@@ -47,21 +105,35 @@ class Event:
         self.info = info
         self.source = source
         self.note = None  # can be used in the parser
-        self.reason = ""  # parsed reason
-        self.parse_reason()
+        if reasons is not None:
+            self.reasons = reasons
+        self._reason_id = reason_id  # decoded on first use when not known, see reason
+
+    @property
+    def reason_id(self):
+        """
+        Id of the reason in self.reasons, cheaper to compare than the reason
+        """
+        if self._reason_id is None:
+            self._reason_id = self.reasons.decode(self)
+        return self._reason_id
+
+    @property
+    def reason(self):
+        """
+        Parsed (and translated) reason of kvm_exit / kvm_mmio / kvm_msr events, empty for other events
+        """
+        reason_id = self._reason_id
+        if reason_id is None:
+            reason_id = self._reason_id = self.reasons.decode(self)
+        return self.reasons.names[reason_id]
+
+    @reason.setter
+    def reason(self, reason):
+        self._reason_id = self.reasons.intern(reason)
 
     def parse_reason(self):
-        if self.event == self.EVENT_KVM_EXIT:
-            self.reason = self.info.split()[1]
-        elif self.event == self.EVENT_KVM_MMIO:
-            op = self.info.split()[1]
-            addr = self.info.split()[5]
-            self.reason = "{} {}".format(op, addr[-4:])
-        elif self.event == self.EVENT_KVM_MSR:
-            op = self.info.split()[0]
-            addr = self.info.split()[1]
-            self.reason = "{} {}".format(op, addr)
-        self.translate_reason()
+        self._reason_id = self.reasons.decode(self)
 
     def translate_reason(self):
         if self.reason in self.REASONS_NAME:
@@ -86,60 +158,467 @@ class Event:
         return int(self.procname.split("-")[-1])
 
 
+class TraceFilter:
+    """
+    Pushdown filter, checked on the raw trace line (or the raw record) before it is parsed.
+    Every given condition must match: cpu in cpus, event name in events, pid in pids, comm in comms.
+    source limits the filter to the traces of one source, the trace markers and the TSC offset events are always kept.
+    """
+    ALWAYS_KEEP = frozenset(("tracing_mark_write", "kvm_write_tsc_offset"))
+    _EVENT_NAME_RE = re.compile(r"[^\s:(]+")
+
+    def __init__(self, cpus=None, events=None, pids=None, comms=None, source=None):
+        self.cpus = frozenset(int(cpu) for cpu in cpus) if cpus is not None else None
+        self.events = frozenset(events) if events is not None else None
+        self.pids = frozenset(str(pid) for pid in pids) if pids is not None else None
+        self.comms = frozenset(comms) if comms is not None else None
+        self.source = source
+        self._cpu_tags = frozenset("[{:03d}]".format(cpu) for cpu in self.cpus) if self.cpus is not None else None
+
+    def __repr__(self):
+        return "TraceFilter(cpus={}, events={}, pids={}, comms={}, source={!r})".format(
+            *(sorted(values) if values is not None else None
+              for values in (self.cpus, self.events, self.pids, self.comms)),
+            self.source)
+
+    def applies_to(self, source):
+        return self.source is None or self.source == source
+
+    def _event_name(self, line, bracket):
+        colon = line.find(": ", bracket)
+        if colon < 0:
+            return None
+        match = self._EVENT_NAME_RE.match(line, colon + 2)
+        return match.group() if match else None
+
+    def accepts_line(self, line):
+        split_point = TraceFile.EVENT_SPLIT_POINT
+        bracket = line.find("[", split_point)
+        accepted = True
+        if self._cpu_tags is not None and line[bracket:bracket + 5] not in self._cpu_tags:
+            accepted = False
+        elif self.pids is not None or self.comms is not None:
+            comm, _, pid = line[:split_point].strip().rpartition("-")
+            accepted = ((self.pids is None or pid in self.pids) and
+                        (self.comms is None or comm in self.comms))
+        if accepted and self.events is None:
+            return True
+
+        name = self._event_name(line, bracket)
+        if name in self.ALWAYS_KEEP:
+            return True
+        return accepted and name in self.events
+
+    def accepts_cpu(self, cpu):
+        """
+        False when no event of the cpu can be accepted (except the always kept ones)
+        """
+        return self.cpus is None or int(cpu) in self.cpus
+
+    def accepts_event(self, event):
+        if event.event in self.ALWAYS_KEEP:
+            return True
+        if self.cpus is not None and int(event.cpuNum) not in self.cpus:
+            return False
+        if self.events is not None and event.event not in self.events:
+            return False
+        if self.pids is not None or self.comms is not None:
+            comm, _, pid = event.procname.rpartition("-")
+            if self.pids is not None and pid not in self.pids:
+                return False
+            if self.comms is not None and comm not in self.comms:
+                return False
+        return True
+
+
 class TraceFile:
-    def __init__(self, filename, source=""):
+    EVENT_SPLIT_POINT = 23
+    MARK_EVENT = "tracing_mark_write"
+    PARSE_CHUNK_SIZE = 32 << 20
+
+    def __init__(self, filename, source="", filters=(), reasons=None):
+        """
+        :param filters: TraceFilter list, lines not accepted by the filters of source are skipped before parsing
+        :param reasons: ReasonTable of the events (shared by the files of Traces)
+        """
         self.filename = filename
         self.events = list()
         self.orig_events = list()
         self.source = source
+        self.filters = tuple(f for f in filters if f.applies_to(source))
+        self.reasons = reasons if reasons is not None else ReasonTable()
 
-    def parse(self):
+    def _accepts_line(self, line):
+        return all(f.accepts_line(line) for f in self.filters)
+
+    def _iter_lines(self, start=0, end=None):
+        if end is not None:
+            yield from self._iter_range_lines(start, end)
+            return
+        accepts = self._accepts_line if self.filters else None
         with open(self.filename) as f:
-            EVENT_SPLIT_POINT = 23
             for line in f:
                 if line.startswith("#") or line.startswith("CPU:"):
                     continue
+                if accepts is not None and not accepts(line):
+                    continue
+                yield line
+
+    def _iter_range_lines(self, start, end):
+        """
+        Lines in the byte range [start, end), the range should be newline aligned (see chunk_ranges())
+        """
+        accepts = self._accepts_line if self.filters else None
+        with open(self.filename, "rb") as f:
+            f.seek(start)
+            pos = start
+            for line in f:
+                if pos >= end:
+                    return
+                pos += len(line)
+                if line.startswith(b"#") or line.startswith(b"CPU:"):
+                    continue
+                line = line.decode()
+                if accepts is not None and not accepts(line):
+                    continue
+                yield line
+
+    def parse_line(self, line):
+        procname = line[:self.EVENT_SPLIT_POINT].strip()
+        line_splitted = [procname] + line[self.EVENT_SPLIT_POINT:].split()
+
+        procname = line_splitted[0].strip()
+        cpu_num = line_splitted[1].strip("[]")
+        flags = line_splitted[2]
+        timestamp = int(line_splitted[3].strip(":"))
+        event_name = line_splitted[4].strip(":")
+        info = " ".join(line_splitted[5:])
+
+        if "(" in event_name:
+            #  handle sys_* events
+            event_name, rest = line_splitted[4].split("(", maxsplit=1)
+            info = " ".join([rest, info])
+        return Event(procname, cpu_num, flags, timestamp, event_name, info, source=self.source, reasons=self.reasons)
+
+    def iter_events(self, start=0, end=None):
+        """
+        Parse the trace file lazily, one event at a time, without keeping the events in memory
+        :param start, end: parse only the byte range [start, end)
+        """
+        for line in self._iter_lines(start, end):
+            yield self.parse_line(line)
+
+    def iter_matching_events(self, pattern):
+        """
+        Parse only the lines containing pattern (cheap scan for rare events like markers)
+        """
+        for line in self._iter_lines():
+            if pattern in line:
+                yield self.parse_line(line)
+
+    def iter_marked_events(self):
+        """
+        Stream the events between the first two trace markers (both included)
+        """
+        inside = False
+        for event in self.iter_events():
+            if event.event == self.MARK_EVENT:
+                yield event
+                if inside:
+                    return
+                inside = True
+            elif inside:
+                yield event
 
-                procname = line[:EVENT_SPLIT_POINT].strip()
-                line_splitted = [procname] + line[EVENT_SPLIT_POINT:].split()
-
-                procname = line_splitted[0].strip()
-                cpu_num = line_splitted[1].strip("[]")
-                flags = line_splitted[2]
-                timestamp = int(line_splitted[3].strip(":"))
-                event_name = line_splitted[4].strip(":")
-                info = " ".join(line_splitted[5:])
-
-                if "(" in event_name:
-                    #  handle sys_* events
-                    event_name, rest = line_splitted[4].split("(", maxsplit=1)
-                    info = " ".join([rest, info])
-                self.events.append(Event(procname, cpu_num, flags, timestamp, event_name, info, source=self.source))
+    def parse(self):
+        self.events = list(self.iter_events())
         self.orig_events = self.events[:]
 
+    def fingerprint(self):
+        return file_fingerprint(self.filename)
+
+    def chunk_ranges(self, chunk_size):
+        """
+        Split the file to newline aligned byte ranges of about chunk_size
+        """
+        size = os.path.getsize(self.filename)
+        ranges = list()
+        start = 0
+        with open(self.filename, "rb") as f:
+            while start < size:
+                f.seek(min(start + chunk_size, size))
+                f.readline()
+                end = f.tell()
+                ranges.append((start, end))
+                start = end
+        return ranges
+
+    def parse_store(self, processes=None):
+        """
+        Parse the file to a kernel_traces.event_store.EventStore.
+        With processes, the file is split to chunks parsed in a process pool, each chunk comes back as a compact
+        EventStore and the chunks are concatenated in order.
+        """
+        from kernel_traces.event_store import EventStore
+
+        if not processes:
+            return EventStore.from_events(self.iter_events())
+
+        size = os.path.getsize(self.filename)
+        chunk_size = max(1 << 20, min(self.PARSE_CHUNK_SIZE, size // (processes * 4) + 1))
+        chunks = [(self.filename, self.source, self.filters, start, end)
+                  for start, end in self.chunk_ranges(chunk_size)]
+        with multiprocessing.Pool(processes) as pool:
+            stores = pool.map(_parse_chunk, chunks, chunksize=1)
+        return EventStore.concatenate(stores)
+
+
+def _parse_chunk(chunk):
+    from kernel_traces.event_store import EventStore
+
+    filename, source, filters, start, end = chunk
+    return EventStore.from_events(TraceFile(filename, source=source, filters=filters).iter_events(start, end))
+
+
+def per_cpu_filename(filename, cpu):
+    """
+    Name of the trace file holding the buffer of a single cpu
+    """
+    return "{}_cpu{}".format(filename, cpu)
+
+
+class TraceMerger:
+    """
+    k-way merge of already time ordered event streams (guest, host, per cpu buffers).
+    The TSC offset of each source is applied on the fly, on equal timestamps the events of the source added first
+    come first.
+    """
+    def __init__(self):
+        self._sources = list()
+
+    def add_source(self, events, tsc_offset=0, name=""):
+        self._sources.append((events, tsc_offset, name))
+
+    def __iter__(self):
+        heap = list()
+        for n, (events, tsc_offset, name) in enumerate(self._sources):
+            events = iter(events)
+            event = next(events, None)
+            if event is not None:
+                event.timestamp -= tsc_offset
+                heap.append((event.timestamp, n, event, events))
+        heapq.heapify(heap)
+
+        unordered = [0] * len(self._sources)  # out of order events per source, the first one is logged
+        while heap:
+            timestamp, n, event, events = heap[0]
+            next_event = next(events, None)
+            if next_event is None:
+                heapq.heappop(heap)
+                if unordered[n]:
+                    logger.warning("Source %s: %d events were not time ordered", self._sources[n][2], unordered[n])
+            else:
+                next_event.timestamp -= self._sources[n][1]
+                if next_event.timestamp < timestamp:
+                    if not unordered[n]:
+                        logger.warning("Source %s is not time ordered: %s", self._sources[n][2], next_event)
+                    unordered[n] += 1
+                heapq.heapreplace(heap, (next_event.timestamp, n, next_event, events))
+            yield event
+
+
+def file_fingerprint(filename, block_size=1 << 20):
+    """
+    (size, mtime, hash of the first and last block) of a file, cheap enough for multi GB traces
+    """
+    stat = os.stat(filename)
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        digest.update(f.read(block_size))
+        if stat.st_size > block_size:
+            f.seek(max(block_size, stat.st_size - block_size))
+            digest.update(f.read(block_size))
+    return [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
 
 class Traces:
-    def __init__(self, dir=DIR):
-        self.guest_traces = TraceFile(os.path.join(dir, "trace_guest"),
-                                      source=Event.EVENT_SOURCE_GUEST)
-        self.host_traces = TraceFile(os.path.join(dir, "trace_host"),
-                                     source=Event.EVENT_SOURCE_HOST)
+    GUEST_FILE = "trace_guest"
+    HOST_FILE = "trace_host"
+    CACHE_FILE = "parsed_trace.npz"
+    CACHE_VERSION = 1
+    # the test events start TEST_START_TRIM seconds after the begin marker and end TEST_END_TRIM seconds before
+    # the end marker (warm up / tear down of netperf)
+    TEST_START_TRIM = 1.5
+    TEST_END_TRIM = 0.5
+
+    def __init__(self, dir=DIR, stream=False, cache=False, processes=None, filters=()):
+        """
+        :param stream: don't load the traces to memory, use iter_events()/iter_test_events() to go over the
+                       merged events
+        :param cache: load the merged events from CACHE_FILE when it matches the trace files, and write it
+                      after parsing (to the trace directory, off by default)
+        :param processes: parse the trace files in parallel to the columnar representation (self.store), with this
+                          number of processes
+        :param filters: TraceFilter list, the events they reject are dropped while parsing
+        """
+        self.dir = dir
+        self.filters = tuple(filters)
+        self.reasons = ReasonTable()  # shared by the events of all the trace files
+        self.guest_traces = self._trace_file(os.path.join(dir, self.GUEST_FILE), Event.EVENT_SOURCE_GUEST,
+                                             self.filters, self.reasons)
+        self.host_traces = self._trace_file(os.path.join(dir, self.HOST_FILE), Event.EVENT_SOURCE_HOST,
+                                            self.filters, self.reasons)
+        # per cpu buffers, used instead of the single trace file when they exist
+        self.guest_cpu_traces = self._find_cpu_traces(dir, self.GUEST_FILE, Event.EVENT_SOURCE_GUEST, self.filters,
+                                                      self.reasons)
+        self.host_cpu_traces = self._find_cpu_traces(dir, self.HOST_FILE, Event.EVENT_SOURCE_HOST, self.filters,
+                                                     self.reasons)
         self.tsc_offset = None
-        self.events = list()
+        self._events = list()
+        self.store = None  # columnar events, see build_store()
+        self.stream = stream
+        self.cache = cache
+        self.processes = processes
+        self.from_cache = False
+        self._index = dict()  # marks, timestamps and groups of the current events, see _cached()
+        self._index_owner = None
+        if cache and self.load_cache():
+            return
+        if stream:
+            return
         try:
             self.parse()
         except:
             logger.debug("Failed to parse traces")
 
+    @staticmethod
+    def _trace_file(filename, source, filters=(), reasons=None):
+        """
+        A raw capture (see Trace.read_trace_raw) is used instead of the text trace when it exists
+        """
+        from kernel_traces.raw_trace import RawTraceFile
+
+        if RawTraceFile.exists(filename):
+            return RawTraceFile(filename, source=source, filters=filters, reasons=reasons)
+        return TraceFile(filename, source=source, filters=filters, reasons=reasons)
+
+    @staticmethod
+    def _find_cpu_traces(dir, filename, source, filters=(), reasons=None):
+        prefix = per_cpu_filename(filename, "")
+        try:
+            names = os.listdir(dir)
+        except OSError:
+            return list()
+        cpus = sorted(int(name[len(prefix):]) for name in names
+                      if name.startswith(prefix) and name[len(prefix):].isdigit())
+        return [TraceFile(os.path.join(dir, per_cpu_filename(filename, cpu)), source=source, filters=filters,
+                          reasons=reasons)
+                for cpu in cpus]
+
+    @property
+    def events(self):
+        if self._events is None:
+            # loaded from the cache, create the Event objects only when needed
+            self._events = list(self.store.iter_events())
+        return self._events
+
+    @events.setter
+    def events(self, events):
+        self._events = events
+
+    @property
+    def store_only(self):
+        """
+        The merged events are only in self.store (loaded from the cache or parsed to the store), Event objects are
+        created when needed
+        """
+        return self._events is None
+
+    @property
+    def cache_filename(self):
+        return os.path.join(self.dir, self.CACHE_FILE)
+
+    def _fingerprint(self):
+        return {os.path.basename(trace.filename): trace.fingerprint()
+                for trace in self.guest_files + self.host_files}
+
+    def _filters_key(self):
+        return [repr(f) for f in self.filters]
+
+    def load_cache(self):
+        """
+        :return: True if the merged events were loaded from the cache
+        """
+        from kernel_traces.event_store import EventStore
+
+        if not os.path.exists(self.cache_filename):
+            return False
+        try:
+            store, meta = EventStore.load(self.cache_filename)
+            valid = (meta["version"] == self.CACHE_VERSION and meta["files"] == self._fingerprint() and
+                     meta.get("filters", []) == self._filters_key())
+        except:
+            logger.debug("Failed to load trace cache %s", self.cache_filename)
+            return False
+        if not valid:
+            logger.debug("Trace cache %s is out of date", self.cache_filename)
+            return False
+
+        self.store = store
+        self.tsc_offset = meta["tsc_offset"]
+        self._events = None
+        self.from_cache = True
+        return True
+
+    def save_cache(self):
+        if self.store is None:
+            self.build_store()
+        meta = {"version": self.CACHE_VERSION,
+                "tsc_offset": self.tsc_offset,
+                "files": self._fingerprint(),
+                "filters": self._filters_key()}
+        try:
+            self.store.save(self.cache_filename, meta)
+        except OSError as e:
+            logger.warning("Failed to write trace cache %s: %s", self.cache_filename, e)
+
+    @property
+    def guest_files(self):
+        return self.guest_cpu_traces or [self.guest_traces]
+
+    @property
+    def host_files(self):
+        return self.host_cpu_traces or [self.host_traces]
+
     def parse(self):
-        self.guest_traces.parse()
-        self.host_traces.parse()
-        self.parse_tsc()
-        self.update_guest_tsc()
-        self.merge()
-
-    def parse_tsc(self):
-        for event in self.host_traces.events:
+        self.store = None
+        self.from_cache = False
+        self._events = list()
+        if self.stream:
+            self.tsc_offset = None
+            self.parse_tsc()
+            return
+        if self.processes or self.cache:
+            # the cache is saved from the store: parse straight to it, the events are created from it when needed
+            self._parse_store()
+        else:
+            for trace in self.guest_files + self.host_files:
+                trace.parse()
+            self.parse_tsc()
+            self.update_guest_tsc()
+            self.merge()
+        if self.cache:
+            self.save_cache()
+
+    def parse_tsc(self, events=None):
+        """
+        :param events: host events to look for kvm_write_tsc_offset in, default the host trace files
+        """
+        if events is None:
+            events = itertools.chain.from_iterable(
+                trace.iter_matching_events('kvm_write_tsc_offset') if self.stream else trace.events
+                for trace in self.host_files)
+        for event in events:
             if event.event == 'kvm_write_tsc_offset':
                 raw_delta = int(event.info.split("=")[-1].strip())
                 self.tsc_offset = struct.unpack("q", struct.pack("Q", raw_delta))[0]
@@ -148,30 +627,210 @@ class Traces:
 
     def update_guest_tsc(self):
         assert self.tsc_offset is not None
-        for event in self.guest_traces.events:
-            event.timestamp -= self.tsc_offset
+        for trace in self.guest_files:
+            for event in trace.events:
+                event.timestamp -= self.tsc_offset
 
     def merge(self):
-        self.events = self.guest_traces.events + self.host_traces.events
-        self.events.sort(key=lambda e: e.timestamp)
-
-    def get_test_events(self):
-        start, end = [n for n, e in enumerate(self.events) if e.event == 'tracing_mark_write']
-        start_timestamp = self.events[start].timestamp + read_cpu_speed() * 1e6 * 1.5  # 0.5 sec
-        end_timestamp = self.events[end].timestamp - read_cpu_speed() * 1e6 * 0.5  # 1.5 sec
-        events = [start + n for n, e in enumerate(self.events[start:end+1]) if start_timestamp < e.timestamp < end_timestamp]
-        # print("start", start)
-        start, end = events[0], events[-1]
-        # print("new start", start)
-        return self.events[start:end + 1]
+        merger = TraceMerger()
+        for trace in self.guest_files + self.host_files:
+            # stable and linear on an already sorted list, keeps the merge correct on unordered files
+            trace.events.sort(key=lambda e: e.timestamp)
+            merger.add_source(trace.events, name=trace.filename)
+        self.events = list(merger)
+
+    def get_merger(self, guest_events=None, host_events=None):
+        """
+        Merger over the trace files, parsed on the fly
+        :param guest_events: function returning the events of a guest TraceFile (default: iter_events())
+        :param host_events: same, for host TraceFile
+        """
+        if self.tsc_offset is None:
+            self.parse_tsc()
+        assert self.tsc_offset is not None
+
+        if guest_events is None:
+            guest_events = lambda trace: trace.iter_events()
+        if host_events is None:
+            host_events = lambda trace: trace.iter_events()
+
+        merger = TraceMerger()
+        for trace in self.guest_files:
+            merger.add_source(guest_events(trace), self.tsc_offset, name=trace.filename)
+        for trace in self.host_files:
+            merger.add_source(host_events(trace), name=trace.filename)
+        return merger
+
+    def iter_events(self):
+        """
+        Iterate over the merged events, in stream mode the traces are parsed and merged on the fly
+        """
+        if not self.stream:
+            return iter(self.events)
+        if self.store_only:
+            return self.store.iter_events()
+        return iter(self.get_merger())
+
+    def build_store(self):
+        """
+        Build the columnar representation of the merged events (kernel_traces.event_store.EventStore)
+        """
+        from kernel_traces.event_store import EventStore
+
+        if self.store_only:
+            return self.store
+
+        if not self.stream:
+            self.store = EventStore.from_events(self.events)
+            return self.store
+
+        self._parse_store()
+        if self.cache:
+            self.save_cache()
+        return self.store
+
+    def _parse_store(self):
+        """
+        Parse the trace files straight to the store (in parallel when self.processes is set), the TSC offset is
+        taken from the host stores
+        """
+        from kernel_traces.event_store import EventStore
+
+        guest = [trace.parse_store(self.processes) for trace in self.guest_files]
+        host = [trace.parse_store(self.processes) for trace in self.host_files]
+        self.tsc_offset = None
+        self.parse_tsc(itertools.chain.from_iterable(
+            store.iter_events(np.flatnonzero(store.mask_event('kvm_write_tsc_offset'))) for store in host))
+        assert self.tsc_offset is not None
+        for store in guest:
+            store.shift_timestamps(-self.tsc_offset)
+        self.store = EventStore.merge(guest + host)
+        self._events = None
+
+    def _cached(self, name, build):
+        """
+        Index data of the current events (self.store / self.events), built on first use
+        """
+        owner = (self.store, self._events)
+        if self._index_owner is None or any(a is not b for a, b in zip(owner, self._index_owner)):
+            self._index = dict()
+            self._index_owner = owner
+        if name not in self._index:
+            self._index[name] = build()
+        return self._index[name]
+
+    def _get_marks(self):
+        return self._cached("marks", self._find_marks)
+
+    def _find_marks(self):
+        if self.store_only:
+            return list(self.store.iter_events(np.flatnonzero(self.store.mask_event(TraceFile.MARK_EVENT))))
+        if not self.stream:
+            return [e for e in self.events if e.event == TraceFile.MARK_EVENT]
+
+        merger = self.get_merger(lambda trace: trace.iter_matching_events(TraceFile.MARK_EVENT),
+                                 lambda trace: trace.iter_matching_events(TraceFile.MARK_EVENT))
+        return [e for e in merger if e.event == TraceFile.MARK_EVENT]
+
+    def find_marker(self, message=TRACE_BEGIN_MSG):
+        """
+        First trace marker containing message
+        """
+        for mark in self._get_marks():
+            if message in mark.info:
+                return mark
+        raise ValueError("No trace marker {!r} in {}".format(message, self.dir))
+
+    @staticmethod
+    def seconds_to_cycles(seconds):
+        return seconds * read_cpu_speed() * 1e6
+
+    def test_window(self, start_trim=None, end_trim=None):
+        """
+        :return: (start, end) timestamps of the test events, between the first two markers, trimmed
+        """
+        if start_trim is None:
+            start_trim = self.TEST_START_TRIM
+        if end_trim is None:
+            end_trim = self.TEST_END_TRIM
+        start, end = self._get_marks()
+        return (start.timestamp + self.seconds_to_cycles(start_trim),
+                end.timestamp - self.seconds_to_cycles(end_trim))
+
+    def marker_window(self, begin=TRACE_BEGIN_MSG, end=TRACE_END_MSG, start_offset=0, duration=None, end_offset=0):
+        """
+        :return: (start, end) timestamps, start_offset seconds after the begin marker and either duration seconds
+                 long or end_offset seconds before the end marker, e.g. marker_window(duration=3) for the 3 seconds
+                 after NETPERF BEGIN
+        """
+        start_timestamp = self.find_marker(begin).timestamp + self.seconds_to_cycles(start_offset)
+        if duration is not None:
+            return start_timestamp, start_timestamp + self.seconds_to_cycles(duration)
+        return start_timestamp, self.find_marker(end).timestamp - self.seconds_to_cycles(end_offset)
+
+    def get_window(self, start=None, end=None, source=None, cpu=None, pid=None):
+        """
+        Events with start < timestamp < end (optionally of one source / cpu / pid) as a view of the store
+        (kernel_traces.event_store.EventStore), O(log n) once the store and the groups are built
+        """
+        store = self.build_store()
+        columns = tuple(column for column, value in (("source", source), ("cpu", cpu), ("pid", pid))
+                        if value is not None)
+        if columns:
+            key = tuple(int(value) if column != "source" else value
+                        for column, value in (("source", source), ("cpu", cpu), ("pid", pid)) if value is not None)
+            groups = self._cached(("groups",) + columns, lambda: store.group_by(*columns))
+            store = groups.get(key, store[0:0])
+        return store.time_slice(start, end)
+
+    def get_marker_window(self, begin=TRACE_BEGIN_MSG, end=TRACE_END_MSG, start_offset=0, duration=None,
+                          end_offset=0, source=None, cpu=None, pid=None):
+        """
+        get_window() of marker_window()
+        """
+        return self.get_window(*self.marker_window(begin, end, start_offset, duration, end_offset),
+                               source=source, cpu=cpu, pid=pid)
+
+    def iter_test_events(self, start_trim=None, end_trim=None):
+        """
+        Iterate over the events of the test itself (between the trace markers, trimmed)
+        """
+        if self.store_only:
+            yield from self._store_test_events(start_trim, end_trim).iter_events()
+            return
+
+        start_timestamp, end_timestamp = self.test_window(start_trim, end_trim)
+        for e in self.iter_events():
+            if e.timestamp <= start_timestamp:
+                continue
+            if e.timestamp >= end_timestamp:
+                break
+            yield e
+
+    def _store_test_events(self, start_trim=None, end_trim=None):
+        return self.store.time_slice(*self.test_window(start_trim, end_trim))
+
+    def get_test_events(self, start_trim=None, end_trim=None):
+        if self.store_only:
+            # only the events of the test are created
+            return list(self._store_test_events(start_trim, end_trim).iter_events())
+        if self.stream:
+            return list(self.iter_test_events(start_trim, end_trim))
+
+        start_timestamp, end_timestamp = self.test_window(start_trim, end_trim)
+        timestamps = self._cached("timestamps", lambda: np.fromiter((e.timestamp for e in self.events),
+                                                                     dtype=np.int64, count=len(self.events)))
+        first = np.searchsorted(timestamps, start_timestamp, side="right")
+        last = np.searchsorted(timestamps, end_timestamp, side="left")
+        return self.events[first:last]
 
     def write_to_file(self, filename, test_events_only=False):
         if os.path.isdir(filename):
             filename = os.path.join(filename, "merged_trace")
         if test_events_only:
-            events = self.get_test_events()
+            events = self.iter_test_events() if self.stream else self.get_test_events()
         else:
-            events = self.events
+            events = self.iter_events()
         with open(filename, "w") as f:
             for event in events:
                 f.write("{!r}\n".format(event))
@@ -211,6 +870,31 @@ def deltas2csv(csvname, deltas):
         writer.writerows(({n: v for n, v in zip(d._fields, d)} for d in deltas))
 
 
+def tcp_events2csv(trace, calling_writer, sending_writer, waiting_writer):
+    """
+    Write the tcp_send_info (all, and the ones followed by tcp_sending) and tcp_wait_for_memory events of trace
+    (a TraceFile) to the csv writers, in a single pass over the marked events: the trace is never loaded to memory
+    :return: Counter of the event names (without the last event)
+    """
+    def fields(event):
+        return [event.timestamp] + [field.split("=")[1] for field in event.info.split(",")]
+
+    c = collections.Counter()
+    prev_event = None
+    for event in trace.iter_marked_events():
+        if event.event == "tcp_send_info":
+            calling_writer.writerow(fields(event))
+        elif event.event == "tcp_wait_for_memory":
+            waiting_writer.writerow(fields(event))
+
+        if prev_event is not None:
+            if prev_event.event == "tcp_send_info" and event.event == "tcp_sending":
+                sending_writer.writerow(fields(prev_event))
+            c[prev_event.event] += 1
+        prev_event = event
+    return c
+
+
 cpu_hz = None
 
 
@@ -12,6 +12,7 @@ import json
 import errno
 import socket
 import sys
+import time
 
 class QMPError(Exception):
     pass
@@ -42,6 +43,7 @@ class QEMUMonitorProtocol:
         self.__address = address
         self._debug = debug
         self.__sock = self.__get_sock()
+        self.__sockfile = None
         if server:
             self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.__sock.bind(self.__address)
@@ -98,25 +100,38 @@ class QEMUMonitorProtocol:
         try:
             self.__json_read()
         except socket.error as err:
-            if err[0] == errno.EAGAIN:
-                # No data available
-                pass
-        self.__sock.setblocking(1)
+            if err.errno != errno.EAGAIN:
+                raise
+            # No data available
+        finally:
+            self.__sock.setblocking(1)
 
         # Wait for new events, if needed.
         # if wait is 0.0, this means "no wait" and is also implicitly false.
         if not self.__events and wait:
-            if isinstance(wait, float):
-                self.__sock.settimeout(wait)
-            try:
-                ret = self.__json_read(only_event=True)
-            except socket.timeout:
-                raise QMPTimeoutError("Timeout waiting for event")
-            except:
-                raise QMPConnectError("Error while reading from socket")
-            if ret is None:
-                raise QMPConnectError("Error while reading from socket")
+            self.__read_event(wait)
+
+    def __read_event(self, wait):
+        """
+        Block until an event is read and cached in __events.
+
+        @param wait (bool or float): True, or a timeout value.
+        """
+        if isinstance(wait, float):
+            self.__sock.settimeout(wait)
+        try:
+            ret = self.__json_read(only_event=True)
+        except socket.timeout:
+            # the reader refuses to read again after a timeout
+            self.__sockfile.close()
+            self.__sockfile = self.__sock.makefile()
+            raise QMPTimeoutError("Timeout waiting for event")
+        except:
+            raise QMPConnectError("Error while reading from socket")
+        finally:
             self.__sock.settimeout(None)
+        if ret is None:
+            raise QMPConnectError("Error while reading from socket")
 
     def connect(self, negotiate=True):
         """
@@ -159,7 +174,7 @@ class QEMUMonitorProtocol:
         try:
             self.__sock.sendall(bytes(json.dumps(qmp_cmd), 'utf8'))
         except socket.error as err:
-            if err[0] == errno.EPIPE:
+            if err.errno == errno.EPIPE:
                 return
             raise socket.error(err)
         resp = self.__json_read()
@@ -208,6 +223,32 @@ class QEMUMonitorProtocol:
             return self.__events.pop(0)
         return None
 
+    def wait_event(self, match, timeout):
+        """
+        Get and delete the first QMP event match accepts, the other events
+        stay available.
+
+        @param match: predicate on the event dict
+        @param timeout (float): timeout value
+
+        @raise QMPTimeoutError: If the timeout period elapses.
+        @raise QMPConnectError: If some error occurred.
+
+        @return The matching QMP event.
+        """
+        deadline = time.monotonic() + timeout
+        self.__get_events()
+        checked = 0
+        while True:
+            for n in range(checked, len(self.__events)):
+                if match(self.__events[n]):
+                    return self.__events.pop(n)
+            checked = len(self.__events)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise QMPTimeoutError("Timeout waiting for event")
+            self.__read_event(float(remaining))
+
     def get_events(self, wait=False):
         """
         Get a list of available QMP events.
@@ -233,7 +274,8 @@ class QEMUMonitorProtocol:
 
     def close(self):
         self.__sock.close()
-        self.__sockfile.close()
+        if self.__sockfile:
+            self.__sockfile.close()
 
     timeout = socket.timeout
 
@@ -491,6 +491,11 @@ class TestCmpThroughput(QemuThroughputTest):
         return [(deepcopy(vm), vm.name) for vm in self._test_vms]
 
 
+class TestCmpThroughputReuse(TestCmpThroughput):
+    # VMs that only differ in NIC / qemu options are reconfigured instead of rebooted, see VM.take_over()
+    REUSE_VMS = True
+
+
 class TestCmpThroughputTSO(TestCmpThroughput):
     NETPERF_CLS = NetPerfTcpTSO
 
@@ -7,7 +7,7 @@ SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.
 sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 
 from utils.vms import QemuNG
-from test_qemu_throughput import TestCmpThroughput
+from test_qemu_throughput import TestCmpThroughputReuse
 
 RUNTIME = 15
 RETRIES = 1
@@ -86,7 +86,7 @@ def create_vms():
 
 if __name__ == "__main__":
     os.makedirs(BASE_DIR, exist_ok=True)
-    test = TestCmpThroughput(create_vms(), RUNTIME, RETRIES, directory=BASE_DIR)
+    test = TestCmpThroughputReuse(create_vms(), RUNTIME, RETRIES, directory=BASE_DIR)
     test.pre_run()
     test.run()
     test.post_run()
@@ -10,7 +10,7 @@ print(SCRIPT_DIR)
 sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 
 from utils.vms import QemuNG
-from test_qemu_throughput import TestCmpThroughput
+from test_qemu_throughput import TestCmpThroughputReuse
 
 RUNTIME = 30
 RETRIES = 1
@@ -117,7 +117,7 @@ def main(skip=0, end=99):
         root_logger.info("Starting %s", name)
         d = os.path.join(BASE_DIR, "{}-{}".format(num, name))
         os.makedirs(d, exist_ok=True)
-        test = TestCmpThroughput(vms, RUNTIME, RETRIES, directory=d)
+        test = TestCmpThroughputReuse(vms, RUNTIME, RETRIES, directory=d)
         test.pre_run()
         test.run()
         test.post_run()
@@ -203,6 +203,9 @@ def create_vms():
 
 
 class TestCmpThroughput(QemuThroughputTest):
+    # the VMs of the sweep only differ in NIC / qemu options, see VM.take_over()
+    REUSE_VMS = True
+
     def __init__(self, vms, *args, **kargs):
         self._test_vms = vms
         super().__init__(*args, **kargs)
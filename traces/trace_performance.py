@@ -8,7 +8,6 @@ from functools import partial
 from math import log2
 import sys
 import multiprocessing
-from time import sleep
 
 from kernel_traces.latency_parser2 import MainStats
 
@@ -20,7 +19,9 @@ MSG_SIZES = (64, 128, 256, 512,
 sys.path.append("../..")
 
 from kernel_traces.kernel_trace import Trace
-from kernel_traces.trace_parser import Traces, TRACE_BEGIN_MSG, TRACE_END_MSG
+from kernel_traces.overhead import estimate_overhead, event_costs, event_key, load_overhead, save_overhead
+from kernel_traces.trace_capture import lost_events
+from kernel_traces.trace_parser import Event, Traces, TRACE_BEGIN_MSG, TRACE_END_MSG
 from kernel_traces.latency_parser import exits_stats, latency_split_to_time_portions, throughput_split_to_time_portions
 from sensors.netperf import NetPerfLatency, NetPerfTCP, netserver_start, netserver_stop, NetPerfTcpTSO
 from utils.machine import localRoot
@@ -34,6 +35,12 @@ Qemu.QEMU_EXE = TMP_QEMU
 
 TMP_DIR = r"/tmp/traces"
 
+# exit latencies aggregated in the kernel, see TracePerformance(aggregate_exits=True)
+EXITS_HIST_FILE = "exits_hist.csv"
+
+# netperf runtime (seconds) used to measure the event rates, see TracePerformance.calibrate_buffers()
+CALIBRATION_RUNTIME = 2
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -47,8 +54,26 @@ def get_dir(directory=None):
 
 
 class TracePerformance:
-    def __init__(self, vm: VM, directory=None, netperf=None, msg_size=64, title="", auto_dir=False, name=None):
+    def __init__(self, vm: VM, directory=None, netperf=None, msg_size=64, title="", auto_dir=False, name=None,
+                 stream=False, raw=False, processes=None, online_stats=False, pushdown=False, capture=False,
+                 capture_compress=False, aggregate_exits=False, calibrate=False, fail_on_overrun=False,
+                 corrected_stats=False):
         self._vm = vm
+        self._stream = stream
+        self._raw = raw
+        self._processes = processes
+        self._online_stats = online_stats
+        self._pushdown = pushdown
+        self._capture = capture
+        self._capture_compress = capture_compress
+        self._aggregate_exits = aggregate_exits
+        self._exit_hist = None
+        self._calibrate = calibrate
+        self._fail_on_overrun = fail_on_overrun
+        self._lost_events = 0
+        self._corrected_stats = corrected_stats
+        self._traced_perf = None
+        self._untraced_perf = list()
         if directory:
             self._dir = directory
         else:
@@ -91,156 +116,195 @@ class TracePerformance:
         root_logger = logging.getLogger()
         root_logger.addHandler(logging.FileHandler(os.path.join(self._dir, "log")))
 
-        self.trace_parser = Traces(self._dir)
+        self.trace_parser = Traces(self._dir, stream=self._stream, cache=True, processes=self._processes,
+                                   filters=MainStats.TRACE_FILTERS if self._pushdown else ())
+
+    def _buffer_size(self, size):
+        """
+        :return: size (KB), or the small calibration size when calibrate_buffers() will size the buffers
+        """
+        if self._calibrate and not self._capture:
+            return Trace.BUFFER_CALIBRATION_KB
+        return size
 
     def host_traces(self):
         assert self._host_tracer is None
 
         self._host_tracer = Trace(localRoot, os.path.join(self._dir, "trace_host"))
-        self._host_tracer.setup()
-        self._host_tracer.set_buffer_size(2000000)
-        sleep(1)
-
-        # if self._vm.cpu_to_pin:
-        #     self._host_tracer.write_value("tracing_cpumask", str(1 << (int(self._vm.cpu_to_pin))))
-
-        # clock sync with VM
-        self._host_tracer.enable_event("kvm/kvm_write_tsc_offset")
-
-        # interrupts
-        # self._host_tracer.enable_event("kvm/kvm_set_irq")
-        # self._host_tracer.enable_event("kvm/kvm_msi_set_irq")
-        # self._host_tracer.enable_event("kvm/kvm_inj_virq")
-        # self._host_tracer.enable_event("kvm/kvm_ioapic_set_irq")
-
-        # exit events
-        self._host_tracer.enable_event("kvm/kvm_exit")
-        self._host_tracer.enable_event("kvm/kvm_entry")
-        # self._host_tracer.enable_event("kvm/kvm_userspace_exit")
-        self._host_tracer.enable_event("kvm/kvm_mmio")
-        self._host_tracer.enable_event("kvm/kvm_msr")
-
-        # sched
-        self._host_tracer.set_event_filter("sched/sched_switch", r'prev_comm ~ "*qemu*" || next_comm ~ "*qemu*"')
-        self._host_tracer.enable_event("sched/sched_switch")
-
-        # self._host_tracer.set_event_filter("sched/sched_wakeup", r'comm~"*qemu*"')
-        # self._host_tracer.enable_event("sched/sched_wakeup")
-
-        # self._host_tracer.set_event_filter("sched/sched_waking", r'comm~"*qemu*"')
-        # self._host_tracer.enable_event("sched/sched_waking")
-        # self._host_tracer.uprobe_add_event("p", "e1000_set_kick", self._vm.exe, "e1000_set_kick")
-        # self._host_tracer.uprobe_add_event("p", "e1000_kick_cb", self._vm.exe, "e1000_kick_cb")
-        # self._host_tracer.uprobe_add_event("p", "qemu_mutex_lock_iothread", self._vm.exe, "qemu_mutex_lock_iothread")
-        # self._host_tracer.uprobe_add_event("r", "qemu_mutex_lock_iothread_end", self._vm.exe, "qemu_mutex_lock_iothread")
-        # self._host_tracer.uprobe_add_event("p", "qemu_mutex_unlock_iothread", self._vm.exe, "qemu_mutex_unlock_iothread")
-        # self._host_tracer.uprobe_add_event("r", "qemu_mutex_unlock_iothread_end", self._vm.exe, "qemu_mutex_unlock_iothread")
-        self._host_tracer.enable_event("irq/irq_handler_entry")
-        self._host_tracer.enable_event("irq/irq_handler_exit")
-        self._host_tracer.enable_event("irq_vectors")
-
-        self._host_tracer.enable_event("syscalls")
-
-        # self._host_tracer.kprobe_add("p:import_iovec import_iovec")
-        # self._host_tracer.kprobe_add("r:import_iovec_end import_iovec")
-        # self._host_tracer.kprobe_add("p:tun_get_user tun_get_user")
-        # self._host_tracer.kprobe_add("r:tun_get_user_end tun_get_user")
-        #
-        # self._host_tracer.kprobe_add("p:netif_receive_skb netif_receive_skb")
-        # self._host_tracer.kprobe_add("r:netif_receive_skb_end netif_receive_skb")
-        # # self._host_tracer.enable_event("net/netif_receive_skb")
-        # # self._host_tracer.enable_event("net/netif_receive_skb_entry")
-        # # self._host_tracer.enable_event("net/netif_rx_ni_entry")
-
-        self._host_tracer.kprobe_enable()
-        self._host_tracer.uprobe_enable()
-        self._host_tracer.empty_trace()
+        with self._host_tracer.batch():
+            self._host_tracer.setup()
+            self._host_tracer.set_buffer_size(self._buffer_size(2000000))
+
+            # if self._vm.cpu_to_pin:
+            #     self._host_tracer.write_value("tracing_cpumask", str(1 << (int(self._vm.cpu_to_pin))))
+
+            # clock sync with VM
+            self._host_tracer.enable_event("kvm/kvm_write_tsc_offset")
+
+            # interrupts
+            # self._host_tracer.enable_event("kvm/kvm_set_irq")
+            # self._host_tracer.enable_event("kvm/kvm_msi_set_irq")
+            # self._host_tracer.enable_event("kvm/kvm_inj_virq")
+            # self._host_tracer.enable_event("kvm/kvm_ioapic_set_irq")
+
+            # exit events, aggregated in the kernel with aggregate_exits
+            if not self._aggregate_exits:
+                self._host_tracer.enable_event("kvm/kvm_exit")
+                self._host_tracer.enable_event("kvm/kvm_entry")
+                # self._host_tracer.enable_event("kvm/kvm_userspace_exit")
+                self._host_tracer.enable_event("kvm/kvm_mmio")
+                self._host_tracer.enable_event("kvm/kvm_msr")
+
+            # sched
+            self._host_tracer.set_event_filter("sched/sched_switch", r'prev_comm ~ "*qemu*" || next_comm ~ "*qemu*"')
+            self._host_tracer.enable_event("sched/sched_switch")
+
+            # self._host_tracer.set_event_filter("sched/sched_wakeup", r'comm~"*qemu*"')
+            # self._host_tracer.enable_event("sched/sched_wakeup")
+
+            # self._host_tracer.set_event_filter("sched/sched_waking", r'comm~"*qemu*"')
+            # self._host_tracer.enable_event("sched/sched_waking")
+            # self._host_tracer.uprobe_add_event("p", "e1000_set_kick", self._vm.exe, "e1000_set_kick")
+            # self._host_tracer.uprobe_add_event("p", "e1000_kick_cb", self._vm.exe, "e1000_kick_cb")
+            # self._host_tracer.uprobe_add_event("p", "qemu_mutex_lock_iothread", self._vm.exe, "qemu_mutex_lock_iothread")
+            # self._host_tracer.uprobe_add_event("r", "qemu_mutex_lock_iothread_end", self._vm.exe, "qemu_mutex_lock_iothread")
+            # self._host_tracer.uprobe_add_event("p", "qemu_mutex_unlock_iothread", self._vm.exe, "qemu_mutex_unlock_iothread")
+            # self._host_tracer.uprobe_add_event("r", "qemu_mutex_unlock_iothread_end", self._vm.exe, "qemu_mutex_unlock_iothread")
+            self._host_tracer.enable_event("irq/irq_handler_entry")
+            self._host_tracer.enable_event("irq/irq_handler_exit")
+            self._host_tracer.enable_event("irq_vectors")
+
+            self._host_tracer.enable_event("syscalls")
+
+            # self._host_tracer.kprobe_add("p:import_iovec import_iovec")
+            # self._host_tracer.kprobe_add("r:import_iovec_end import_iovec")
+            # self._host_tracer.kprobe_add("p:tun_get_user tun_get_user")
+            # self._host_tracer.kprobe_add("r:tun_get_user_end tun_get_user")
+            #
+            # self._host_tracer.kprobe_add("p:netif_receive_skb netif_receive_skb")
+            # self._host_tracer.kprobe_add("r:netif_receive_skb_end netif_receive_skb")
+            # # self._host_tracer.enable_event("net/netif_receive_skb")
+            # # self._host_tracer.enable_event("net/netif_receive_skb_entry")
+            # # self._host_tracer.enable_event("net/netif_rx_ni_entry")
+
+            self._host_tracer.kprobe_enable()
+            self._host_tracer.uprobe_enable()
+            self._host_tracer.empty_trace()
+        if self._aggregate_exits:
+            self._exit_hist = self._host_tracer.exit_latency_hist_start()
+        if self._capture:
+            self._host_tracer.capture_start(cpus=[2], raw=self._raw, compress=self._capture_compress)
         self._host_tracer.trace_on()
 
     def guest_traces(self):
         assert self._guest_tracer is None
 
         self._guest_tracer = Trace(self._vm.root, os.path.join(self._dir, "trace_guest"))
-        self._guest_tracer.setup()
-        self._guest_tracer.set_buffer_size(600000)
-
-        self._guest_tracer.enable_event("power/cpu_idle")
-        self._guest_tracer.enable_event("syscalls/sys_enter_sendto")
-        # self._guest_tracer.enable_event("syscalls/sys_enter_recvfrom")
-        self._guest_tracer.enable_event("syscalls/sys_exit_recvfrom")
-
-        #sched
-        self._guest_tracer.set_event_filter("sched/sched_switch", r'prev_comm ~ "*netperf*" || next_comm ~ "*netperf*"')
-        self._guest_tracer.enable_event("sched/sched_switch")
-
-        # net
-        self._guest_tracer.enable_event("net/net_dev_start_xmit")
-        self._guest_tracer.enable_event("net/net_dev_xmit")
-        self._guest_tracer.enable_event("net/net_dev_recv_start")
-        self._guest_tracer.enable_event("net/net_dev_recv_end")
-
-        self._guest_tracer.enable_event("net/net_exit_before")
-        self._guest_tracer.enable_event("net/net_exit_after")
-
-        # irq
-        self._guest_tracer.enable_event("irq/irq_handler_entry")
-        self._guest_tracer.enable_event("irq/irq_handler_exit")
-        self._host_tracer.enable_event("irq_vectors")
-
-        self._guest_tracer.enable_event("napi")
-
-        # self._guest_tracer.enable_event("tcp/tcp_xmit_break")
-
-        self._guest_tracer.kprobe_add("p:recv_start virtnet_receive")
-        self._guest_tracer.kprobe_add("r:recv_end virtnet_receive")
-
-        self._guest_tracer.kprobe_add("p:recv_start e1000_clean_rx_irq")
-        self._guest_tracer.kprobe_add("r:recv_end e1000_clean_rx_irq")
-
-        self._guest_tracer.kprobe_add("p:napi_receive_start napi_gro_receive")
-        self._guest_tracer.kprobe_add("r:napi_receive_end napi_gro_receive")
-
-        self._guest_tracer.kprobe_add("p:e1000_update_stats e1000_update_stats")
-        self._guest_tracer.kprobe_add("r:e1000_update_stats_end e1000_update_stats")
-
-        # recieve checksum validation
-        self._guest_tracer.kprobe_add("p:dev_gro_receive dev_gro_receive")
-        self._guest_tracer.kprobe_add("r:dev_gro_receive_end dev_gro_receive")
-
-        # tcp stack boundries
-        self._guest_tracer.kprobe_add("p:netif_receive_skb_internal netif_receive_skb_internal")
-        self._guest_tracer.kprobe_add("r:netif_receive_skb_internal_end netif_receive_skb_internal")
-        self._guest_tracer.kprobe_add("p:dev_hard_start_xmit dev_hard_start_xmit")
-        self._guest_tracer.kprobe_add("r:dev_hard_start_xmit_end dev_hard_start_xmit")
-
-        # self._guest_tracer.kprobe_add("p:ip_rcv_finish ip_rcv_finish")
-        # self._guest_tracer.kprobe_add("r:ip_rcv_finish_end ip_rcv_finish")
-        # self._guest_tracer.kprobe_add("p:tcp_write_xmit tcp_write_xmit")
-        # self._guest_tracer.kprobe_add("r:tcp_write_xmit_end tcp_write_xmit")
-        #
-        # self._guest_tracer.kprobe_add("p:dev_queue_xmit dev_queue_xmit")
-        # self._guest_tracer.kprobe_add("r:dev_queue_xmit_end dev_queue_xmit")
-        #
-        # self._guest_tracer.kprobe_add("p:tcp_v4_rcv tcp_v4_rcv")
-        # self._guest_tracer.kprobe_add("r:tcp_v4_rcv_end tcp_v4_rcv")
-        #
-        # for n in ("tcp_v4_do_rcv", "tcp_rcv_established", "__tcp_push_pending_frames", "tcp_write_xmit"):
-        #     self._guest_tracer.kprobe_add("p:{name} {name}".format(name=n))
-        #     self._guest_tracer.kprobe_add("r:{name}_end {name}".format(name=n))
-
-        # self._guest_tracer.kprobe_add("p:validate_xmit_skb_list validate_xmit_skb_list")
-        # self._guest_tracer.kprobe_add("r:validate_xmit_skb_list_end validate_xmit_skb_list")
-
-        # self._guest_tracer.kprobe_add("p:tcp_ack tcp_ack")
-        # self._guest_tracer.kprobe_add("r:tcp_ack_end tcp_ack")
-
-        # self._guest_tracer.write_value("current_tracer", "function_graph")
-        # self._guest_tracer.write_value("set_graph_function", "netif_receive_skb_internal")
-
-        self._guest_tracer.kprobe_enable()
-        self._guest_tracer.uprobe_enable()
-
-        self._guest_tracer.empty_trace()
+        with self._guest_tracer.batch():
+            self._guest_tracer.setup()
+            self._guest_tracer.set_buffer_size(self._buffer_size(600000))
+
+            self._guest_tracer.enable_event("power/cpu_idle")
+            self._guest_tracer.enable_event("syscalls/sys_enter_sendto")
+            # self._guest_tracer.enable_event("syscalls/sys_enter_recvfrom")
+            self._guest_tracer.enable_event("syscalls/sys_exit_recvfrom")
+
+            #sched
+            self._guest_tracer.set_event_filter("sched/sched_switch", r'prev_comm ~ "*netperf*" || next_comm ~ "*netperf*"')
+            self._guest_tracer.enable_event("sched/sched_switch")
+
+            # net
+            self._guest_tracer.enable_event("net/net_dev_start_xmit")
+            self._guest_tracer.enable_event("net/net_dev_xmit")
+            self._guest_tracer.enable_event("net/net_dev_recv_start")
+            self._guest_tracer.enable_event("net/net_dev_recv_end")
+
+            self._guest_tracer.enable_event("net/net_exit_before")
+            self._guest_tracer.enable_event("net/net_exit_after")
+
+            # irq
+            self._guest_tracer.enable_event("irq/irq_handler_entry")
+            self._guest_tracer.enable_event("irq/irq_handler_exit")
+            self._host_tracer.enable_event("irq_vectors")
+
+            self._guest_tracer.enable_event("napi")
+
+            # self._guest_tracer.enable_event("tcp/tcp_xmit_break")
+
+            self._guest_tracer.kprobe_add("p:recv_start virtnet_receive")
+            self._guest_tracer.kprobe_add("r:recv_end virtnet_receive")
+
+            self._guest_tracer.kprobe_add("p:recv_start e1000_clean_rx_irq")
+            self._guest_tracer.kprobe_add("r:recv_end e1000_clean_rx_irq")
+
+            self._guest_tracer.kprobe_add("p:napi_receive_start napi_gro_receive")
+            self._guest_tracer.kprobe_add("r:napi_receive_end napi_gro_receive")
+
+            self._guest_tracer.kprobe_add("p:e1000_update_stats e1000_update_stats")
+            self._guest_tracer.kprobe_add("r:e1000_update_stats_end e1000_update_stats")
+
+            # recieve checksum validation
+            self._guest_tracer.kprobe_add("p:dev_gro_receive dev_gro_receive")
+            self._guest_tracer.kprobe_add("r:dev_gro_receive_end dev_gro_receive")
+
+            # tcp stack boundries
+            self._guest_tracer.kprobe_add("p:netif_receive_skb_internal netif_receive_skb_internal")
+            self._guest_tracer.kprobe_add("r:netif_receive_skb_internal_end netif_receive_skb_internal")
+            self._guest_tracer.kprobe_add("p:dev_hard_start_xmit dev_hard_start_xmit")
+            self._guest_tracer.kprobe_add("r:dev_hard_start_xmit_end dev_hard_start_xmit")
+
+            # self._guest_tracer.kprobe_add("p:ip_rcv_finish ip_rcv_finish")
+            # self._guest_tracer.kprobe_add("r:ip_rcv_finish_end ip_rcv_finish")
+            # self._guest_tracer.kprobe_add("p:tcp_write_xmit tcp_write_xmit")
+            # self._guest_tracer.kprobe_add("r:tcp_write_xmit_end tcp_write_xmit")
+            #
+            # self._guest_tracer.kprobe_add("p:dev_queue_xmit dev_queue_xmit")
+            # self._guest_tracer.kprobe_add("r:dev_queue_xmit_end dev_queue_xmit")
+            #
+            # self._guest_tracer.kprobe_add("p:tcp_v4_rcv tcp_v4_rcv")
+            # self._guest_tracer.kprobe_add("r:tcp_v4_rcv_end tcp_v4_rcv")
+            #
+            # for n in ("tcp_v4_do_rcv", "tcp_rcv_established", "__tcp_push_pending_frames", "tcp_write_xmit"):
+            #     self._guest_tracer.kprobe_add("p:{name} {name}".format(name=n))
+            #     self._guest_tracer.kprobe_add("r:{name}_end {name}".format(name=n))
+
+            # self._guest_tracer.kprobe_add("p:validate_xmit_skb_list validate_xmit_skb_list")
+            # self._guest_tracer.kprobe_add("r:validate_xmit_skb_list_end validate_xmit_skb_list")
+
+            # self._guest_tracer.kprobe_add("p:tcp_ack tcp_ack")
+            # self._guest_tracer.kprobe_add("r:tcp_ack_end tcp_ack")
+
+            # self._guest_tracer.write_value("current_tracer", "function_graph")
+            # self._guest_tracer.write_value("set_graph_function", "netif_receive_skb_internal")
+
+            self._guest_tracer.kprobe_enable()
+            self._guest_tracer.uprobe_enable()
+
+            self._guest_tracer.empty_trace()
+        if self._capture:
+            self._guest_tracer.capture_start(raw=self._raw, compress=self._capture_compress)
+        self._guest_tracer.trace_on()
+
+    def calibrate_buffers(self):
+        """
+        Replace the calibration buffer sizes with sizes measured on a short netperf run, only host cpu 2 is read:
+        the other host cpus keep a minimal buffer. Tracing is restarted
+        """
+        self._host_tracer.trace_off()
+        self._guest_tracer.trace_off()
+        self._host_tracer.calibration_start()
+        self._guest_tracer.calibration_start()
+
+        runtime = self._netperf.runtime
+        self._netperf.runtime = CALIBRATION_RUNTIME
+        try:
+            self._netperf.run_netperf(self._vm, msg_size=self._msg_size)
+        finally:
+            self._netperf.runtime = runtime
+        self._host_tracer.calibration_stop(float(runtime), cpus=[2])
+        self._guest_tracer.calibration_stop(float(runtime))
+
+        self._host_tracer.trace_on()
         self._guest_tracer.trace_on()
 
     def run_netperf(self, runtime=None):
@@ -251,6 +315,7 @@ class TracePerformance:
         self._host_tracer.trace_marker(TRACE_END_MSG, cpu=2)
         print("Netperf performance: %s" % (netperf_perf,))
         logger.info("Netperf performance: %s", netperf_perf)
+        return netperf_perf
 
     def copy_maps(self):
         try:
@@ -271,20 +336,41 @@ class TracePerformance:
             self.host_traces()
             self._vm.run()
             self.guest_traces()
-            self.run_netperf()
+            if self._calibrate:
+                if self._capture:
+                    logger.info("Buffer calibration is not needed with a capture, skipped")
+                else:
+                    self.calibrate_buffers()
+            if self._exit_hist is not None:
+                self._exit_hist.control("clear")
+            self._traced_perf = self.run_netperf()
+            if self._exit_hist is not None:
+                self._exit_hist.control("pause")
             self._host_tracer.trace_off()
             self._guest_tracer.trace_off()
 
             logger.info("Test again without traces:")
-            self.run_netperf(10)
-            self.run_netperf(10)
-            self.run_netperf(10)
+            self._untraced_perf = [self.run_netperf(10) for _ in range(3)]
 
         finally:
             try:
-                self._guest_tracer.read_trace_once(to_file=True)
-                self._host_tracer.read_trace_once(to_file=True, cpu="2")
+                if self._capture:
+                    stats = list(self._guest_tracer.capture_stop().values())
+                    stats += list(self._host_tracer.capture_stop().values())
+                    self._lost_events = sum(lost_events(cpu_stats) for cpu_stats in stats)
+                else:
+                    self._lost_events = (self._guest_tracer.check_overruns()[0] +
+                                         self._host_tracer.check_overruns(cpus=[2])[0])
+                    if self._raw:
+                        self._guest_tracer.read_trace_raw()
+                        self._host_tracer.read_trace_raw(cpus=[2])
+                    else:
+                        self._guest_tracer.read_trace_once(to_file=True)
+                        self._host_tracer.read_trace_once(to_file=True, cpu="2")
                 # self._host_tracer.read_trace_once(to_file=True, filename=os.path.join(self._dir, "full_trace"))
+                if self._exit_hist is not None:
+                    self._exit_hist.write_csv(os.path.join(self._dir, EXITS_HIST_FILE))
+                    self._host_tracer.exit_latency_hist_stop()
                 self._host_tracer.set_buffer_size(1000)
             except:
                 import traceback
@@ -296,15 +382,68 @@ class TracePerformance:
             except:
                 pass
 
+        if self._lost_events and self._fail_on_overrun:
+            raise RuntimeError("{} trace events were lost, the statistics would be wrong".format(self._lost_events))
         self.merge_traces()
+        save_overhead(self._dir, {"traced": self._traced_perf, "untraced": self._untraced_perf,
+                                  "probes": self.probes()})
+
+    def probes(self):
+        """
+        :return: dict of event key (see kernel_traces.overhead.event_key) -> probe kind, of the kprobes and uprobes
+        """
+        probes = dict()
+        for source, tracer in ((Event.EVENT_SOURCE_HOST, self._host_tracer),
+                               (Event.EVENT_SOURCE_GUEST, self._guest_tracer)):
+            if tracer is not None:
+                probes.update((event_key(source, name), kind) for name, kind in tracer.probes.items())
+        return probes
+
+    def update_overhead(self, stats):
+        """
+        Complete overhead.json (netperf results of the traced run and of the runs without tracing) with the per
+        event cost of the events stats looks at, the costs already in the file are kept
+        :return: the overhead dict, None without the netperf results
+        """
+        overhead = load_overhead(self._dir)
+        if not overhead or overhead.get("traced") is None or not overhead.get("untraced"):
+            logger.info("No netperf results in %s, the tracing overhead is unknown", self._dir)
+            return None
+        counts = stats.count_events()
+        costs = overhead.get("event_costs", {})
+        if all(event_key(*key) in costs for key in counts):
+            return overhead
+        start, end = self.trace_parser.test_window()
+        overhead = estimate_overhead(overhead["traced"], overhead["untraced"], counts, end - start,
+                                     event_costs=costs, probes=overhead.get("probes"))
+        save_overhead(self._dir, overhead)
+        logger.info("Tracing overhead: %.1f%% slower, %.0f cycles per event", overhead["slowdown"] * 100,
+                    overhead["event_cost"])
+        return overhead
 
     def stats(self):
-        new_stats = MainStats(self.trace_parser, os.path.join(self._dir, "new"), size=self._msg_size)
+        exits_hist = os.path.join(self._dir, EXITS_HIST_FILE)
+        if self._aggregate_exits or os.path.exists(exits_hist):
+            # the batches, the exit and the HW exit statistics are built from the kvm_exit events
+            logger.warning("The exits were aggregated in the kernel, not traced: no statistics, see %s", exits_hist)
+            return
+        new_stats = MainStats(self.trace_parser, os.path.join(self._dir, "new"), size=self._msg_size,
+                              online=self._online_stats)
         os.makedirs(os.path.join(self._dir, "new"), exist_ok=True)
         # new_stats.attr = "time_median"
         new_stats.attr = "time_avg"
         new_stats.run(new_stats.TYP_VIRTIO if "virtio" in self._vm.name else new_stats.TYP_E1000)
 
+        overhead = self.update_overhead(new_stats)
+        if self._corrected_stats and overhead is not None:
+            # same statistics, without the estimated cost of the tracing
+            corrected_dir = os.path.join(self._dir, "new_corrected")
+            os.makedirs(corrected_dir, exist_ok=True)
+            corrected_stats = MainStats(self.trace_parser, corrected_dir, size=self._msg_size,
+                                        event_costs=event_costs(overhead), online=self._online_stats)
+            corrected_stats.attr = new_stats.attr
+            corrected_stats.run(new_stats.TYP_VIRTIO if "virtio" in self._vm.name else new_stats.TYP_E1000)
+
         # exits_stats(self.trace_parser, self._dir, self._title)
         # if isinstance(self._netperf, NetPerfLatency):
         #     # Latency only
@@ -479,11 +618,38 @@ def create_arg_parser():
     arg_parser.add_argument("--name", default=None)
     arg_parser.add_argument("--multi", action="store_true", default=False)
     arg_parser.add_argument("--batch", action="store_true", default=False)
+    arg_parser.add_argument("--stream", help="Parse traces on the fly, without loading them to memory",
+                            action="store_true", default=False)
+    arg_parser.add_argument("--raw", help="Capture the binary ring buffers (trace_pipe_raw) instead of the text trace",
+                            action="store_true", default=False)
+    arg_parser.add_argument("--parse-processes", help="Parse the trace files in parallel (not with --multi)",
+                            type=int, default=None)
+    arg_parser.add_argument("--online-stats", help="Constant memory statistics (estimated median)",
+                            action="store_true", default=False)
+    arg_parser.add_argument("--pushdown", help="Drop the events the statistics ignore while parsing the traces",
+                            action="store_true", default=False)
+    arg_parser.add_argument("--capture", help="Drain the per cpu trace buffers while tracing (with --raw, the binary "
+                                              "buffers), reports lost events",
+                            action="store_true", default=False)
+    arg_parser.add_argument("--capture-compress", help="Compress the captured traces on the traced machine",
+                            action="store_true", default=False)
+    arg_parser.add_argument("--aggregate-exits", help="Aggregate the exit latency per exit reason in the kernel (hist "
+                                                     "triggers, exits_hist.csv) instead of tracing every exit, "
+                                                     "the statistics (new/) are not computed",
+                            action="store_true", default=False)
+    arg_parser.add_argument("--calibrate", help="Size the trace buffers from the event rate of a short run",
+                            action="store_true", default=False)
+    arg_parser.add_argument("--fail-on-overrun", help="Fail the run when trace events were lost",
+                            action="store_true", default=False)
+    arg_parser.add_argument("--corrected-stats", help="Also write the statistics without the estimated tracing cost "
+                                                     "(new_corrected, see overhead.json)",
+                            action="store_true", default=False)
     arg_parser.add_argument("directory")
     return arg_parser
 
 
-def stats_only(vm, netperf, msg_size, directory, title, auto_dir, name):
+def stats_only(vm, netperf, msg_size, directory, title, auto_dir, name, stream=False, online_stats=False,
+               pushdown=False, corrected_stats=False):
     perf = TracePerformance(vm=vm,
                             netperf=netperf,
                             msg_size=msg_size,
@@ -491,6 +657,10 @@ def stats_only(vm, netperf, msg_size, directory, title, auto_dir, name):
                             title=vm,
                             auto_dir=auto_dir,
                             name=name,
+                            stream=stream,
+                            online_stats=online_stats,
+                            pushdown=pushdown,
+                            corrected_stats=corrected_stats,
                             )
     perf.init_env(False)
     perf.stats()
@@ -529,6 +699,17 @@ def runner(args):
                                 title=args.vm,
                                 auto_dir=args.auto_dir,
                                 name=args.name,
+                                stream=args.stream,
+                                raw=args.raw,
+                                processes=args.parse_processes,
+                                online_stats=args.online_stats,
+                                pushdown=args.pushdown,
+                                capture=args.capture,
+                                capture_compress=args.capture_compress,
+                                aggregate_exits=args.aggregate_exits,
+                                calibrate=args.calibrate,
+                                fail_on_overrun=args.fail_on_overrun,
+                                corrected_stats=args.corrected_stats,
                                 )
         if not args.stats_only:
                 perf.init_env(True)
@@ -547,6 +728,10 @@ def runner(args):
                              title=args.vm,
                              auto_dir=args.auto_dir,
                              name=args.name,
+                             stream=args.stream,
+                             online_stats=args.online_stats,
+                             pushdown=args.pushdown,
+                             corrected_stats=args.corrected_stats,
                              )
         pool = multiprocessing.Pool(processes=4)
         for size in MSG_SIZES:
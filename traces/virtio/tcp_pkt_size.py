@@ -157,14 +157,14 @@ def main(directory=None, netperf_msg_size=None):
 
 def trace2csv(dirname):
     traces = TraceFile(os.path.join(dirname, "trace_guest"))
-    traces.parse()
-    start, end = [n for n, e in enumerate(traces.events) if e.event == 'tracing_mark_write']
+    c = Counter()
     once = True
     with open(os.path.join(dirname, "virtio-pkt_size.csv"), "w") as csvfile:
         csvwritter = csv.writer(csvfile)
         csvwritter.writerow(("timestamp", "segment size"))
 
-        for event in traces.events[start:end+1]:
+        prev_event = None
+        for event in traces.iter_marked_events():
             if event.event == "net_dev_xmit":
                 content = [event.timestamp] + \
                     [field.split("=")[1]
@@ -176,7 +176,10 @@ def trace2csv(dirname):
                     once = False
                 csvwritter.writerow(content)
 
-    c = Counter((e.event for e in traces.events[start:end]))
+            if prev_event is not None:
+                c[prev_event.event] += 1
+            prev_event = event
+
     logger.info(c)
 
 
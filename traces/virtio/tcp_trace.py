@@ -2,11 +2,11 @@ import csv
 import logging
 import os
 import shutil
-from collections import Counter
 from math import log2
 
 from kernel_traces.kernel_trace import Trace
-from kernel_traces.trace_parser import Traces, TRACE_BEGIN_MSG, TRACE_END_MSG, delta2time, TraceFile
+from kernel_traces.trace_parser import Traces, TRACE_BEGIN_MSG, TRACE_END_MSG, delta2time, TraceFile, \
+    tcp_events2csv
 from sensors.netperf import NetPerfLatency, NetPerfTCP, netserver_start, netserver_stop
 from utils.machine import localRoot
 from utils.shell_utils import run_command_async
@@ -156,37 +156,19 @@ def main(directory=None, netperf_msg_size=None):
 
 def trace2csv(dirname):
     traces = TraceFile(os.path.join(dirname, "trace_guest"))
-    traces.parse()
-    start, end = [n for n, e in enumerate(traces.events) if e.event == 'tracing_mark_write']
 
-    with open(os.path.join(dirname, "virtio-calling.csv"), "w") as csvfile:
-        csvwritter = csv.writer(csvfile)
-        csvwritter.writerow(("timestamp", "cwnd", "inflight", "mss_now", "pacing_rate", "sk_wmem_alloc"))
+    with open(os.path.join(dirname, "virtio-calling.csv"), "w") as calling_file, \
+            open(os.path.join(dirname, "virtio-sending.csv"), "w") as sending_file, \
+            open(os.path.join(dirname, "virtio-waiting.csv"), "w") as waiting_file:
+        calling_writter = csv.writer(calling_file)
+        calling_writter.writerow(("timestamp", "cwnd", "inflight", "mss_now", "pacing_rate", "sk_wmem_alloc"))
+        sending_writter = csv.writer(sending_file)
+        sending_writter.writerow(("timestamp", "cwnd", "inflight", "mss_now", "pacing_rate"))
+        waiting_writter = csv.writer(waiting_file)
+        waiting_writter.writerow(("timestamp", "wmem_queued", "sndbuf", "is_sleep"))
 
-        for event in traces.events[start:end+1]:
-            if event.event == "tcp_send_info":
-                content = [event.timestamp] + [field.split("=")[1] for field in event.info.split(",")]
-                csvwritter.writerow(content)
+        c = tcp_events2csv(traces, calling_writter, sending_writter, waiting_writter)
 
-    with open(os.path.join(dirname, "virtio-sending.csv"), "w") as csvfile:
-        csvwritter = csv.writer(csvfile)
-        csvwritter.writerow(("timestamp", "cwnd", "inflight", "mss_now", "pacing_rate"))
-
-        for event, next_event in zip(traces.events[start:end], traces.events[start+1:end+1]):
-            if event.event == "tcp_send_info" and next_event.event == "tcp_sending":
-                content = [event.timestamp] + [field.split("=")[1] for field in event.info.split(",")]
-                csvwritter.writerow(content)
-
-    with open(os.path.join(dirname, "virtio-waiting.csv"), "w") as csvfile:
-        csvwritter = csv.writer(csvfile)
-        csvwritter.writerow(("timestamp", "wmem_queued", "sndbuf", "is_sleep"))
-
-        for event in traces.events[start:end+1]:
-            if event.event == "tcp_wait_for_memory":
-                content = [event.timestamp] + [field.split("=")[1] for field in event.info.split(",")]
-                csvwritter.writerow(content)
-
-    c = Counter((e.event for e in traces.events[start:end]))
     logger.info(c)
 
 
@@ -1,12 +1,19 @@
 import logging
+import os
+import shlex
 import socket
+import subprocess
 
-from utils.shell_utils import run_command_remote, run_prepare_command, run_command_remote_ex
+from utils.shell_utils import run_command_remote, run_prepare_command, run_command_remote_ex, ssh_master_start, \
+    ssh_master_stop, run_command_output, run_command_ex
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
 class Machine:
+    # the files of the machine can be read and written with read_file() / write_file() (see LocalRoot)
+    direct_files = False
+
     def __init__(self, remote_ip, remote_user):
         self._user = remote_user
         self._remote_ip = remote_ip
@@ -44,6 +51,20 @@ class Machine:
     def remote_root_command(self, command, **kargs):
         return run_command_remote(self._remote_ip, "root", command, **kargs)
 
+    def connect(self):
+        """
+        Open the shared ssh connections (user and root) ahead of the first remote command
+        """
+        for user in {self._user, "root"}:
+            ssh_master_start(self._remote_ip, user)
+
+    def disconnect(self):
+        """
+        Close the shared ssh connections, before the machine goes away (shutdown, reboot)
+        """
+        for user in {self._user, "root"}:
+            ssh_master_stop(self._remote_ip, user)
+
     def get_info(self, old_info=None) -> dict:
         ENABLED = "enabled"
         if not self.enabled and old_info is None:
@@ -53,11 +74,63 @@ class Machine:
 
 
 class LocalRoot(Machine):
+    """
+    The host itself: the commands run locally (through sudo when not root) instead of through ssh to 127.0.0.1,
+    and when running as root the files (sysfs, tracefs) are read and written directly
+    """
     def __init__(self):
         super().__init__("127.0.0.1", "root")
         self.name = "localhost"
         self.netserver_enabled = False
 
+    @property
+    def direct_files(self):
+        return os.geteuid() == 0
+
+    def _shell_command(self, command):
+        return "{sudo}sh -c {command}".format(sudo="" if os.geteuid() == 0 else "sudo ",
+                                              command=shlex.quote(command))
+
+    def remote_command(self, command, **kargs):
+        return run_command_output(self._shell_command(command), **kargs)
+
+    def remote_command_prepare(self, command):
+        return self._shell_command(command)
+
+    def remote_command_ex(self, command):
+        return run_command_ex(self._shell_command(command))
+
+    def remote_root_command(self, command, **kargs):
+        return self.remote_command(command, **kargs)
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def read_file(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def write_file(self, path, text, append=False, cpu=None):
+        """
+        Write text to path in a single write (as echo does), from cpu if given.
+        Errors are raised as subprocess.CalledProcessError, like a failed remote command.
+        """
+        old_affinity = None
+        try:
+            if cpu is not None:
+                old_affinity = os.sched_getaffinity(0)
+                os.sched_setaffinity(0, {int(cpu)})
+            with open(path, "a" if append else "w") as f:
+                f.write(text)
+        except OSError as e:
+            raise subprocess.CalledProcessError(1, "write {!r} to {}: {}".format(text, path, e)) from e
+        finally:
+            if old_affinity is not None:
+                os.sched_setaffinity(0, old_affinity)
+
     def get_info(self, old_info=None):
         info = dict()
         info["kernel_version"] = self.remote_command("uname -r")
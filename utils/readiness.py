@@ -0,0 +1,31 @@
+import logging
+import socket
+from time import monotonic, sleep
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def wait_until(condition, timeout, interval=0.2, description="condition"):
+    """
+    Poll condition() until it returns a true value
+    :return: the value returned by condition()
+    :raise TimeoutError: after timeout seconds
+    """
+    start = monotonic()
+    while True:
+        result = condition()
+        if result:
+            logger.debug("%s after %.1f seconds", description, monotonic() - start)
+            return result
+        if monotonic() - start > timeout:
+            raise TimeoutError("Timeout ({}s) waiting for {}".format(timeout, description))
+        sleep(interval)
+
+
+def tcp_port_open(host, port, timeout=1.0):
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
@@ -2,10 +2,17 @@ import logging
 import subprocess
 import shlex
 import os
+import tempfile
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# remote commands share a master ssh connection per user@host (ControlMaster), kept open SSH_CONTROL_PERSIST seconds
+# after its last use: a command opens a session on the connection instead of a new connection and handshake
+SSH_MULTIPLEX = True
+SSH_CONTROL_DIR = os.path.join(tempfile.gettempdir(), "ssh-mux-{}".format(os.getuid()))
+SSH_CONTROL_PERSIST = 600
+
 def disable_signal():
     os.setpgrp()
 
@@ -33,25 +40,84 @@ def run_command_check(command_string, shell=False, cwd=None):
     return subprocess.check_call(cmd, shell=shell, cwd=cwd, preexec_fn=disable_signal)
 
 
-def run_command_output(command_string, shell=False, log_output=True, cwd=None):
+def run_command_output(command_string, shell=False, log_output=True, cwd=None, input=None, timeout=None):
+    """
+    :param input: text passed to the command stdin (e.g. a script for "sh -s")
+    :param timeout: seconds, subprocess.TimeoutExpired is raised after it
+    """
     logger.debug("Run command (checked): %s", command_string)
     if shell:
         args = command_string
     else:
         args = shlex.split(command_string)
-    output = subprocess.check_output(args, shell=shell, cwd=cwd, preexec_fn=disable_signal, stdin=subprocess.DEVNULL)
+    if input is not None:
+        output = subprocess.check_output(args, shell=shell, cwd=cwd, preexec_fn=disable_signal, input=input.encode(),
+                                         timeout=timeout)
+    else:
+        output = subprocess.check_output(args, shell=shell, cwd=cwd, preexec_fn=disable_signal,
+                                         stdin=subprocess.DEVNULL, timeout=timeout)
     if log_output:
         logger.debug("Command output: %s", output)
     return output.decode()
 
 
-def run_prepare_command(servername, user, command):
-    full_command = 'ssh -o "StrictHostKeyChecking no" {user}@{host} \'{command}\''.format(host=servername, user=user, command=command)
+def ssh_options():
+    options = '-o "StrictHostKeyChecking no"'
+    if SSH_MULTIPLEX:
+        os.makedirs(SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
+        # %C: hash of the local host, remote host, port and user, short enough for a unix socket path
+        options += " -o ControlMaster=auto -o ControlPath={} -o ControlPersist={}".format(
+            os.path.join(SSH_CONTROL_DIR, "%C"), SSH_CONTROL_PERSIST)
+    return options
+
+
+def run_prepare_command(servername, user, command, extra_options=""):
+    """
+    :param extra_options: more ssh options, e.g. "-o BatchMode=yes"
+    """
+    options = ssh_options()
+    if extra_options:
+        options += " " + extra_options
+    full_command = 'ssh {options} {user}@{host} \'{command}\''.format(options=options, host=servername,
+                                                                       user=user, command=command)
     return full_command
 
 
-def run_command_remote(servername, user, command, **kargs):
-    full_command = run_prepare_command(servername, user, command)
+def ssh_master_start(servername, user):
+    """
+    Open the master connection to user@servername in the background (the first remote command opens it otherwise)
+    """
+    if not SSH_MULTIPLEX or _ssh_control("check", servername, user) == 0:
+        return
+    command = "ssh {options} -N -f {user}@{host}".format(options=ssh_options(), user=user, host=servername)
+    logger.debug("Run command: %s", command)
+    subprocess.call(shlex.split(command), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL, preexec_fn=disable_signal)
+
+
+def ssh_master_stop(servername, user):
+    """
+    Close the master connection to user@servername, if any. Do it before the machine goes away, or the next
+    commands wait for the dead connection to time out.
+    """
+    if SSH_MULTIPLEX:
+        _ssh_control("exit", servername, user)
+
+
+def _ssh_control(operation, servername, user):
+    """
+    ssh -O operation on the master connection to user@servername
+    :return: ssh exit code
+    """
+    command = "ssh {options} -O {operation} {user}@{host}".format(options=ssh_options(), operation=operation,
+                                                                   user=user, host=servername)
+    logger.debug("Run command: %s", command)
+    return subprocess.call(shlex.split(command), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, preexec_fn=disable_signal)
+
+
+def run_command_remote(servername, user, command, extra_options="", **kargs):
+    full_command = run_prepare_command(servername, user, command, extra_options)
     return run_command_output(full_command, **kargs)
 
 
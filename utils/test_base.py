@@ -1,7 +1,6 @@
 import json
 import os
 from collections import defaultdict
-from time import sleep
 
 from utils.machine import localRoot
 from utils.vms import VM
@@ -14,6 +13,8 @@ logger.setLevel(logging.DEBUG)
 
 class TestBase:
     DIR = ""
+    # keep the VM running for the next one when it can be reconfigured, see VM.take_over()
+    REUSE_VMS = False
 
     def __init__(self, retries: int, directory=None, all_x=True, additional_x=None, ):
         self.dir = self.DIR
@@ -85,15 +86,42 @@ class TestBase:
                               values=[size for size, _ in self._x_categories])
 
     def run(self):
-        for vm, vm_name in self._vms:
-            if vm.enabled:
-                self.run_vm(vm, vm_name)
-            else:
-                self.load_old_vm_data(vm, vm_name)
-
-    def run_vm(self, vm, vm_name):
+        running = None
+        try:
+            for vm, vm_name in self._vms:
+                if vm.enabled:
+                    # handed over to run_vm(), which starts vm in its place or tears it down
+                    previous, running = running, None
+                    running = self.run_vm(vm, vm_name, previous)
+                else:
+                    self.load_old_vm_data(vm, vm_name)
+        finally:
+            if running is not None:
+                running.teardown()
+
+    def start_vm(self, vm, running=None):
+        """
+        Start vm, or reconfigure the VM left running by the previous test to it
+        """
+        if running is not None and vm.can_take_over(running):
+            try:
+                vm.take_over(running)
+            except:
+                vm.teardown()
+                raise
+            return
+        if running is not None:
+            running.teardown()
         vm.setup()
         vm.run()
+
+    def run_vm(self, vm, vm_name, running=None):
+        """
+        :param running: VM left running by the previous test
+        :return: the VM left running for the next test (REUSE_VMS), None if it was torn down
+        """
+        self.start_vm(vm, running)
+        keep_running = False
         try:
             for x_value, x_value_name in self._x_categories:
                 for i in range(self._retries):
@@ -111,6 +139,7 @@ class TestBase:
                             sensor.test_after(vm, vm_name, x_value)
                         except:
                             logger.error("Exception: ", exc_info=True)
+            keep_running = self.REUSE_VMS
         except KeyboardInterrupt:
             pass
         except:
@@ -119,7 +148,9 @@ class TestBase:
         finally:
             if self._stop_after_test:
                 input("Press Enter to continue")
-            vm.teardown()
+            if not keep_running:
+                vm.teardown()
+        return vm if keep_running else None
 
     def load_old_vm_data(self, vm, vm_name):
         for sensor in self._sensors:
@@ -192,5 +223,4 @@ class TestBase2VM(TestBaseNetperf):
             finally:
                 vm2.teardown()
                 vm1.teardown()
-                sleep(10)
 
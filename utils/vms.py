@@ -1,11 +1,18 @@
+import hashlib
+import json
 import logging
 import os
-from subprocess import CalledProcessError
+import shlex
+import shutil
+import tempfile
+from math import ceil
+from subprocess import CalledProcessError, TimeoutExpired
 
-from qemu.qmp import QEMUMonitorProtocol
+from qemu.qmp import QEMUMonitorProtocol, QMPError, QMPTimeoutError
 from utils.machine import Machine, localRoot
-from utils.shell_utils import run_command_output, run_command_check, run_command_remote, run_command_async, run_command
-from time import sleep
+from utils.readiness import wait_until, tcp_port_open
+from utils.shell_utils import run_command_output, run_command_check, run_command_async, run_command
+from time import sleep, time
 from tempfile import NamedTemporaryFile
 import signal
 
@@ -18,6 +25,11 @@ class VM(Machine):
     BOOTUP_WAIT = 50  # 15
     POWEROFF_WAIT = 3
     USER = "user"
+    # the guest is probed until it accepts ssh commands, bootwait is the fixed wait used when boot_probe is off
+    BOOT_TIMEOUT = 300
+    BOOT_POLL_INTERVAL = 0.5
+    SSH_PORT = 22
+    SSH_PROBE_TIMEOUT = 10  # seconds, for a single readiness probe
 
     def __init__(self, path, guest_ip, host_ip):
         super(VM, self).__init__(guest_ip, self.USER)
@@ -25,6 +37,7 @@ class VM(Machine):
         self.ip_guest = guest_ip
         self.ip_host = host_ip
         self.bootwait = self.BOOTUP_WAIT
+        self.boot_probe = True
         self.netperf_test_params = ""
         self.guest_configure_commands = list()
 
@@ -47,12 +60,47 @@ class VM(Machine):
 
     def shutdown(self):
         self.remote_root_command("poweroff")
+        self.disconnect()
         sleep(self.POWEROFF_WAIT)
 
+    def wait_for_boot(self):
+        """
+        Wait for the guest to be usable: its sshd accepts connections and runs commands
+        """
+        wait_until(self._guest_ready, self.BOOT_TIMEOUT, self.BOOT_POLL_INTERVAL, "{} to boot".format(self))
+
+    def _guest_ready(self):
+        if not tcp_port_open(self.ip_guest, self.SSH_PORT):
+            return False
+        try:
+            # a stalled sshd or a password prompt must not block the polling
+            self.remote_command("true", log_output=False, timeout=self.SSH_PROBE_TIMEOUT,
+                                extra_options="-o ConnectTimeout={} -o BatchMode=yes".format(
+                                    max(1, ceil(self.BOOT_POLL_INTERVAL))))
+        except (CalledProcessError, TimeoutExpired):
+            return False
+        return True
+
+    def can_take_over(self, other):
+        """
+        :return: True if the running VM other can be reconfigured to this VM, see take_over()
+        """
+        return False
+
+    def take_over(self, other):
+        """
+        Take over the running guest of other instead of setup() / run(): this VM is torn down in its place
+        """
+        raise NotImplementedError()
+
     def run(self, configure_guest=True):
         logger.info("Running VM: %s", self)
         self._run()
-        sleep(self.bootwait)
+        if self.boot_probe:
+            self.wait_for_boot()
+        else:
+            sleep(self.bootwait)
+        self.connect()
         if configure_guest:
             self.configure_guest()
 
@@ -66,6 +114,17 @@ class Qemu(VM):
     QEMU_VIRTIO = "virtio-net-pci"
 
     BOOTUP_WAIT = 30
+    QMP_ADDRESS = ('127.0.0.1', 1235)
+    NIC_ID = "nic0"
+    QEMU_START_TIMEOUT = 30
+    QEMU_POLL_INTERVAL = 0.1
+    # shutdown: wait for the guest to power off, then QMP quit, then SIGKILL
+    POWEROFF_TIMEOUT = 30
+    QUIT_TIMEOUT = 5
+    TAP_RELEASE_TIMEOUT = 5
+    # fast_start: saved guest states, see _run_from_snapshot()
+    SNAPSHOT_DIR = r"../vms/snapshots"
+    SNAPSHOT_TIMEOUT = 120
 
     def __init__(self, disk_path, guest_ip, host_ip, cpu_to_pin="2"):
         super(Qemu, self).__init__(disk_path, guest_ip, host_ip)
@@ -112,6 +171,10 @@ class Qemu(VM):
 
         self.guest_e1000_ng_flag = 0
 
+        # boot once per configuration and restore the saved guest state afterwards
+        self.fast_start = False
+        self._run_disk = None
+
         self.qmp = None
 
     def get_info(self, old_info=None):
@@ -174,12 +237,15 @@ class Qemu(VM):
     def delete_tun(self):
         if self.bridge:
             run_command("sudo brctl delif {br} {iff}".format(br=self.bridge, iff=self.tap_device))
-        while True:
+
+        def release():
             try:
                 run_command_check("sudo tunctl -d {tap}".format(tap=self.tap_device))
-                break
-            except:
-                sleep(1)
+            except CalledProcessError:
+                return False
+            return True
+        # qemu has exited, its tap file descriptor is closed
+        wait_until(release, self.TAP_RELEASE_TIMEOUT, self.QEMU_POLL_INTERVAL, "{} release".format(self.tap_device))
 
     def load_kvm(self):
         run_command_check("sudo modprobe kvm-intel")
@@ -187,7 +253,6 @@ class Qemu(VM):
             run_command_check("echo 0 | sudo tee /sys/module/kvm/parameters/halt_poll_ns")
 
     def unload_kvm(self):
-        sleep(1)
         run_command("sudo modprobe -r kvm-intel")
 
     def _clean_cpu(self):
@@ -212,22 +277,44 @@ class Qemu(VM):
             self.qmp.close()
         except:
             pass
-        self.qmp = QEMUMonitorProtocol(('127.0.0.1', 1235))
+        self.qmp = QEMUMonitorProtocol(self.QMP_ADDRESS)
         self._pid = None
+        if self._run_disk:
+            os.remove(self._run_disk)
+            self._run_disk = None
         self._reset_host_configuration()
-        sleep(20)
         self.delete_tun()
-        sleep(2)
         self.unload_kvm()
         super().teardown()
 
     def _get_temp_nic_additional(self):
         return ""
 
+    def _nic_device(self, pci_address=None):
+        """
+        -device / device_add argument of the NIC
+        """
+        device = "{dev_type},id={nic_id},netdev=net0,mac={mac}".format(dev_type=self.ethernet_dev, nic_id=self.NIC_ID,
+                                                                       mac=self.mac_address)
+        if pci_address:
+            device += ",addr={}".format(pci_address)
+        return device + self.nic_additionals + self._get_temp_nic_additional()
+
+    def _kernel_append(self):
+        kernel_command_line = self.kernel_cmdline_additional
+        if "e1000.NG_flags" not in self.kernel_cmdline_additional and self.guest_e1000_ng_flag != 0:
+            kernel_command_line += " e1000.NG_flags={}".format(self.guest_e1000_ng_flag)
+        return "{} {}".format(self.kernel_cmdline, kernel_command_line)
+
     def _run(self):
         assert self.exe
+        if self.fast_start:
+            self._run_from_snapshot()
+        else:
+            self._start_qemu(self.path)
+        self._configure_qemu()
 
-        self.qmp = QEMUMonitorProtocol(('127.0.0.1', 1235))
+    def _start_qemu(self, disk, incoming=None, timeout=None):
         self.pidfile = NamedTemporaryFile()
 
         if self.vhost:
@@ -247,15 +334,11 @@ class Qemu(VM):
         self.pidfile = NamedTemporaryFile()
 
         kernel_spicific_boot = ""
-        kernel_command_line = self.kernel_cmdline_additional
-        if "e1000.NG_flags" not in self.kernel_cmdline_additional and self.guest_e1000_ng_flag != 0:
-            kernel_command_line += " e1000.NG_flags={}".format(self.guest_e1000_ng_flag)
         if self.kernel:
-            kernel_spicific_boot = "-kernel {kernel} -initrd {initrd} -append '{cmdline} {cmdline_more}'".format(
+            kernel_spicific_boot = "-kernel {kernel} -initrd {initrd} -append '{cmdline}'".format(
                 kernel=self.kernel,
                 initrd=self.initrd,
-                cmdline=self.kernel_cmdline,
-                cmdline_more=kernel_command_line
+                cmdline=self._kernel_append(),
             )
 
         qemu_command = "numactl -C {cpu} -m 0 {qemu_exe} -enable-kvm {sidecore} -k en-us -m {mem} " \
@@ -265,47 +348,247 @@ class Qemu(VM):
                        "-device virtio-blk-pci,scsi=off,bus=pci.0,addr=0x5,drive=drive-virtio-disk0,id=virtio-disk0,bootindex=1 " \
                        "-netdev tap,ifname={tap},id=net0,script=no{vhost} " \
                        "-object iothread,id=iothread0 " \
-                       "-device {dev_type},netdev=net0,mac={mac}{nic_additionals} " \
+                       "-device {nic} " \
                        "-vnc :{vnc} " \
                        "-pidfile {pidfile} " \
                        "-monitor tcp:127.0.0.1:1234,server,nowait,nodelay " \
                        "-qmp tcp:127.0.0.1:1235,server,nowait,nodelay " \
-                       "".format(  # -monitor tcp:1234,server,nowait,nodelay
+                       "{incoming}".format(  # -monitor tcp:1234,server,nowait,nodelay
             cpu=self.cpu_to_pin,
             qemu_exe=self.exe,
             sidecore=sidecore_param,
             kernel_additions=kernel_spicific_boot,
             qemu_additionals=self.qemu_additionals,
-            disk=self.path,
+            disk=disk,
             tap=self.tap_device,
             vhost=vhost_param,
-            dev_type=self.ethernet_dev,
-            mac=self.mac_address,
-            nic_additionals=self.nic_additionals + self._get_temp_nic_additional(),
+            nic=self._nic_device(),
             pidfile=self.pidfile.name,
             vnc=self.vnc_number,
             mem=self.mem,
+            incoming="-incoming {}".format(shlex.quote(incoming)) if incoming else "",
 #                       "-pidfile {pidfile} " \
 
             
         )
         run_command_async(qemu_command)
-        sleep(1)
+        self.wait_for_qemu(timeout)
+
+    def _configure_qemu(self):
+        """
+        Host side settings of the started qemu
+        """
         if self.qemu_config:
             self.change_qemu_parameters()
-        sleep(1)
         if self.io_thread_cpu:
             command = "sudo taskset -p -c {} {}".format(self.io_thread_cpu, self.get_pid())
             run_command_check(command)
         if self.is_io_thread_nice:
             self.set_iothread_nice()
-        sleep(1)
-        self.qmp.connect()
+
+    def wait_for_qemu(self, timeout=None):
+        """
+        Wait for qemu to finish its initialization: the pidfile is written and the QMP monitor reports the machine
+        running (the main loop is up, the SIGUSR1 handler of change_qemu_parameters() is installed)
+        :param timeout: of the machine running, longer for an incoming state
+        """
+        wait_until(self._read_pid, self.QEMU_START_TIMEOUT, self.QEMU_POLL_INTERVAL, "the qemu pidfile")
+        self.qmp = wait_until(self._qmp_connect, self.QEMU_START_TIMEOUT, self.QEMU_POLL_INTERVAL, "the qemu QMP")
+        wait_until(self._machine_running, timeout or self.QEMU_START_TIMEOUT, self.QEMU_POLL_INTERVAL,
+                   "qemu to run")
+
+    def _machine_running(self):
+        status = self.qmp.command("query-status")
+        if status["status"] == "paused":
+            # the incoming state was saved stopped
+            self.qmp.command("cont")
+        return status["running"]
+
+    def snapshot_key(self):
+        """
+        Hash of the configuration the saved guest state depends on: the files used (by path, size and mtime, a
+        change of the disk invalidates its states) and the machine / devices of the qemu command line
+        """
+        def file_id(path):
+            if not path:
+                return None
+            stat = os.stat(path)
+            return os.path.realpath(path), stat.st_size, stat.st_mtime_ns
+
+        config = {
+            "exe": file_id(shutil.which(self.exe) or self.exe),
+            "disk": file_id(self.path),
+            "kernel": file_id(self.kernel),
+            "initrd": file_id(self.initrd) if self.kernel else None,
+            "cmdline": self._kernel_append() if self.kernel else None,
+            "mem": self.mem,
+            "nic": self._nic_device(),
+            "vhost": self.vhost,
+            "sidecore": self.sidecore,
+            "qemu_additionals": self.qemu_additionals,
+        }
+        return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+    def _run_from_snapshot(self):
+        """
+        Start from the guest state saved for this configuration, booting and saving it first if there is none.
+        A snapshot is a qcow2 overlay of the disk and the migration stream of the guest (saved stopped, right after
+        the boot); every run writes to a new overlay on top of it, the snapshot itself is never modified.
+        """
+        directory = os.path.join(self.SNAPSHOT_DIR, self.snapshot_key())
+        if not os.path.exists(directory):
+            self._save_snapshot(directory)
+
+        fd, self._run_disk = tempfile.mkstemp(suffix=".qcow2", dir=self.SNAPSHOT_DIR)
+        os.close(fd)
+        self._create_overlay(os.path.join(directory, "disk.qcow2"), self._run_disk)
+        logger.info("Restoring VM %s from %s", self, directory)
+        try:
+            self._start_qemu(self._run_disk, incoming="exec:cat {}".format(os.path.join(directory, "state")),
+                             timeout=self.SNAPSHOT_TIMEOUT)
+        except (OSError, RuntimeError, QMPError):
+            # the incoming state was not loaded: qemu exited, closed the QMP connection or timed out
+            logger.error("Failed to restore %s, removing it", directory)
+            shutil.rmtree(directory)
+            raise
+
+    def _save_snapshot(self, directory):
+        logger.info("Booting VM %s to save its state in %s", self, directory)
+        partial = directory + ".partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        self._create_overlay(self.path, os.path.join(partial, "disk.qcow2"))
+        self._start_qemu(os.path.join(partial, "disk.qcow2"))
+        self._configure_qemu()
+        VM.wait_for_boot(self)
+
+        self.disconnect()
+        self.qmp.command("stop")
+        self.qmp.command("migrate", uri="exec:cat > {}".format(os.path.join(partial, "state")))
+        wait_until(self._migration_completed, self.SNAPSHOT_TIMEOUT, self.QEMU_POLL_INTERVAL, "the state to be saved")
+        self.qmp.cmd("quit")
+        if not self._wait_for_exit(self.QUIT_TIMEOUT):
+            raise RuntimeError("qemu did not quit after saving the state of {}".format(self))
+        self.qmp.close()
+        self._pid = None
+        os.rename(partial, directory)
+
+    def _migration_completed(self):
+        status = self.qmp.command("query-migrate").get("status")
+        if status in ("failed", "cancelled"):
+            raise RuntimeError("Saving the state of {} {}".format(self, status))
+        return status == "completed"
+
+    @staticmethod
+    def _create_overlay(backing_file, overlay):
+        run_command_check("qemu-img create -q -f qcow2 -b {} -F qcow2 {}".format(
+            shlex.quote(os.path.abspath(backing_file)), shlex.quote(overlay)))
+
+    def wait_for_boot(self):
+        super().wait_for_boot()
+        if self._run_disk:
+            # the guest clock stopped when its state was saved
+            self.remote_root_command("date -s @{}".format(int(time())))
+
+    def shutdown(self):
+        """
+        Power the guest off and wait for qemu to exit: the QMP SHUTDOWN event is waited for POWEROFF_TIMEOUT, then
+        qemu is asked to quit and finally killed
+        """
+        if not self.is_running():
+            return
+        try:
+            self.remote_root_command("poweroff")
+        except CalledProcessError:
+            # the connection is often closed by the poweroff itself
+            pass
+        self.disconnect()
+
+        if self._wait_for_shutdown_event(self.POWEROFF_TIMEOUT) and self._wait_for_exit(self.QUIT_TIMEOUT):
+            return
+        logger.warning("%s did not power off, quitting qemu", self)
+        try:
+            self.qmp.cmd("quit")
+        except (OSError, QMPError):
+            pass
+        if self._wait_for_exit(self.QUIT_TIMEOUT):
+            return
+        logger.warning("qemu of %s did not quit, killing it", self)
+        os.kill(self.get_pid(), signal.SIGKILL)
+        if not self._wait_for_exit(self.QUIT_TIMEOUT):
+            raise RuntimeError("Failed to kill qemu (pid {})".format(self.get_pid()))
+
+    def _wait_for_shutdown_event(self, timeout):
+        """
+        :return: True when qemu reported the guest shutdown, or closed the QMP connection (exited)
+        """
+        try:
+            return self._wait_for_qmp_event("SHUTDOWN", timeout) is not None
+        except (OSError, QMPError):
+            return not self.is_running()
+
+    def _wait_for_qmp_event(self, name, timeout, data=None):
+        """
+        :param data: values the data of the event must have
+        :return: the event, None on timeout. The other events stay in the QMP event queue
+        """
+        def match(event):
+            return event["event"] == name and \
+                all(event.get("data", {}).get(key) == value for key, value in (data or {}).items())
+
+        try:
+            return self.qmp.wait_event(match, float(timeout))
+        except QMPTimeoutError:
+            return None
+
+    def _wait_for_exit(self, timeout):
+        try:
+            wait_until(lambda: not self.is_running(), timeout, self.QEMU_POLL_INTERVAL, "qemu to exit")
+        except TimeoutError:
+            return False
+        return True
+
+    def _read_pid(self):
+        if self._pid is None and self.pidfile is None:
+            return None
+        try:
+            return self.get_pid()
+        except (OSError, ValueError):
+            return None
+
+    def _qmp_connect(self):
+        if not self.is_running():
+            raise RuntimeError("qemu exited during startup")
+        qmp = QEMUMonitorProtocol(self.QMP_ADDRESS)
+        try:
+            qmp.connect()
+        except (OSError, QMPError):
+            qmp.close()
+            return None
+        return qmp
+
+    def is_running(self):
+        """
+        :return: True while the qemu process is alive (not a zombie, it is never waited for)
+        """
+        pid = self._read_pid()
+        if not pid:
+            return False
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+        except (OSError, IndexError):
+            return False
+
+    def _guest_ready(self):
+        if not self.is_running():
+            raise RuntimeError("qemu exited during the boot of {}".format(self))
+        return super()._guest_ready()
 
     def set_iothread_nice(self, nice=None):
         if nice is None:
             nice = self.io_nice
-        run_command_remote("127.0.0.1", "root", "renice -n {} -p {}".format(nice, self.get_pid()))
+        localRoot.remote_command("renice -n {} -p {}".format(nice, self.get_pid()))
 
     def change_qemu_parameters(self, config=None):
         if config:
@@ -400,6 +683,31 @@ class QemuNG(Qemu):
     QEMU_E1000_BETTER = 'e1000-82545em'
     # BOOTUP_WAIT = 50
 
+    # a change of these needs a new qemu / guest boot, the others are applied to the running VM by take_over()
+    RESTART_ATTRIBUTES = ("exe", "path", "mem", "cpu_to_pin", "vhost", "sidecore", "bridge", "qemu_additionals",
+                          "ethernet_dev", "mac_address", "ip_guest", "ip_host", "kernel", "initrd", "kernel_cmdline",
+                          "kernel_cmdline_additional", "guest_e1000_ng_flag", "io_thread_cpu", "is_io_thread_nice",
+                          "io_nice", "disable_kvm_poll", "netserver_enabled", "netserver_core", "netserver_nice",
+                          "guest_configure_commands")
+    # applied by replacing the NIC, the guest sets the new one up from scratch
+    NIC_ATTRIBUTES = ("e1000_options", "nic_additionals", "large_queue", "static_itr", "queue_size")
+    # the qemu process and its connections
+    RUNNING_ATTRIBUTES = ("_pid", "pidfile", "qmp", "tap_device", "_run_disk")
+    NIC_UNPLUG_TIMEOUT = 10
+    # the guest has to be reachable again after the NIC replacement within this time
+    NIC_REPLUG_TIMEOUT = 30
+    GUEST_INTERFACE = "eth0"
+    # started in the guest before the unplug: brings the new interface (new ifindex) up with the guest address
+    GUEST_REPLUG_SCRIPT = "old=$(cat /sys/class/net/{interface}/ifindex)\n" \
+                          "for i in $(seq 100); do\n" \
+                          "    new=$(cat /sys/class/net/{interface}/ifindex 2>/dev/null)\n" \
+                          "    [ -n \"$new\" ] && [ \"$new\" != \"$old\" ] && break\n" \
+                          "    sleep 0.2\n" \
+                          "done\n" \
+                          "ip link set {interface} up\n" \
+                          "ip addr replace {ip}/24 dev {interface}\n"
+    GUEST_REPLUG_SCRIPT_FILE = "/tmp/nic_replug.sh"
+
     def __init__(self, *args, **kargs):
         super().__init__(*args, **kargs)
         self.e1000_options = dict()
@@ -407,6 +715,60 @@ class QemuNG(Qemu):
         self.static_itr = False
         self.queue_size = 0
 
+    def can_take_over(self, other):
+        # qemu_config options cannot be reset to their default
+        return type(other) is type(self) and other.is_running() and \
+            all(getattr(self, name) == getattr(other, name) for name in self.RESTART_ATTRIBUTES) and \
+            set(other.qemu_config) <= set(self.qemu_config)
+
+    def take_over(self, other):
+        """
+        Take over the qemu of other and apply the difference: the NIC is replaced when its options changed, the
+        qemu_config is sent to qemu (SIGUSR1), and the guest configured again
+        """
+        logger.info("Reconfiguring VM %s to %s", other, self)
+        for name in self.RUNNING_ATTRIBUTES:
+            setattr(self, name, getattr(other, name))
+            setattr(other, name, None)
+        if any(getattr(self, name) != getattr(other, name) for name in self.NIC_ATTRIBUTES):
+            self.replug_nic()
+        if self.qemu_config != other.qemu_config:
+            self.change_qemu_parameters()
+        self.configure_guest()
+
+    def replug_nic(self):
+        """
+        Replace the NIC by one with the current options: same MAC and PCI slot, the guest brings the same interface
+        up again (GUEST_REPLUG_SCRIPT)
+        """
+        pci_address = self._nic_pci_address()
+        self.remote_root_command("cat > {}".format(self.GUEST_REPLUG_SCRIPT_FILE),
+                                 input=self.GUEST_REPLUG_SCRIPT.format(interface=self.GUEST_INTERFACE,
+                                                                       ip=self.ip_guest))
+        self.remote_root_command("nohup sh {} </dev/null >/dev/null 2>&1 &".format(self.GUEST_REPLUG_SCRIPT_FILE))
+        self.disconnect()
+        self.qmp.command("device_del", id=self.NIC_ID)
+        if not self._wait_for_qmp_event("DEVICE_DELETED", self.NIC_UNPLUG_TIMEOUT, {"device": self.NIC_ID}):
+            raise RuntimeError("The guest of {} did not release its NIC".format(self))
+        # through the human monitor, the properties are parsed as on the command line
+        error = self.qmp.command("human-monitor-command",
+                                 **{"command-line": "device_add " + self._nic_device(pci_address)})
+        if error:
+            raise RuntimeError("device_add failed: {}".format(error.strip()))
+        try:
+            wait_until(self._guest_ready, self.NIC_REPLUG_TIMEOUT, self.BOOT_POLL_INTERVAL,
+                       "{} to be reachable with the new NIC".format(self))
+        except TimeoutError:
+            raise RuntimeError("The guest of {} did not bring its new NIC up".format(self)) from None
+        self.connect()
+
+    def _nic_pci_address(self):
+        for bus in self.qmp.command("query-pci"):
+            for device in bus["devices"]:
+                if device.get("qdev_id") == self.NIC_ID:
+                    return "{:#x}.{}".format(device["slot"], device["function"])
+        raise RuntimeError("NIC {} not found".format(self.NIC_ID))
+
     def _get_temp_nic_additional(self):
         return "," + ",".join(("%s=%s" % (k, v) for k, v in self.e1000_options.items()))
 
@@ -437,6 +799,8 @@ class QemuNG(Qemu):
 
 
 class QemuE1000NG(QemuNG):
+    RESTART_ATTRIBUTES = QemuNG.RESTART_ATTRIBUTES + ("addiotional_guest_command",)
+
     def __init__(self, *args, **kargs):
         super(QemuE1000NG, self).__init__(*args, **kargs)
         self.e1000_options = {